@@ -0,0 +1,355 @@
+import time
+from collections import Counter, defaultdict
+from django.db import connection, transaction
+from django.utils.timezone import now
+from pretix.api.webhooks import notify_webhooks
+from pretix.base.models import InvoiceAddress, Order, OrderPosition, Quota, TaxRule
+from pretix.base.models.log import LogEntry
+from pretix.base.services.notifications import notify
+from pretix.base.services.pricing import get_price
+from pretix.base.services.quotas import QuotaAvailability
+
+from .instrumentation import instrument
+from .metrics import swap_lock_wait
+from .models import SwapRequest
+from .stats import update_snapshot
+from .tasks import finish_bulk_swap
+from .validation import CandidateValidator, Reasons, Rejection
+
+BULK_BATCH_SIZE = 500
+FINISH_CHUNK_SIZE = 200
+
+
+def lock_swap_pairs(event, pairs):
+    """Locks all requests of ``pairs`` in one query and reloads their state
+    and positions in another one.
+
+    Like :func:`~pretix_swap.models.lock_swap_requests`, the rows are
+    locked in primary key order.
+    """
+    requests = [request for pair in pairs for request in pair]
+    start = time.monotonic()
+    locked = {
+        pk: (state, partner_id)
+        for pk, state, partner_id in SwapRequest.objects.select_for_update()
+        .filter(pk__in=[request.pk for request in requests])
+        .order_by("pk")
+        .values_list("pk", "state", "partner_id")
+    }
+    swap_lock_wait.observe(time.monotonic() - start, operation="bulk")
+    positions = OrderPosition.all.select_related(
+        "order", "item__tax_rule", "variation", "subevent", "voucher"
+    ).in_bulk([request.position_id for request in requests])
+    for request in requests:
+        request.state, request.partner_id = locked.get(request.pk, (None, None))
+        request.position = positions[request.position_id]
+        request.position.order.event = event
+
+
+def load_quotas(event, subevent_ids):
+    """Returns the ids of the quotas of the given dates by ``(subevent_id,
+    item_id, variation_id)``, the same quotas pretix counts a position
+    against."""
+    quotas = defaultdict(set)
+    for quota in Quota.objects.filter(
+        event=event, subevent_id__in=subevent_ids
+    ).prefetch_related("items", "variations"):
+        for item in quota.items.all():
+            quotas[quota.subevent_id, item.pk, None].add(quota.pk)
+        for variation in quota.variations.all():
+            quotas[quota.subevent_id, variation.item_id, variation.pk].add(quota.pk)
+    return quotas
+
+
+def check_target_prices(pairs, subevents):
+    """Splits pairs into those whose positions can be sold on the date they
+    move to, and ``(request, other, error)`` tuples of the others.
+
+    Prices are calculated like pretix's ``OrderChangeManager`` does, for
+    the voucher and invoice address of each position.
+    """
+    dates = {}
+    for subevent in subevents.values():
+        dates.setdefault(subevent.pk, subevent)  # Loads price overrides once per date
+    invoice_addresses = {
+        address.order_id: address
+        for address in InvoiceAddress.objects.filter(
+            order_id__in={
+                request.position.order_id for pair in pairs for request in pair
+            }
+        )
+    }
+    valid = []
+    rejected = []
+    for request, other in pairs:
+        try:
+            for this, target in ((request, other), (other, request)):
+                position = this.position
+                price = get_price(
+                    position.item,
+                    position.variation,
+                    voucher=position.voucher,
+                    subevent=dates[subevents[target.pk].pk],
+                    invoice_address=invoice_addresses.get(position.order_id),
+                )
+                if price is None:
+                    raise Rejection(
+                        Reasons.NOT_ALLOWED,
+                        "This product is not available on this date.",
+                    )
+        except TaxRule.SaleNotAllowed:
+            rejected.append(
+                (
+                    request,
+                    other,
+                    Rejection(
+                        Reasons.NOT_ALLOWED,
+                        "This product can't be sold to this customer.",
+                    ),
+                )
+            )
+            continue
+        except Rejection as e:
+            rejected.append((request, other, e))
+            continue
+        valid.append((request, other))
+    return valid, rejected
+
+
+def check_quota_changes(pairs, subevents, quotas):
+    """Splits pairs into those that fit into the quotas of their new dates
+    and those that don't.
+
+    The changes of all pairs are added up per quota, and every quota that
+    gains tickets in total is checked with pretix's
+    ``QuotaAvailability``, like ``OrderChangeManager`` does. Pairs that
+    add tickets to a quota without enough capacity don't fit.
+    """
+    total = Counter()
+    changes = {}
+    for request, other in pairs:
+        change = Counter()
+        for this, target in ((request, other), (other, request)):
+            key = (this.position.item_id, this.position.variation_id)
+            change.update(quotas[(subevents[target.pk].pk, *key)])
+            change.subtract(quotas[(subevents[this.pk].pk, *key)])
+        changes[request.pk] = change
+        total.update(change)
+    gaining = [quota_id for quota_id, change in total.items() if change > 0]
+    if not gaining:
+        return pairs, []
+    availability = QuotaAvailability()
+    availability.queue(*Quota.objects.filter(pk__in=gaining))
+    availability.compute()
+    full = {
+        quota.pk
+        for quota, (state, available) in availability.results.items()
+        if state != Quota.AVAILABILITY_OK
+        or (available is not None and available < total[quota.pk])
+    }
+    fits = []
+    overbooked = []
+    for request, other in pairs:
+        if any(changes[request.pk][quota_id] > 0 for quota_id in full):
+            overbooked.append((request, other))
+        else:
+            fits.append((request, other))
+    return fits, overbooked
+
+
+def needs_change_manager(position):
+    """Seats and voucher budgets depend on the date of a position, only
+    pretix's ``OrderChangeManager`` can move them."""
+    return position.seat_id or position.voucher_budget_use is not None
+
+
+def save_log_entries(entries):
+    """Saves log entries built with ``log_action(..., save=False)`` in bulk
+    and dispatches their notifications and webhooks, like
+    ``log_action`` would."""
+    if connection.features.can_return_rows_from_bulk_insert:
+        LogEntry.objects.bulk_create(entries, batch_size=BULK_BATCH_SIZE)
+    else:  # Only SQLite, for development
+        for entry in entries:
+            entry.save()
+    types = {}
+    for entry in entries:
+        if entry.action_type not in types:
+            types[entry.action_type] = (entry.notification_type, entry.webhook_type)
+        notification_type, webhook_type = types[entry.action_type]
+        if notification_type:
+            notify.apply_async(args=(entry.pk,))
+        if webhook_type:
+            notify_webhooks.apply_async(args=(entry.pk,))
+
+
+def get_log_entries(request, other, old_subevent, new_subevent):
+    """Returns the log entries of ``swap_with`` for the order of
+    ``request``: pretix's own entry for the date change, and the swap
+    entry."""
+    position = request.position
+    order = position.order
+    return [
+        order.log_action(
+            "pretix.event.order.changed.subevent",
+            data={
+                "position": position.pk,
+                "positionid": position.positionid,
+                "old_subevent": old_subevent.pk,
+                "new_subevent": new_subevent.pk,
+                "old_price": position.price,
+                "new_price": position.price,
+            },
+            save=False,
+        ),
+        order.log_action(
+            "pretix_swap.swap.complete",
+            data={
+                "position": position.pk,
+                "positionid": position.positionid,
+                "other_position": other.position.pk,
+                "other_positionid": other.position.positionid,
+                "other_order": other.position.order.code,
+            },
+            save=False,
+        ),
+    ]
+
+
+def queue_finish_bulk_swap(event, position_ids):
+    """Queues :func:`~pretix_swap.tasks.finish_bulk_swap` in chunks. Must
+    only run after the commit, so that the workers see the changes."""
+    for start in range(0, len(position_ids), FINISH_CHUNK_SIZE):
+        end = start + FINISH_CHUNK_SIZE
+        finish_bulk_swap.apply_async(
+            kwargs={"event": event.pk, "positions": position_ids[start:end]}
+        )
+
+
+@instrument("execute_swap_pairs")
+def execute_swap_pairs(event, pairs, validator=None):
+    """Completes many pairs of swap requests in one transaction.
+
+    Every pair runs the same checks as ``SwapRequest.swap_with``, before
+    and after all requests are locked. The checks before locking use
+    ``validator``, or a new
+    :class:`~pretix_swap.validation.CandidateValidator`. The positions, requests and log
+    entries of all valid pairs are then written in batches. Ticket
+    secrets, transactions, invoices, ticket caches and emails are
+    handled by the :func:`~pretix_swap.tasks.finish_bulk_swap` task
+    after the commit.
+
+    Only paid positions are swapped. The prices on the new dates are
+    calculated like pretix does, and the net change of every quota over
+    the whole batch is checked against its capacity. Pairs that don't
+    fit into the quotas, and positions with seats or voucher budgets, are
+    swapped through ``swap_with`` after the batch.
+
+    Returns the completed pairs and ``(request, other, error)`` tuples
+    of the rejected ones.
+    """
+    validator = validator or CandidateValidator(event)
+    completed = []
+    rejected = []
+    checked = []
+    for request, other in pairs:
+        rejection = validator.check_swap(request, other)
+        if rejection:
+            rejected.append((request, other, rejection))
+            continue
+        checked.append((request, other))
+    if not checked:
+        return completed, rejected
+
+    subevents = {}
+    single = []
+    with transaction.atomic(), event.lock():
+        for request, other in checked:
+            subevents[request.pk] = request.position.subevent
+            subevents[other.pk] = other.position.subevent
+        lock_swap_pairs(event, checked)
+        quotas = load_quotas(event, {subevent.pk for subevent in subevents.values()})
+
+        accepted = []
+        for request, other in checked:
+            my_subevent = subevents[request.pk]
+            other_subevent = subevents[other.pk]
+            try:
+                request.check_locked_swap(other, my_subevent, other_subevent)
+                key = (request.position.item_id, request.position.variation_id)
+                if not (
+                    quotas[(my_subevent.pk, *key)] and quotas[(other_subevent.pk, *key)]
+                ):
+                    raise Rejection(
+                        Reasons.NO_QUOTA,
+                        "There is no quota for this product on this date.",
+                    )
+            except Rejection as e:
+                rejected.append((request, other, e))
+                continue
+            if needs_change_manager(request.position) or needs_change_manager(
+                other.position
+            ):
+                single.append((request, other))
+                continue
+            accepted.append((request, other))
+
+        accepted, invalid = check_target_prices(accepted, subevents)
+        rejected += invalid
+        accepted, overbooked = check_quota_changes(accepted, subevents, quotas)
+        single += overbooked
+
+        positions = []
+        requests = []
+        log_entries = []
+        changes = defaultdict(int)
+        timestamp = now()
+        for request, other in accepted:
+            my_subevent = subevents[request.pk]
+            other_subevent = subevents[other.pk]
+            for this, partner, old, new in (
+                (request, other, my_subevent, other_subevent),
+                (other, request, other_subevent, my_subevent),
+            ):
+                log_entries += get_log_entries(this, partner, old, new)
+                this.position.subevent = new
+                this.subevent = new
+                this.state = SwapRequest.States.COMPLETED
+                this.completed = timestamp
+                this.partner = partner
+                positions.append(this.position)
+                requests.append(this)
+                changes[old.pk] += 1
+            completed.append((request, other))
+
+        OrderPosition.all.bulk_update(
+            positions, ["subevent"], batch_size=BULK_BATCH_SIZE
+        )
+        SwapRequest.objects.bulk_update(
+            requests,
+            ["state", "completed", "partner", "subevent"],
+            batch_size=BULK_BATCH_SIZE,
+        )
+        save_log_entries(log_entries)
+        Order.objects.filter(
+            pk__in={position.order_id for position in positions}
+        ).update(last_modified=now())
+        for subevent_id, count in changes.items():
+            update_snapshot(
+                event,
+                subevent_id,
+                open_swap_requests=-count,
+                completed_swap_requests=count,
+            )
+        position_ids = [position.pk for position in positions]
+        transaction.on_commit(lambda: queue_finish_bulk_swap(event, position_ids))
+
+    for request, other in single:
+        try:
+            with transaction.atomic():
+                request.swap_with(other)
+        except Exception as e:
+            rejected.append((request, other, e))
+            continue
+        completed.append((request, other))
+    return completed, rejected
@@ -0,0 +1,80 @@
+import re
+from django.core.cache import cache
+
+from .metrics import code_lookups
+from .models import SwapRequest
+
+UNKNOWN_CODE_KEY = "pretix_swap:unknown_code:{event_id}:{kind}:{code}"
+UNKNOWN_CODE_TIMEOUT = 30
+
+SWAP_CODE_RE = re.compile(r"^[a-z0-9]{1,40}$")
+ORDER_CODE_RE = re.compile(r"^[A-Z0-9]{1,16}$")
+
+
+def normalize_swap_code(code):
+    """Swap codes are generated in lower case, see
+    :func:`~pretix_swap.models.generate_swap_code`."""
+    return (code or "").strip().lower()
+
+
+def normalize_order_code(code):
+    """pretix generates order codes in upper case."""
+    return (code or "").strip().upper()
+
+
+def forget_unknown_code(event_id, kind, code):
+    """Removes ``code`` from the cache of unknown codes, for codes that
+    have just been created."""
+    cache.delete(UNKNOWN_CODE_KEY.format(event_id=event_id, kind=kind, code=code))
+
+
+def _resolve(event, kind, code, pattern, lookup):
+    """Returns the result of ``lookup(code)``, or None for malformed codes
+    and for codes that were not found in the last
+    ``UNKNOWN_CODE_TIMEOUT`` seconds."""
+    if not pattern.match(code):
+        code_lookups.inc(1, kind=kind, result="malformed")
+        return None
+    key = UNKNOWN_CODE_KEY.format(event_id=event.pk, kind=kind, code=code)
+    if cache.get(key):
+        code_lookups.inc(1, kind=kind, result="unknown_cached")
+        return None
+    result = lookup(code)
+    if result is None:
+        code_lookups.inc(1, kind=kind, result="unknown")
+        cache.set(key, True, UNKNOWN_CODE_TIMEOUT)
+    else:
+        code_lookups.inc(1, kind=kind, result="found")
+    return result
+
+
+def resolve_swap_code(event, code):
+    """Returns the open swap request with the given Direct Code, or None.
+
+    Uses the unique index on ``SwapRequest.swap_code``.
+    """
+    return _resolve(
+        event,
+        "swap",
+        normalize_swap_code(code),
+        SWAP_CODE_RE,
+        lambda code: SwapRequest.objects.filter(
+            swap_code=code, event=event, state=SwapRequest.States.REQUESTED
+        )
+        .select_related("position")
+        .first(),
+    )
+
+
+def resolve_cancel_code(event, code):
+    """Returns the order of the event with the given order code, or None.
+
+    Uses pretix's index on ``Order.code``.
+    """
+    return _resolve(
+        event,
+        "cancel",
+        normalize_order_code(code),
+        ORDER_CODE_RE,
+        lambda code: event.orders.filter(code=code).first(),
+    )
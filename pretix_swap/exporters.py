@@ -0,0 +1,125 @@
+import io
+import json
+from collections import OrderedDict
+from django.utils.translation import gettext_lazy as _
+from pretix.base.exporter import ListExporter
+
+from .models import SwapRequest
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def str_or_none(value):
+    return None if value is None else str(value)
+
+
+class SwapRequestExporter(ListExporter):
+    identifier = "swap_requests"
+    verbose_name = _("Swap and cancelation requests")
+    category = _("Order data")
+    description = _(
+        "Download a spreadsheet of all swap and cancelation requests with their "
+        "state, dates and partners."
+    )
+
+    @property
+    def export_form_fields(self):
+        form_fields = super().export_form_fields
+        format_field = form_fields["_format"]
+        format_field.choices = list(format_field.choices) + [("jsonl", _("JSON Lines"))]
+        return form_fields
+
+    def get_filename(self):
+        return f"{self.event.slug}_swap_requests"
+
+    def get_queryset(self):
+        return (
+            SwapRequest.objects.filter(event=self.event)
+            .select_related(
+                "position__order",
+                "item",
+                "variation",
+                "subevent",
+                "target_subevent",
+                "target_order",
+                "partner__position__order",
+            )
+            .order_by("pk")
+        )
+
+    def iterate_rows(self):
+        """Yields one dict per request, reading the requests in chunks of
+        ``EXPORT_CHUNK_SIZE``."""
+        types = dict(SwapRequest.Types.choices)
+        states = dict(SwapRequest.States.choices)
+        methods = dict(SwapRequest.Methods.choices)
+        for request in self.get_queryset().iterator(chunk_size=EXPORT_CHUNK_SIZE):
+            partner = request.partner.position if request.partner else None
+            for subevent in (request.subevent, request.target_subevent):
+                if subevent:
+                    subevent.event = self.event  # Used to format the dates
+            yield OrderedDict(
+                [
+                    ("id", request.pk),
+                    ("order", request.position.order.code),
+                    ("position", request.position.positionid),
+                    ("item", str_or_none(request.item)),
+                    ("variation", str_or_none(request.variation)),
+                    ("date", str_or_none(request.subevent)),
+                    ("target_date", str_or_none(request.target_subevent)),
+                    ("type", str(types[request.swap_type])),
+                    ("state", str(states[request.state])),
+                    ("method", str(methods[request.swap_method])),
+                    ("partner_order", partner.order.code if partner else None),
+                    ("partner_position", partner.positionid if partner else None),
+                    ("target_order", getattr(request.target_order, "code", None)),
+                    ("requested", request.requested.isoformat()),
+                    ("completed", request.completed and request.completed.isoformat()),
+                ]
+            )
+
+    def iterate_list(self, form_data):
+        yield self.ProgressSetTotal(total=self.get_queryset().count())
+        yield [
+            _("ID"),
+            _("Order code"),
+            _("Position ID"),
+            _("Product"),
+            _("Variation"),
+            _("Date"),
+            _("Target date"),
+            _("Type"),
+            _("State"),
+            _("Method"),
+            _("Partner order"),
+            _("Partner position"),
+            _("Target order"),
+            _("Requested"),
+            _("Completed"),
+        ]
+        for row in self.iterate_rows():
+            yield list(row.values())
+
+    def _render_jsonl(self, output_file=None):
+        filename = self.get_filename() + ".jsonl"
+        if output_file and "b" not in output_file.mode:
+            self._write_jsonl(output_file)
+            return filename, "application/jsonl", None
+        output = io.TextIOWrapper(
+            output_file or io.BytesIO(), encoding="utf-8", newline=""
+        )
+        self._write_jsonl(output)
+        output.flush()
+        output = output.detach()  # Don't close the file with the wrapper
+        if output_file:
+            return filename, "application/jsonl", None
+        return filename, "application/jsonl", output.getvalue()
+
+    def _write_jsonl(self, output):
+        for row in self.iterate_rows():
+            output.write(json.dumps(row) + "\n")
+
+    def render(self, form_data, output_file=None):
+        if form_data.get("_format") == "jsonl":
+            return self._render_jsonl(output_file=output_file)
+        return super().render(form_data, output_file=output_file)
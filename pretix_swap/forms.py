@@ -1,3 +1,4 @@
+import json
 from decimal import Decimal
 from django import forms
 from django.contrib import messages
@@ -9,6 +10,7 @@ from i18nfield.forms import I18nModelForm
 from pretix.base.forms import SettingsForm
 from pretix.base.models import Item, SubEvent
 
+from .codes import resolve_cancel_code, resolve_swap_code
 from .models import SwapGroup, SwapRequest
 from .utils import get_target_subevents, get_valid_swap_types
 
@@ -51,6 +53,16 @@ class SwapSettingsForm(SettingsForm):
             "Allow customers to request to cancel orderpositions only with a known-to-work email address"
         ),
     )
+    swap_max_cycle_length = forms.IntegerField(
+        label=_("Maximum number of participants in a swap"),
+        min_value=2,
+        max_value=6,
+        help_text=_(
+            "With more than two participants, tickets can be swapped in a rotation, e.g. "
+            "from the first to the second date, from the second to the third date, and from "
+            "the third back to the first date."
+        ),
+    )
     swap_cancellation_fee = forms.DecimalField(
         required=False,
         max_digits=10,
@@ -62,6 +74,24 @@ class SwapSettingsForm(SettingsForm):
         ),
     )
 
+    swap_async_matching = forms.BooleanField(
+        label=_("Look for swap partners in the background"),
+        required=False,
+        help_text=_(
+            "New swap requests are matched by a background task instead of while the customer "
+            "waits for the page to load. Customers see that matching is in progress until it is done."
+        ),
+    )
+
+    swap_instrumentation = forms.BooleanField(
+        label=_("Log query counts and timings"),
+        required=False,
+        help_text=_(
+            "Writes a log line with the number of database queries and the time spent for every "
+            "swap page, matching run and signal handled for this event. Only useful for debugging."
+        ),
+    )
+
     def __init__(self, *args, **kwargs):
         self.event = kwargs.get("obj")
         super().__init__(*args, **kwargs)
@@ -77,6 +107,36 @@ class SwapSettingsForm(SettingsForm):
         val = self.cleaned_data["cancellation_fee"] or Decimal("0.00")
         return val
 
+    def save(self):
+        result = super().save()
+        if "swap_orderpositions" in self.changed_data and self.cleaned_data.get(
+            "swap_orderpositions"
+        ):
+            from .scheduler import mark_open_requests_dirty
+
+            mark_open_requests_dirty(self.event)
+        return result
+
+
+class SwapGroupImportForm(forms.Form):
+    file = forms.FileField(
+        label=_("Swap group export"),
+        help_text=_(
+            "A JSON file exported from the swap settings of this or another event. Products "
+            "are matched by their internal name or name, dates by their start time."
+        ),
+    )
+    replace = forms.BooleanField(
+        label=_("Replace all existing swap groups"),
+        required=False,
+    )
+
+    def clean_file(self):
+        try:
+            return json.load(self.cleaned_data["file"])
+        except ValueError:
+            raise forms.ValidationError(_("This is not a valid JSON file."))
+
 
 class ItemModelMultipleChoiceField(SafeModelMultipleChoiceField):
     def label_from_instance(self, instance):
@@ -154,20 +214,19 @@ class PositionModelChoiceField(forms.ModelChoiceField):
 
 
 class SwapWizardPositionForm(forms.Form):
-    def __init__(self, *args, order, **kwargs):
+    def __init__(self, *args, order, positions=None, **kwargs):
         self.order = order
         super().__init__(*args, **kwargs)
-        text = {
-            SwapRequest.Types.SWAP: _("Request a team/festival date swap"),
-            SwapRequest.Types.CANCELATION: _("Request to sell your ticket"),
-        }
-        relevant_positions = [
-            (position, text[position])
-            for position in order.positions.all()
-            if get_valid_swap_types(position)
-        ]
+        if positions is None:
+            positions = [
+                position
+                for position in order.positions.all()
+                if get_valid_swap_types(position)
+            ]
         self.fields["position"] = PositionModelChoiceField(
-            self.order.positions.filter(pk__in=[p.pk for p in relevant_positions]),
+            self.order.positions.filter(
+                pk__in=[p.pk for p in positions]
+            ).select_related("item", "variation", "subevent"),
             label=_("Which item do you want to change?"),
             widget=forms.RadioSelect,
         )
@@ -176,9 +235,13 @@ class SwapWizardPositionForm(forms.Form):
 class SwapWizardTypeForm(forms.Form):
     def __init__(self, *args, swap_types, **kwargs):
         super().__init__(*args, **kwargs)
+        text = {
+            SwapRequest.Types.SWAP: _("Request a team/festival date swap"),
+            SwapRequest.Types.CANCELATION: _("Request to sell your ticket"),
+        }
         self.fields["swap_type"] = forms.ChoiceField(
-            initial=swap_types[0],
-            choices=swap_types,
+            initial=swap_types[0] if swap_types else None,
+            choices=[(swap_type, text[swap_type]) for swap_type in swap_types],
             label=_("What do you want to do?"),
             required=True,
             widget=forms.RadioSelect,
@@ -194,16 +257,18 @@ class SwapWizardDetailsForm(forms.Form):
     - target_subevent (when the type is swap)
     """
 
-    def __init__(self, *args, position, swap_type, **kwargs):
+    def __init__(self, *args, position, swap_type, target_subevents=None, **kwargs):
         self.position = position
         self.swap_type = swap_type
         self.event = position.order.event
         super().__init__(*args, **kwargs)
         if self.swap_type == SwapRequest.Types.SWAP:
+            if target_subevents is None:
+                target_subevents = get_target_subevents(self.position, self.swap_type)
             self.fields["target_subevent"] = forms.ModelChoiceField(
                 required=True,
                 label=_("Date"),
-                queryset=get_target_subevents(self.position, self.swap_type),
+                queryset=target_subevents,
                 widget=forms.RadioSelect,
                 empty_label=None,
             )
@@ -281,11 +346,7 @@ class SwapWizardDetailsForm(forms.Form):
         data = self.cleaned_data.get("swap_code")
         if not data:
             return data
-        partner = SwapRequest.objects.filter(
-            position__order__event=self.event,
-            swap_code=data,
-            state=SwapRequest.States.REQUESTED,
-        ).first()
+        partner = resolve_swap_code(self.event, data)
         if not partner:
             raise ValidationError(_("Unknown swap code!"))
         if (partner.position.item != self.position.item) or (
@@ -324,7 +385,7 @@ class SwapWizardDetailsForm(forms.Form):
                 )
             )
 
-        order = self.event.orders.filter(code__iexact=data).first()
+        order = resolve_cancel_code(self.event, data)
         if not order:
             raise ValidationError(_("Unknown cancelation code."))
 
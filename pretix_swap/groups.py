@@ -0,0 +1,216 @@
+from collections import defaultdict
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.utils.translation import gettext_lazy as _
+
+from .models import SwapGroup
+from .scheduler import mark_buckets_dirty
+from .utils import bump_eligibility_version
+
+EXPORT_VERSION = 1
+
+
+def get_item_key(item, locale):
+    """Items are identified by their internal name, or by their name in the
+    event's default language."""
+    return item.internal_name or item.name.localize(locale)
+
+
+def get_subevent_key(subevent):
+    """Dates are identified by their start time."""
+    return subevent.date_from.isoformat()
+
+
+def get_key_map(objects, get_key):
+    """Maps the keys of ``objects`` to their ids. Keys shared by several
+    objects are returned separately and left out of the map."""
+    keys = {}
+    ambiguous = set()
+    for obj in objects:
+        key = get_key(obj)
+        if key in keys or key in ambiguous:
+            ambiguous.add(key)
+            keys.pop(key, None)
+        else:
+            keys[key] = obj.pk
+    return keys, ambiguous
+
+
+def load_group_members(groups):
+    """Returns the item and subevent ids of the given groups, in two
+    queries."""
+    items = defaultdict(list)
+    subevents = defaultdict(list)
+    for group_id, item_id in SwapGroup.items.through.objects.filter(
+        swapgroup__in=groups
+    ).values_list("swapgroup_id", "item_id"):
+        items[group_id].append(item_id)
+    for group_id, subevent_id in SwapGroup.subevents.through.objects.filter(
+        swapgroup__in=groups
+    ).values_list("swapgroup_id", "subevent_id"):
+        subevents[group_id].append(subevent_id)
+    return items, subevents
+
+
+def export_swap_groups(event):
+    """Returns the swap groups of an event as a JSON serializable dict, with
+    items and dates referenced by :func:`get_item_key` and
+    :func:`get_subevent_key`."""
+    locale = event.settings.locale
+    groups = list(event.swap_groups.order_by("pk"))
+    items, subevents = load_group_members(groups)
+    item_keys = {item.pk: get_item_key(item, locale) for item in event.items.all()}
+    subevent_keys = {
+        subevent.pk: get_subevent_key(subevent) for subevent in event.subevents.all()
+    }
+    return {
+        "version": EXPORT_VERSION,
+        "swap_groups": [
+            {
+                "name": group.name.data,
+                "swap_type": group.swap_type,
+                "items": sorted(item_keys[pk] for pk in items[group.pk]),
+                "subevents": sorted(subevent_keys[pk] for pk in subevents[group.pk]),
+            }
+            for group in groups
+        ],
+    }
+
+
+def create_swap_groups(event, groups):
+    """Creates swap groups from ``(name, swap_type, item_ids, subevent_ids)``
+    tuples, with one bulk insert for the groups and one per relation.
+
+    Bulk inserts skip the model signals, so the cached swap group rules
+    are invalidated and the affected requests are queued for matching
+    here instead.
+    """
+    instances = [
+        SwapGroup(event=event, name=name, swap_type=swap_type)
+        for name, swap_type, item_ids, subevent_ids in groups
+    ]
+    if connection.features.can_return_rows_from_bulk_insert:
+        SwapGroup.objects.bulk_create(instances)
+    else:  # Only SQLite, for development
+        for instance in instances:
+            instance.save()
+
+    item_rows = []
+    subevent_rows = []
+    for instance, (name, swap_type, item_ids, subevent_ids) in zip(instances, groups):
+        item_rows += [
+            SwapGroup.items.through(swapgroup_id=instance.pk, item_id=item_id)
+            for item_id in item_ids
+        ]
+        subevent_rows += [
+            SwapGroup.subevents.through(
+                swapgroup_id=instance.pk, subevent_id=subevent_id
+            )
+            for subevent_id in subevent_ids
+        ]
+    SwapGroup.items.through.objects.bulk_create(item_rows)
+    SwapGroup.subevents.through.objects.bulk_create(subevent_rows)
+
+    bump_eligibility_version(event.pk)
+    all_items = {row.item_id for row in item_rows}
+    if any(not item_ids for name, swap_type, item_ids, subevent_ids in groups):
+        all_items |= set(event.items.values_list("pk", flat=True))
+    mark_buckets_dirty(event.pk, all_items, {row.subevent_id for row in subevent_rows})
+    return instances
+
+
+def import_swap_groups(event, data, replace=False):
+    """Creates the swap groups of an :func:`export_swap_groups` dict in
+    ``event``, optionally replacing all existing groups.
+
+    Raises a ``ValidationError`` listing all items and dates that don't
+    exist in the event, or that match more than one item or date, without
+    creating anything.
+    """
+    try:
+        specs = data["swap_groups"]
+        locale = event.settings.locale
+        items, ambiguous_items = get_key_map(
+            event.items.all(), lambda item: get_item_key(item, locale)
+        )
+        subevents, ambiguous_subevents = get_key_map(
+            event.subevents.all(), get_subevent_key
+        )
+        missing = set()
+        ambiguous = set()
+        groups = []
+        for spec in specs:
+            if spec["swap_type"] not in SwapGroup.Types.values:
+                raise ValidationError(
+                    _("Unknown swap group type: {type}").format(type=spec["swap_type"])
+                )
+            ambiguous |= ambiguous_items.intersection(spec["items"])
+            ambiguous |= ambiguous_subevents.intersection(spec["subevents"])
+            missing |= {key for key in spec["items"] if key not in items}
+            missing |= {key for key in spec["subevents"] if key not in subevents}
+            missing -= ambiguous
+            groups.append(
+                (
+                    spec["name"],
+                    spec["swap_type"],
+                    [items[key] for key in spec["items"] if key in items],
+                    [subevents[key] for key in spec["subevents"] if key in subevents],
+                )
+            )
+    except (KeyError, TypeError):
+        raise ValidationError(_("This is not a swap group export."))
+    if missing:
+        raise ValidationError(
+            _("These products or dates do not exist in this event: {missing}").format(
+                missing=", ".join(sorted(missing))
+            )
+        )
+    if ambiguous:
+        raise ValidationError(
+            _(
+                "These products or dates are not unique in this event: {ambiguous}"
+            ).format(ambiguous=", ".join(sorted(ambiguous)))
+        )
+
+    with transaction.atomic():
+        if replace:
+            event.swap_groups.all().delete()
+        return create_swap_groups(event, groups)
+
+
+def copy_swap_groups(other, event, item_map):
+    """Copies the swap groups of ``other`` to ``event``, when an event is
+    cloned. Items are mapped with pretix's ``item_map``, dates by their
+    start time, if the new event already has dates and the start time is
+    unique.
+
+    Groups limited to items of which none were copied are skipped, they
+    would apply to all items otherwise."""
+    groups = list(other.swap_groups.order_by("pk"))
+    if not groups:
+        return []
+    items, subevents = load_group_members(groups)
+    subevent_keys = get_key_map(event.subevents.all(), get_subevent_key)[0]
+    other_keys = {
+        subevent.pk: get_subevent_key(subevent) for subevent in other.subevents.all()
+    }
+    copies = []
+    for group in groups:
+        item_ids = [item_map[pk].pk for pk in items[group.pk] if pk in item_map]
+        if items[group.pk] and not item_ids:
+            continue
+        copies.append(
+            (
+                group.name,
+                group.swap_type,
+                item_ids,
+                [
+                    subevent_keys[other_keys[pk]]
+                    for pk in subevents[group.pk]
+                    if other_keys[pk] in subevent_keys
+                ],
+            )
+        )
+    if not copies:
+        return []
+    return create_swap_groups(event, copies)
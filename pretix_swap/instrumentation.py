@@ -0,0 +1,101 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from pretix.base.models import Event
+
+from .metrics import call_db_duration, call_duration, call_queries
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter:
+    """Database execute wrapper that counts the queries run through it and
+    the time spent in them."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.monotonic() - start
+
+
+def find_event(args, kwargs):
+    """Finds the event of an instrumented call among its arguments: an
+    event, or anything with an ``event`` or ``request.event`` attribute,
+    like requests, views and swap requests.
+
+    The ``event`` relation of model instances is only used if it has
+    already been loaded, so that finding the event never costs a query.
+    """
+    for value in (kwargs.get("event"), kwargs.get("sender"), *args):
+        if isinstance(value, Event):
+            return value
+        value = getattr(value, "request", value)
+        state = getattr(value, "_state", None)
+        if state is not None and "event" not in state.fields_cache:
+            continue
+        event = getattr(value, "event", None)
+        if isinstance(event, Event):
+            return event
+    return None
+
+
+def is_logged(event):
+    return bool(event and event.settings.swap_instrumentation)
+
+
+@contextmanager
+def measure(name, event=None):
+    """Records the number of queries, the database time and the wall time
+    of the enclosed block as metrics, if pretix metrics are enabled, and
+    as a log line, if the event has ``swap_instrumentation`` turned on.
+    Does nothing otherwise."""
+    log = is_logged(event)
+    if not settings.METRICS_ENABLED and not log:
+        yield
+        return
+
+    counter = QueryCounter()
+    start = time.monotonic()
+    try:
+        with connection.execute_wrapper(counter):
+            yield
+    finally:
+        duration = time.monotonic() - start
+        if settings.METRICS_ENABLED:
+            call_duration.observe(duration, entry_point=name)
+            call_db_duration.observe(counter.duration, entry_point=name)
+            call_queries.observe(counter.count, entry_point=name)
+        if log:
+            logger.info(
+                "%s for event %s: %d queries, %.1f ms in the database, %.1f ms total",
+                name,
+                event.slug,
+                counter.count,
+                counter.duration * 1000,
+                duration * 1000,
+            )
+
+
+def instrument(name):
+    """Decorator that wraps every call in :func:`measure`, with the event
+    found by :func:`find_event`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(name, find_event(args, kwargs)):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+from pretix.base.models import Event
+
+from ...scheduler import EXECUTORS, get_executor, match_events
+
+
+class Command(BaseCommand):
+    help = "Matches the open swap requests of all events that use the swap plugin"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--organizer", help="Only match the events of this organizer (slug)"
+        )
+        parser.add_argument(
+            "--event", action="append", help="Only match this event (slug)"
+        )
+        parser.add_argument(
+            "--executor",
+            choices=sorted(EXECUTORS),
+            help="Defaults to the configured matching executor",
+        )
+
+    def handle(self, *args, **options):
+        with scopes_disabled():
+            events = Event.objects.filter(
+                plugins__contains="pretix_swap"
+            ).select_related("organizer")
+            if options["organizer"]:
+                events = events.filter(organizer__slug=options["organizer"])
+            if options["event"]:
+                events = events.filter(slug__in=options["event"])
+            run = match_events(list(events), get_executor(options["executor"]))
+        if run is None:
+            self.stdout.write("Queued the shards for matching.")
+        else:
+            self.stdout.write(f"Matched swap requests: {run}")
@@ -0,0 +1,358 @@
+import logging
+from collections import defaultdict, deque
+from django.db import transaction
+from pretix.base.models import Order
+from pretix.base.services.orders import OrderError
+
+from .bulk import execute_swap_pairs
+from .instrumentation import instrument
+from .models import SwapRequest
+from .utils import can_be_swapped, get_swappable_subevents
+from .validation import CandidateValidator, Reasons, Rejection, count_rejection
+
+logger = logging.getLogger(__name__)
+
+
+class MatchReport:
+    """Collects the outcome of a matching run.
+
+    ``matched`` contains ``(request, other)`` tuples of completed swaps,
+    ``cycles`` contains lists of requests that were swapped in a
+    rotation, ``rejected`` contains ``(request, other, reason)`` tuples of pairs
+    that were considered, but could not be swapped.
+    """
+
+    def __init__(self):
+        self.matched = []
+        self.cycles = []
+        self.rejected = []
+
+    def add_match(self, request, other):
+        self.matched.append((request, other))
+
+    def add_cycle(self, requests):
+        self.cycles.append(list(requests))
+
+    def add_rejection(self, request, other, reason):
+        count_rejection("swap", reason)
+        self.rejected.append((request, other, str(reason)))
+
+    def __str__(self):
+        return f"{len(self.matched)} matched, {len(self.cycles)} cycles, {len(self.rejected)} rejected"
+
+
+def get_bucket_key(request):
+    """Requests with the same bucket key are interchangeable for matching
+    purposes."""
+    return (
+        request.position.item_id,
+        request.position.variation_id,
+        request.position.subevent_id,
+        request.target_subevent_id,
+    )
+
+
+def get_opposite_bucket_key(key):
+    item_id, variation_id, source_id, target_id = key
+    return (item_id, variation_id, target_id, source_id)
+
+
+def load_open_swap_requests(event, subevent_ids=None, item_ids=None):
+    """Loads all open free swap requests of paid positions of an event in a
+    single query, oldest first.
+
+    If ``subevent_ids`` or ``item_ids`` are given, only requests for
+    positions on these dates or of these items are loaded.
+    """
+    requests = (
+        SwapRequest.objects.filter(
+            event_id=event.pk,
+            state=SwapRequest.States.REQUESTED,
+            swap_method=SwapRequest.Methods.FREE,
+            swap_type=SwapRequest.Types.SWAP,
+            partner__isnull=True,
+            target_subevent__isnull=False,
+            position__canceled=False,
+            position__order__status=Order.STATUS_PAID,
+        )
+        .select_related(
+            "event",
+            "position",
+            "position__order",
+            "position__item",
+            "position__variation",
+            "position__subevent",
+            "target_subevent",
+        )
+        .order_by("requested", "pk")
+    )
+    if subevent_ids is not None:
+        requests = requests.filter(subevent_id__in=subevent_ids)
+    if item_ids is not None:
+        requests = requests.filter(item_id__in=item_ids)
+    return requests
+
+
+def bucket_requests(requests):
+    buckets = defaultdict(deque)
+    for request in requests:
+        buckets[get_bucket_key(request)].append(request)
+    return buckets
+
+
+def pair_buckets(queue, other_queue, report, validator):
+    """Pairs two opposite buckets first come, first served.
+
+    The oldest request of ``queue`` is paired with the oldest request in
+    ``other_queue`` that has the same price and passes the
+    :class:`~pretix_swap.validation.CandidateValidator`. If there is
+    none, the request stays unmatched. Returns the list of pairs.
+    """
+    pairs = []
+    while queue and other_queue:
+        request = queue.popleft()
+        for other in other_queue:
+            if other.position.price != request.position.price:
+                continue
+            rejection = validator.check_swap(request, other)
+            if rejection:
+                report.add_rejection(request, other, rejection)
+                continue
+            other_queue.remove(other)
+            pairs.append((request, other))
+            break
+    return pairs
+
+
+class SwapGraph:
+    """Index of open swap requests as a directed graph of dates.
+
+    Every edge from a source date to a target date holds the requests
+    on that edge, oldest first. Only requests that are interchangeable
+    (same item, variation and price) may be put into the same graph.
+    """
+
+    def __init__(self, requests=()):
+        self.edges = defaultdict(dict)
+        for request in requests:
+            self.add(request)
+
+    def add(self, request):
+        source = request.position.subevent_id
+        target = request.target_subevent_id
+        if source == target:
+            return
+        self.edges[source].setdefault(target, deque()).append(request)
+
+    def remove(self, request):
+        source = request.position.subevent_id
+        target = request.target_subevent_id
+        queue = self.edges[source].get(target)
+        if queue is None or request not in queue:
+            return
+        queue.remove(request)
+        if not queue:
+            del self.edges[source][target]
+
+    def find_path(self, source, target, max_edges, min_node=None):
+        """Returns the shortest list of dates leading from ``source`` to
+        ``target`` (both included) with at most ``max_edges`` edges, or
+        None.
+
+        This is a breadth-first search over dates, so it runs in linear
+        time of the graph size, no matter how many requests the edges
+        hold. Dates smaller than ``min_node`` are not visited.
+        """
+        parents = {source: None}
+        depths = {source: 0}
+        nodes = deque([source])
+        while nodes:
+            node = nodes.popleft()
+            depth = depths[node] + 1
+            if depth > max_edges:
+                continue
+            for other in self.edges.get(node, ()):
+                if other == target:
+                    path = [target]
+                    while node is not None:
+                        path.append(node)
+                        node = parents[node]
+                    return path[::-1]
+                if other in parents or (min_node is not None and other < min_node):
+                    continue
+                parents[other] = node
+                depths[other] = depth
+                nodes.append(other)
+        return None
+
+    def find_cycle(self, start, max_length):
+        """Returns the oldest requests forming a cycle through ``start``,
+        where ``start`` is the smallest date in the cycle."""
+        path = self.find_path(start, start, max_length, min_node=start)
+        if not path:
+            return None
+        return [self.edges[source][target][0] for source, target in zip(path, path[1:])]
+
+    def pop_cycles(self, max_length):
+        """Yields cycles of requests until none are left.
+
+        The requests are removed from the graph before they are yielded.
+        """
+        for start in sorted(self.edges):
+            while True:
+                cycle = self.find_cycle(start, max_length)
+                if not cycle:
+                    break
+                for request in cycle:
+                    self.remove(request)
+                yield cycle
+
+
+def get_graph_key(request):
+    return (
+        request.position.item_id,
+        request.position.variation_id,
+        request.position.price,
+    )
+
+
+def build_swap_graphs(event, requests):
+    """Sorts requests into one graph per item, variation and price.
+
+    Requests on edges that are not allowed by the event's swap groups
+    are left out.
+    """
+    allowed = {}
+    graphs = defaultdict(SwapGraph)
+    for request in requests:
+        edge = (
+            request.position.item_id,
+            request.position.subevent_id,
+            request.target_subevent_id,
+        )
+        if edge not in allowed:
+            allowed[edge] = can_be_swapped(
+                event,
+                request.position.item,
+                request.position.subevent,
+                request.target_subevent,
+            )
+        if allowed[edge]:
+            graphs[get_graph_key(request)].add(request)
+    return graphs
+
+
+def match_cycles(event, requests, report, max_length):
+    for graph in build_swap_graphs(event, requests).values():
+        for cycle in graph.pop_cycles(max_length):
+            try:
+                with transaction.atomic():
+                    SwapRequest.swap_cycle(cycle)
+            except (Rejection, OrderError) as e:
+                for request, partner in zip(cycle, cycle[1:] + cycle[:1]):
+                    report.add_rejection(request, partner, e)
+                continue
+            report.add_cycle(cycle)
+
+
+def find_cycle_for_request(request):
+    """Finds a cycle of open swap requests that includes ``request``, with at
+    most as many participants as the event permits.
+
+    Returns the list of requests, starting with ``request``, or None.
+    """
+    event = request.event
+    if not can_be_swapped(
+        event,
+        request.position.item,
+        request.position.subevent,
+        request.target_subevent,
+    ):
+        return None
+    others = load_open_swap_requests(event).filter(
+        item_id=request.position.item_id,
+        variation_id=request.position.variation_id,
+        position__price=request.position.price,
+    )
+    graph = build_swap_graphs(
+        event, [other for other in others if other.pk != request.pk]
+    ).get(get_graph_key(request))
+    if not graph:
+        return None
+    path = graph.find_path(
+        request.target_subevent_id,
+        request.position.subevent_id,
+        event.settings.swap_max_cycle_length - 1,
+    )
+    if not path:
+        return None
+    return [request] + [
+        graph.edges[source][target][0] for source, target in zip(path, path[1:])
+    ]
+
+
+@instrument("match_open_swap_requests")
+def match_open_swap_requests(event, subevent_ids=None, item_ids=None):
+    """Attempts to find matches for all open free swap requests of an event,
+    or of the given dates and items of an event.
+
+    All requests are loaded at once and sorted into buckets by item,
+    variation, source and target date. Opposite buckets are then paired
+    in memory, and all chosen pairs are completed at once by
+    :func:`~pretix_swap.bulk.execute_swap_pairs`. If the
+    event permits swap cycles, the remaining requests are then rotated
+    in cycles of up to ``swap_max_cycle_length`` participants.
+
+    Requests whose dates are not both reachable for their item through
+    any swap group are rejected before the detailed checks.
+    """
+    report = MatchReport()
+    if not event.settings.swap_orderpositions:
+        return report
+
+    requests = list(load_open_swap_requests(event, subevent_ids, item_ids))
+    reachable = get_swappable_subevents(event, {r.position.item_id for r in requests})
+    buckets = bucket_requests(requests)
+    validator = CandidateValidator(event)
+    pairs = []
+    for key, queue in buckets.items():
+        item_id, variation_id, source_id, target_id = key
+        if source_id >= target_id:
+            continue  # Every pair of buckets is handled from its lower side
+        other_queue = buckets.get(get_opposite_bucket_key(key))
+        if not other_queue:
+            continue
+        request = queue[0]
+        if not {source_id, target_id} <= reachable[item_id] or not can_be_swapped(
+            event,
+            request.position.item,
+            request.position.subevent,
+            request.target_subevent,
+        ):
+            report.add_rejection(
+                request,
+                other_queue[0],
+                Rejection(Reasons.NOT_ALLOWED, "This swap is currently not allowed."),
+            )
+            continue
+        pairs += pair_buckets(queue, other_queue, report, validator)
+    if pairs:
+        completed, rejected = execute_swap_pairs(event, pairs, validator)
+        for request, other in completed:
+            report.add_match(request, other)
+        for request, other, reason in rejected:
+            report.add_rejection(request, other, reason)
+
+    max_length = event.settings.swap_max_cycle_length
+    if max_length > 2:
+        remaining = [
+            request
+            for request in requests
+            if request.state == SwapRequest.States.REQUESTED
+            and {request.position.subevent_id, request.target_subevent_id}
+            <= reachable[request.position.item_id]
+        ]
+        match_cycles(event, remaining, report, max_length)
+
+    logger.info("Matched swap requests for event %s: %s", event.slug, report)
+    return report
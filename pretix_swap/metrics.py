@@ -0,0 +1,66 @@
+from pretix.base.metrics import Counter, Histogram
+
+eligibility_cache_requests = Counter(
+    "pretix_swap_eligibility_cache_requests",
+    "Lookups of the swap group configuration in the shared cache",
+    ["result"],
+)
+
+order_paid_queue_latency = Histogram(
+    "pretix_swap_order_paid_queue_latency_seconds",
+    "Time between an order being paid and its cancelation matching starting",
+)
+
+swap_matching_latency = Histogram(
+    "pretix_swap_matching_latency_seconds",
+    "Time between a swap request being queued for matching and its matching finishing",
+)
+
+swap_lock_wait = Histogram(
+    "pretix_swap_lock_wait_seconds",
+    "Time spent waiting for the row locks of swap requests",
+    ["operation"],
+)
+swap_lock_retries = Counter(
+    "pretix_swap_lock_retries",
+    "Swap transactions retried after a deadlock or lock timeout",
+    ["operation"],
+)
+
+matching_shard_duration = Histogram(
+    "pretix_swap_matching_shard_duration_seconds",
+    "Time spent matching the open swap requests of one shard",
+)
+matching_shard_matches = Counter(
+    "pretix_swap_matching_shard_matches",
+    "Swaps and swap cycles completed by the shard matching",
+)
+
+call_duration = Histogram(
+    "pretix_swap_call_duration_seconds",
+    "Wall time of instrumented swap entry points",
+    ["entry_point"],
+)
+call_db_duration = Histogram(
+    "pretix_swap_call_db_duration_seconds",
+    "Database time of instrumented swap entry points",
+    ["entry_point"],
+)
+call_queries = Histogram(
+    "pretix_swap_call_queries",
+    "Number of database queries of instrumented swap entry points",
+    ["entry_point"],
+    buckets=[1, 2, 5, 10, 20, 50, 100, 200, 500, 1000],
+)
+
+code_lookups = Counter(
+    "pretix_swap_code_lookups",
+    "Direct Code lookups by code type and result",
+    ["kind", "result"],
+)
+
+candidate_rejections = Counter(
+    "pretix_swap_candidate_rejections",
+    "Swap and cancelation candidates that were rejected, by reason",
+    ["operation", "reason"],
+)
@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretixbase", "0183_auto_20210423_0829"),
+        ("pretix_swap", "0003_auto_20210616_2249"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SwapStatsSnapshot",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False
+                    ),
+                ),
+                ("open_swap_requests", models.IntegerField(default=0)),
+                ("completed_swap_requests", models.IntegerField(default=0)),
+                ("open_cancelation_requests", models.IntegerField(default=0)),
+                ("completed_cancelation_requests", models.IntegerField(default=0)),
+                ("approval_orders", models.IntegerField(default=0)),
+                ("pending_orders", models.IntegerField(default=0)),
+                ("rebuilt", models.DateTimeField()),
+                ("updated", models.DateTimeField()),
+                (
+                    "event",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="swap_stats",
+                        to="pretixbase.event",
+                    ),
+                ),
+                (
+                    "subevent",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="pretixbase.subevent",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("event", "subevent")},
+            },
+        ),
+    ]
@@ -0,0 +1,95 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def populate_position_fields(apps, schema_editor):
+    SwapRequest = apps.get_model("pretix_swap", "SwapRequest")
+    OrderPosition = apps.get_model("pretixbase", "OrderPosition")
+    positions = OrderPosition.all.filter(pk=OuterRef("position_id"))
+    SwapRequest.objects.update(
+        event_id=Subquery(positions.values("order__event_id")[:1]),
+        item_id=Subquery(positions.values("item_id")[:1]),
+        variation_id=Subquery(positions.values("variation_id")[:1]),
+        subevent_id=Subquery(positions.values("subevent_id")[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretixbase", "0183_auto_20210423_0829"),
+        ("pretix_swap", "0004_swap_stats_snapshot"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="swaprequest",
+            name="event",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="swap_requests",
+                to="pretixbase.event",
+            ),
+        ),
+        migrations.AddField(
+            model_name="swaprequest",
+            name="item",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="pretixbase.item",
+            ),
+        ),
+        migrations.AddField(
+            model_name="swaprequest",
+            name="subevent",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="pretixbase.subevent",
+            ),
+        ),
+        migrations.AddField(
+            model_name="swaprequest",
+            name="variation",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="pretixbase.itemvariation",
+            ),
+        ),
+        migrations.RunPython(populate_position_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="swaprequest",
+            index=models.Index(
+                condition=models.Q(("state", "r")),
+                fields=[
+                    "event",
+                    "swap_type",
+                    "swap_method",
+                    "item",
+                    "subevent",
+                    "target_subevent",
+                ],
+                name="pretix_swap_open_requests",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="swaprequest",
+            index=models.Index(
+                fields=["position", "swap_type", "state"],
+                name="pretix_swap_position_state",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="swaprequest",
+            index=models.Index(fields=["swap_code"], name="pretix_swap_swap_code"),
+        ),
+    ]
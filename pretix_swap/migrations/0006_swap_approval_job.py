@@ -0,0 +1,50 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretixbase", "0183_auto_20210423_0829"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("pretix_swap", "0005_swaprequest_denormalized_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SwapApprovalJob",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False
+                    ),
+                ),
+                ("orders", models.JSONField(default=list)),
+                ("approved", models.IntegerField(default=0)),
+                ("failed", models.IntegerField(default=0)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("finished", models.DateTimeField(null=True)),
+                (
+                    "event",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="swap_approval_jobs",
+                        to="pretixbase.event",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:34
+
+from django.db import migrations, models
+from django.utils.timezone import now
+
+
+def mark_paid_orders_processed(apps, schema_editor):
+    SwapApproval = apps.get_model("pretix_swap", "SwapApproval")
+    SwapApproval.objects.filter(order__status="p").update(processed=now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_swap", "0006_swap_approval_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="swapapproval",
+            name="processed",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(mark_paid_orders_processed, migrations.RunPython.noop),
+    ]
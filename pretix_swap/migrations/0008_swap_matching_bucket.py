@@ -0,0 +1,54 @@
+# Generated by Django 3.2.25 on 2026-10-17 00:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretixbase", "0183_auto_20210423_0829"),
+        ("pretix_swap", "0007_swapapproval_processed"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SwapMatchingBucket",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True, primary_key=True, serialize=False
+                    ),
+                ),
+                ("version", models.IntegerField(default=0)),
+                (
+                    "event",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="pretixbase.event",
+                    ),
+                ),
+                (
+                    "item",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="pretixbase.item",
+                    ),
+                ),
+                (
+                    "subevent",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="pretixbase.subevent",
+                    ),
+                ),
+            ],
+            options={
+                "unique_together": {("event", "item", "subevent")},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_swap", "0008_swap_matching_bucket"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="swaprequest",
+            index=models.Index(
+                condition=models.Q(
+                    ("state", "r"), ("swap_method", "f"), ("swap_type", "c")
+                ),
+                fields=["event", "item", "variation", "subevent", "requested", "id"],
+                name="pretix_swap_cancel_queue",
+            ),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:15
+
+from django.db import migrations, models
+
+import pretix_swap.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_swap", "0009_swap_cancel_queue"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="swaprequest",
+            name="pretix_swap_swap_code",
+        ),
+        migrations.AlterField(
+            model_name="swaprequest",
+            name="swap_code",
+            field=models.CharField(
+                default=pretix_swap.models.generate_swap_code,
+                max_length=40,
+                unique=True,
+            ),
+        ),
+    ]
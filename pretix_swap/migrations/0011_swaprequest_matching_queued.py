@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_swap", "0010_swap_code_unique"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="swaprequest",
+            name="matching_queued",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
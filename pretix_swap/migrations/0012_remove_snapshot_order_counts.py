@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-17 01:46
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("pretix_swap", "0011_swaprequest_matching_queued"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="swapstatssnapshot",
+            name="approval_orders",
+        ),
+        migrations.RemoveField(
+            model_name="swapstatssnapshot",
+            name="pending_orders",
+        ),
+    ]
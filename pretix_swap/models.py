@@ -1,13 +1,24 @@
 import string
-from django.db import models
+import time
+from django.db import OperationalError, models, transaction
 from django.utils.crypto import get_random_string
-from django.utils.functional import cached_property
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django_scopes import ScopedManager
 from i18nfield.fields import I18nCharField
+from pretix.base.models import Order
 from pretix.base.services.orders import OrderChangeManager, OrderError, cancel_order
 
-from .utils import can_be_canceled, can_be_swapped
+from .instrumentation import instrument
+from .metrics import swap_lock_retries, swap_lock_wait
+from .utils import can_be_swapped
+from .validation import (
+    CandidateValidator,
+    Reasons,
+    Rejection,
+    check_paid,
+    count_rejection,
+)
 
 
 class SwapGroup(models.Model):
@@ -62,6 +73,95 @@ class SwapApproval(models.Model):
     approved_for_cancelation_request = models.BooleanField(
         default=True
     )  # Currently always True
+    processed = models.DateTimeField(
+        null=True
+    )  # Set once the order has been paid and cancelation requests have been matched
+
+
+SWAP_LOCK_ATTEMPTS = 3
+SWAP_LOCK_BACKOFF = 0.1  # seconds, multiplied with the number of the attempt
+ATTEMPT_SWAP_CANDIDATES = 10
+
+
+def lock_swap_requests(requests, operation):
+    """Locks the rows of ``requests`` until the end of the current
+    transaction and reloads their state, their positions and the status
+    of their orders.
+
+    The rows are always locked in primary key order, so that workers
+    locking overlapping sets of requests wait for each other instead
+    of deadlocking.
+    """
+    start = time.monotonic()
+    locked = {
+        request.pk: request
+        for request in SwapRequest.objects.select_for_update()
+        .filter(pk__in=[request.pk for request in requests])
+        .order_by("pk")
+    }
+    swap_lock_wait.observe(time.monotonic() - start, operation=operation)
+    for request in requests:
+        current = locked.get(request.pk)
+        if current is None:
+            raise Rejection(Reasons.NOT_REQUESTED, "The request has been withdrawn.")
+        request.state = current.state
+        request.partner_id = current.partner_id
+        request.position.refresh_from_db()
+    statuses = dict(
+        Order.objects.filter(
+            pk__in=[request.position.order_id for request in requests]
+        ).values_list("pk", "status")
+    )
+    for request in requests:
+        request.position.order.status = statuses[request.position.order_id]
+
+
+def run_with_locks(requests, operation, func):
+    """Runs ``func`` in a transaction that holds the row locks of
+    ``requests``.
+
+    If the database aborts the transaction because of a deadlock or a
+    lock timeout, the transaction is retried up to
+    ``SWAP_LOCK_ATTEMPTS`` times.
+    """
+    for attempt in range(1, SWAP_LOCK_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                lock_swap_requests(requests, operation)
+                return func()
+        except OperationalError:
+            if attempt == SWAP_LOCK_ATTEMPTS:
+                raise
+            swap_lock_retries.inc(1, operation=operation)
+            time.sleep(SWAP_LOCK_BACKOFF * attempt)
+
+
+def sync_position_columns(order):
+    """Copies the current item, variation and date of the positions of
+    ``order`` to their swap requests, after pretix changed the order.
+
+    Returns the changed requests together with their previous date.
+    """
+    changed = []
+    for request in SwapRequest.objects.filter(position__order=order).select_related(
+        "position"
+    ):
+        position = request.position
+        if (request.item_id, request.variation_id, request.subevent_id) == (
+            position.item_id,
+            position.variation_id,
+            position.subevent_id,
+        ):
+            continue
+        changed.append((request, request.subevent_id))
+        request.item_id = position.item_id
+        request.variation_id = position.variation_id
+        request.subevent_id = position.subevent_id
+    SwapRequest.objects.bulk_update(
+        [request for request, old_subevent_id in changed],
+        ["item", "variation", "subevent"],
+    )
+    return changed
 
 
 class SwapRequest(models.Model):
@@ -91,6 +191,26 @@ class SwapRequest(models.Model):
     position = models.ForeignKey(
         "pretixbase.OrderPosition", related_name="swap_states", on_delete=models.CASCADE
     )
+    # Copies of the position's event, item, variation and subevent, kept up to
+    # date in save(), so that matching queries don't have to join positions and orders.
+    event = models.ForeignKey(
+        "pretixbase.Event",
+        related_name="swap_requests",
+        on_delete=models.CASCADE,
+        null=True,
+    )
+    item = models.ForeignKey(
+        "pretixbase.Item", related_name="+", on_delete=models.CASCADE, null=True
+    )
+    variation = models.ForeignKey(
+        "pretixbase.ItemVariation",
+        related_name="+",
+        on_delete=models.CASCADE,
+        null=True,
+    )
+    subevent = models.ForeignKey(
+        "pretixbase.SubEvent", related_name="+", on_delete=models.CASCADE, null=True
+    )
     target_subevent = models.ForeignKey(
         "pretixbase.SubEvent",
         related_name="+",
@@ -113,16 +233,64 @@ class SwapRequest(models.Model):
 
     requested = models.DateTimeField(auto_now_add=True)
     completed = models.DateTimeField(null=True)
+    matching_queued = models.DateTimeField(
+        null=True
+    )  # Set while a background matching run for this request is pending, see tasks.match_swap_request
 
-    swap_code = models.CharField(max_length=40, default=generate_swap_code)
+    swap_code = models.CharField(
+        max_length=40, default=generate_swap_code, unique=True
+    )  # Always lower case, see codes.resolve_swap_code
 
-    objects = ScopedManager(organizer="position__order__event__organizer")
+    objects = ScopedManager(organizer="event__organizer")
 
-    @cached_property
-    def event(self):
-        return self.position.order.event
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=[
+                    "event",
+                    "swap_type",
+                    "swap_method",
+                    "item",
+                    "subevent",
+                    "target_subevent",
+                ],
+                condition=models.Q(state="r"),
+                name="pretix_swap_open_requests",
+            ),
+            models.Index(
+                fields=["position", "swap_type", "state"],
+                name="pretix_swap_position_state",
+            ),
+            # The queue of free cancelation requests per item, variation and date,
+            # oldest first, see tasks.claim_cancelation_request
+            models.Index(
+                fields=["event", "item", "variation", "subevent", "requested", "id"],
+                condition=models.Q(state="r", swap_type="c", swap_method="f"),
+                name="pretix_swap_cancel_queue",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self.event_id:
+            self.event_id = self.position.order.event_id
+        self.item_id = self.position.item_id
+        self.variation_id = self.position.variation_id
+        self.subevent_id = self.position.subevent_id
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            kwargs["update_fields"] = set(update_fields) | {
+                "event",
+                "item",
+                "variation",
+                "subevent",
+            }
+        super().save(*args, **kwargs)
 
     def get_notification(self):
+        if self.state == self.States.REQUESTED and self.matching_queued:
+            return _(
+                "We are looking for a swap partner for you right now. Please reload this page in a moment."
+            )
         texts = {
             (self.Types.SWAP, self.States.REQUESTED, self.Methods.FREE): str(
                 _(
@@ -159,38 +327,57 @@ class SwapRequest(models.Model):
         }
         return texts[(self.swap_type, self.state, self.swap_method)]
 
-    def swap_with(self, other):
-        if not self.event.settings.swap_orderpositions:
-            raise Exception("Order position swapping is currently not allowed")
+    def check_swap(self, other):
+        """Raises a :class:`~pretix_swap.validation.Rejection` if the
+        positions of this request and ``other`` can't be swapped under the
+        event's settings and swap groups."""
+        rejection = CandidateValidator(self.event).check_swap(self, other)
+        if rejection:
+            raise rejection
+
+    def check_locked_swap(self, other, my_subevent, other_subevent):
+        """Raises a :class:`~pretix_swap.validation.Rejection` if the locked
+        and reloaded requests can no longer be swapped, or one of the
+        positions has moved away from the date it had before locking."""
+        # Make sure AGAIN that the state is alright, because timings
+        if self.state != self.States.REQUESTED or other.state != self.States.REQUESTED:
+            raise Rejection(
+                Reasons.NOT_REQUESTED,
+                "Both requests have to be in the 'requesting' state.",
+            )
+        if (
+            self.position.subevent_id != my_subevent.pk
+            or other.position.subevent_id != other_subevent.pk
+        ):
+            raise Rejection(
+                Reasons.POSITION_CHANGED,
+                "The position has been changed in the meantime.",
+            )
+        if not self.position.price == other.position.price:
+            raise Rejection(
+                Reasons.PRICE_MISMATCH, "Both requests have to have the same price."
+            )
+        rejection = check_paid([self.position, other.position])
+        if rejection:
+            raise rejection
 
-        my_item = self.position.item
-        my_variation = self.position.variation
+    @instrument("swap_with")
+    def swap_with(self, other):
+        self.check_swap(other)
         my_subevent = self.position.subevent
-        other_item = other.position.item
-        other_variation = other.position.variation
         other_subevent = other.position.subevent
+        run_with_locks(
+            [self, other],
+            "swap",
+            lambda: self._complete_swap(other, my_subevent, other_subevent),
+        )
 
-        if not (my_item == other_item):
-            raise Exception(f"Items do not match: {my_item} vs {other_item}.")
-        if not (my_variation == other_variation):
-            raise Exception(
-                f"Item variations do not match: {my_variation} vs {other_variation}."
-            )
-        if my_subevent == other_subevent:
-            raise Exception("Can't swap within the same subevent.")
-        if not can_be_swapped(self.event, my_item, my_subevent, other_subevent):
-            raise Exception("This swap is currently not allowed.")
-
+    def _complete_swap(self, other, my_subevent, other_subevent):
+        self.check_locked_swap(other, my_subevent, other_subevent)
+        my_item = self.position.item
+        my_variation = self.position.variation
         my_change_manager = OrderChangeManager(order=self.position.order)
         other_change_manager = OrderChangeManager(order=other.position.order)
-
-        # Make sure AGAIN that the state is alright, because timings
-        self.refresh_from_db()
-        other.refresh_from_db()
-        if self.state != self.States.REQUESTED or other.state != self.States.REQUESTED:
-            raise Exception("Both requests have to be in the 'requesting' state.")
-        if not self.position.price == other.position.price:
-            raise Exception("Both requests have to have the same price.")
         my_change_manager.change_item_and_subevent(
             position=self.position,
             item=my_item,
@@ -205,12 +392,18 @@ class SwapRequest(models.Model):
         )
         my_change_manager.commit()
         other_change_manager.commit()
-        self.state = self.States.COMPLETED
+        self.state = other.state = self.States.COMPLETED
+        self.completed = other.completed = now()
         self.partner = other
         self.save()
-        other.state = self.States.COMPLETED
         other.partner = self
         other.save()
+        from .stats import update_snapshot
+
+        for subevent in (my_subevent, other_subevent):
+            update_snapshot(
+                self.event, subevent, open_swap_requests=-1, completed_swap_requests=1
+            )
         self.position.order.log_action(
             "pretix_swap.swap.complete",
             data={
@@ -232,34 +425,169 @@ class SwapRequest(models.Model):
             },
         )
 
+    @classmethod
+    def swap_cycle(cls, requests):
+        """Rotates the positions of a cycle of swap requests.
+
+        Every request moves to the date of the next request's position,
+        the last request moves to the date of the first one. All order
+        changes are committed in one transaction, so either all or none
+        of the requests are completed.
+        """
+        if len(requests) < 2:
+            raise ValueError("A swap cycle needs at least two requests.")
+        first = requests[0]
+        event = first.event
+        if not event.settings.swap_orderpositions:
+            raise Rejection(
+                Reasons.SETTING_DISABLED,
+                "Order position swapping is currently not allowed",
+            )
+
+        item = first.position.item
+        variation = first.position.variation
+        price = first.position.price
+        partners = requests[1:] + requests[:1]
+        if len({request.position.subevent_id for request in requests}) != len(requests):
+            raise Rejection(
+                Reasons.SAME_DATE, "Every date may only occur once in a swap cycle."
+            )
+        for request, partner in zip(requests, partners):
+            if request.position.item != item:
+                raise Rejection(
+                    Reasons.ITEM_MISMATCH,
+                    f"Items do not match: {item} vs {request.position.item}.",
+                )
+            if request.position.variation != variation:
+                raise Rejection(
+                    Reasons.VARIATION_MISMATCH,
+                    f"Item variations do not match: {variation} vs {request.position.variation}.",
+                )
+            if request.position.price != price:
+                raise Rejection(
+                    Reasons.PRICE_MISMATCH, "All requests have to have the same price."
+                )
+            if request.target_subevent_id != partner.position.subevent_id:
+                raise Rejection(
+                    Reasons.DATE_MISMATCH, "The requests do not form a cycle."
+                )
+            if not can_be_swapped(
+                event, item, request.position.subevent, partner.position.subevent
+            ):
+                raise Rejection(
+                    Reasons.NOT_ALLOWED, "This swap is currently not allowed."
+                )
+
+        subevents = [request.position.subevent for request in requests]
+        run_with_locks(
+            requests,
+            "cycle",
+            lambda: cls._complete_cycle(requests, partners, subevents),
+        )
+
+    @classmethod
+    def _complete_cycle(cls, requests, partners, subevents):
+        event = requests[0].event
+        item = requests[0].position.item
+        variation = requests[0].position.variation
+        # Make sure AGAIN that the state is alright, because timings
+        for request, subevent in zip(requests, subevents):
+            if request.state != cls.States.REQUESTED:
+                raise Rejection(
+                    Reasons.NOT_REQUESTED,
+                    "All requests have to be in the 'requesting' state.",
+                )
+            if request.position.subevent_id != subevent.pk:
+                raise Rejection(
+                    Reasons.POSITION_CHANGED,
+                    "The position has been changed in the meantime.",
+                )
+        rejection = check_paid([request.position for request in requests])
+        if rejection:
+            raise rejection
+        for request, target in zip(requests, subevents[1:] + subevents[:1]):
+            change_manager = OrderChangeManager(order=request.position.order)
+            change_manager.change_item_and_subevent(
+                position=request.position,
+                item=item,
+                variation=variation,
+                subevent=target,
+            )
+            # Every date in the cycle gains and loses exactly one paid ticket of
+            # the same product, so the quotas stay the same in total.
+            change_manager.commit(check_quotas=False)
+        from .stats import update_snapshot
+
+        completed = now()
+        for request, partner, subevent in zip(requests, partners, subevents):
+            request.state = cls.States.COMPLETED
+            request.completed = completed
+            request.partner = partner
+            request.save()
+            update_snapshot(
+                event, subevent, open_swap_requests=-1, completed_swap_requests=1
+            )
+            request.position.order.log_action(
+                "pretix_swap.swap.complete",
+                data={
+                    "position": request.position.pk,
+                    "positionid": request.position.positionid,
+                    "other_position": partner.position.pk,
+                    "other_positionid": partner.position.positionid,
+                    "other_order": partner.position.order.code,
+                },
+            )
+
+    @instrument("attempt_swap")
     def attempt_swap(self):
         """Find a swap partner.
 
+        If no direct partner is found and the event allows swap cycles,
+        tries to find a cycle of swap requests that includes this one.
         Do not use for bulk action – use utils.match_open_swap_requests
         instead!
+
+        Candidates are tried oldest first. A failed swap is counted and
+        leaves the request open, it never fails the caller.
         """
         if self.swap_method != self.Methods.FREE:
             return
 
-        item = self.position.item
-        variation = self.position.variation
-        other = SwapRequest.objects.filter(
-            position__order__event_id=self.event.pk,
-            state=SwapRequest.States.REQUESTED,
-            swap_method=SwapRequest.Methods.FREE,
-            swap_type=SwapRequest.Types.SWAP,
-            partner__isnull=True,
-            target_subevent=self.position.subevent,
-            position__subevent=self.target_subevent,
-            position__item=item,
+        candidates = (
+            SwapRequest.objects.filter(
+                event_id=self.event_id,
+                state=SwapRequest.States.REQUESTED,
+                swap_method=SwapRequest.Methods.FREE,
+                swap_type=SwapRequest.Types.SWAP,
+                partner__isnull=True,
+                target_subevent=self.position.subevent,
+                subevent=self.target_subevent,
+                item=self.position.item,
+                variation=self.position.variation,
+                position__canceled=False,
+                position__order__status=Order.STATUS_PAID,
+            )
+            .exclude(pk=self.pk)
+            .select_related("position__order")
+            .order_by("requested", "pk")
         )
-        if variation:
-            other = other.filter(position__variation=variation)
-
-        other = other.exclude(pk=self.pk).first()
-        if other:
-            self.swap_with(other)
-
+        for other in candidates[:ATTEMPT_SWAP_CANDIDATES]:
+            try:
+                self.swap_with(other)
+                return
+            except (Rejection, OrderError) as e:
+                count_rejection("swap", e)
+        if self.event.settings.swap_max_cycle_length > 2:
+            from .matching import find_cycle_for_request
+
+            cycle = find_cycle_for_request(self)
+            if cycle:
+                try:
+                    self.swap_cycle(cycle)
+                except (Rejection, OrderError) as e:
+                    count_rejection("swap", e)
+
+    @instrument("cancel_for")
     def cancel_for(self, other):
         """Called when an order is marked as paid.
 
@@ -267,24 +595,25 @@ class SwapRequest(models.Model):
         calling this method.
         """
 
-        if not self.event.settings.cancel_orderpositions:
-            raise Exception("Order position canceling is currently not allowed")
+        rejection = CandidateValidator(self.event).check_cancelation(self, other)
+        if rejection:
+            raise rejection
 
-        if (
-            self.position.subevent != other.subevent
-            or self.position.item != other.item
-            or self.position.variation != other.variation
-        ):
-            raise Exception("Cancelation failed, orders are not equal")
-        if not can_be_canceled(self.event, self.position.item, self.position.subevent):
-            raise Exception("Cancelation failed, currently not allowed")
+        run_with_locks([self], "cancel", lambda: self._complete_cancelation(other))
 
+    def _complete_cancelation(self, other):
         # Make sure AGAIN that the state is alright, because timings
-        self.refresh_from_db()
         if not self.state == self.States.REQUESTED:
-            raise Exception("Not in 'requesting' state.")
+            raise Rejection(Reasons.NOT_REQUESTED, "Not in 'requesting' state.")
+        if self.position.subevent_id != other.subevent_id:
+            raise Rejection(
+                Reasons.POSITION_CHANGED,
+                "The position has been changed in the meantime.",
+            )
         if self.position.price > other.price:
-            raise Exception("Cannot cancel for a cheaper product.")
+            raise Rejection(
+                Reasons.PRICE_MISMATCH, "Cannot cancel for a cheaper product."
+            )
 
         try:
             change_manager = OrderChangeManager(order=self.position.order)
@@ -297,8 +626,17 @@ class SwapRequest(models.Model):
                 try_auto_refund=True,
             )
         self.state = self.States.COMPLETED
+        self.completed = now()
         self.target_order = other.order  # Should be set already, let's just make sure
         self.save()
+        from .stats import update_snapshot
+
+        update_snapshot(
+            self.event,
+            self.position.subevent_id,
+            open_cancelation_requests=-1,
+            completed_cancelation_requests=1,
+        )
         self.position.order.log_action(
             "pretix_swap.cancelation.complete",
             data={
@@ -309,3 +647,85 @@ class SwapRequest(models.Model):
                 "other_order": other.order.code,
             },
         )
+
+
+class SwapStatsSnapshot(models.Model):
+    """One line of the swap overview, per event and subevent.
+
+    Updated incrementally whenever a request changes state, and rebuilt
+    from scratch periodically to correct any drift. Pending orders are
+    counted live, pretix changes them without notifying plugins.
+    """
+
+    event = models.ForeignKey(
+        "pretixbase.Event", related_name="swap_stats", on_delete=models.CASCADE
+    )
+    subevent = models.ForeignKey(
+        "pretixbase.SubEvent", related_name="+", on_delete=models.CASCADE, null=True
+    )
+    open_swap_requests = models.IntegerField(default=0)
+    completed_swap_requests = models.IntegerField(default=0)
+    open_cancelation_requests = models.IntegerField(default=0)
+    completed_cancelation_requests = models.IntegerField(default=0)
+
+    rebuilt = models.DateTimeField()
+    updated = models.DateTimeField()
+
+    objects = ScopedManager(organizer="event__organizer")
+
+    class Meta:
+        unique_together = (("event", "subevent"),)
+
+
+class SwapApprovalJob(models.Model):
+    """A batch of orders waiting for approval that are approved in the
+    background, see ``tasks.approve_swap_orders``."""
+
+    event = models.ForeignKey(
+        "pretixbase.Event",
+        related_name="swap_approval_jobs",
+        on_delete=models.CASCADE,
+    )
+    user = models.ForeignKey(
+        "pretixbase.User", related_name="+", on_delete=models.SET_NULL, null=True
+    )
+    orders = models.JSONField(default=list)  # Order IDs, in the order of approval
+    approved = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True)
+
+    objects = ScopedManager(organizer="event__organizer")
+
+    @property
+    def total(self):
+        return len(self.orders)
+
+    @property
+    def remaining(self):
+        return self.total - self.approved - self.failed
+
+
+class SwapMatchingBucket(models.Model):
+    """Marks the open swap requests for one item and date as changed since
+    the last periodic matching run, see ``scheduler.match_dirty_buckets``.
+
+    ``version`` is increased every time the bucket is marked again, so that
+    a run only clears the marks it has seen.
+    """
+
+    event = models.ForeignKey(
+        "pretixbase.Event", related_name="+", on_delete=models.CASCADE
+    )
+    item = models.ForeignKey(
+        "pretixbase.Item", related_name="+", on_delete=models.CASCADE
+    )
+    subevent = models.ForeignKey(
+        "pretixbase.SubEvent", related_name="+", on_delete=models.CASCADE
+    )
+    version = models.IntegerField(default=0)
+
+    objects = ScopedManager(organizer="event__organizer")
+
+    class Meta:
+        unique_together = (("event", "item", "subevent"),)
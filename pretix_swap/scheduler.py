@@ -0,0 +1,312 @@
+import logging
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db.models import F
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Event
+
+from .matching import match_open_swap_requests
+from .metrics import matching_shard_duration, matching_shard_matches
+from .utils import load_swap_group_rules
+
+logger = logging.getLogger(__name__)
+
+CLAIM_BATCH_SIZE = 500
+
+
+def get_matching_shards(event):
+    """Splits the dates of an event into groups that can be matched
+    independently of each other.
+
+    Two dates end up in the same shard if a swap group connects them,
+    directly or through other dates. A swap request can only be matched
+    with requests of its own shard, so shards never touch the same
+    positions and can be matched in parallel. Dates without swap groups
+    can't be swapped and are left out. Returns a sorted list of sorted
+    subevent id lists.
+    """
+    from .models import SwapGroup
+
+    parents = {}
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for swap_type, item_ids, subevent_ids in load_swap_group_rules(event):
+        if swap_type != SwapGroup.Types.SWAP or not subevent_ids:
+            continue
+        for subevent_id in subevent_ids:
+            parents.setdefault(subevent_id, subevent_id)
+        root = find(subevent_ids[0])
+        for subevent_id in subevent_ids[1:]:
+            parents[find(subevent_id)] = root
+
+    shards = {}
+    for subevent_id in parents:
+        shards.setdefault(find(subevent_id), []).append(subevent_id)
+    return sorted(sorted(shard) for shard in shards.values())
+
+
+class ShardResult:
+    """Outcome of matching one shard of an event."""
+
+    def __init__(self, event, subevent_ids, item_ids, report, duration):
+        self.event = event
+        self.subevent_ids = subevent_ids
+        self.item_ids = item_ids
+        self.report = report
+        self.duration = duration
+
+    @property
+    def matches(self):
+        return len(self.report.matched) + len(self.report.cycles)
+
+    def __str__(self):
+        return f"{self.event.slug} {self.subevent_ids}: {self.report} in {self.duration:.3f}s"
+
+
+def match_shard(event, subevent_ids, item_ids=None, buckets=None):
+    """Matches one shard. The dirty ``buckets`` of the shard, as ``(pk,
+    version)`` pairs, are only cleared once matching succeeded."""
+    start = time.monotonic()
+    with scope(organizer=event.organizer):
+        report = match_open_swap_requests(event, subevent_ids, item_ids)
+        if buckets:
+            clear_dirty_buckets(buckets)
+    result = ShardResult(
+        event, subevent_ids, item_ids, report, time.monotonic() - start
+    )
+    matching_shard_duration.observe(result.duration)
+    matching_shard_matches.inc(result.matches)
+    logger.info("Matched swap request shard %s", result)
+    return result
+
+
+class SerialExecutor:
+    """Matches all shards one after another in the current process, and
+    logs the totals with ``label``."""
+
+    def run(self, shards, label):
+        start = time.monotonic()
+        results = [match_shard(*shard) for shard in shards]
+        run = MatchingRun.from_results(results, time.monotonic() - start)
+        if results:
+            logger.info("%s: %s", label, run)
+        return run
+
+
+class CeleryExecutor:
+    """Queues one celery task per shard, so that the shards are matched by
+    all celery workers in parallel.
+
+    The shard tasks are grouped in a chord, whose callback logs the totals
+    with ``label`` once all shards are done. ``run`` returns before that,
+    so it returns no results.
+    """
+
+    def run(self, shards, label):
+        from celery import chord
+
+        from .tasks import log_matching_run, match_swap_shard
+
+        if shards:
+            chord(
+                match_swap_shard.signature(
+                    kwargs={
+                        "event": event.pk,
+                        "subevent_ids": subevent_ids,
+                        "item_ids": item_ids,
+                        "buckets": buckets,
+                    }
+                )
+                for event, subevent_ids, item_ids, buckets in shards
+            )(log_matching_run.s(label=label, queued=time.time()))
+        return None
+
+
+EXECUTORS = {
+    "serial": SerialExecutor,
+    "celery": CeleryExecutor,
+}
+
+
+def get_executor(name=None):
+    """Returns the executor configured in the ``[pretix_swap]`` section of
+    the pretix configuration file, with ``matching_executor`` set to
+    ``celery`` or ``serial``. Uses celery if it is available."""
+    if name is None:
+        name = settings.CONFIG_FILE.get(
+            "pretix_swap",
+            "matching_executor",
+            fallback="celery" if settings.HAS_CELERY else "serial",
+        )
+    return EXECUTORS[name]()
+
+
+class MatchingRun:
+    """Totals of matching a number of shards. ``results`` holds the
+    :class:`ShardResult` of every shard, if they were matched in this
+    process."""
+
+    def __init__(self, shards, matches, duration, results=()):
+        self.shards = shards
+        self.matches = matches
+        self.duration = duration
+        self.results = list(results)
+
+    @classmethod
+    def from_results(cls, results, duration):
+        return cls(
+            len(results), sum(result.matches for result in results), duration, results
+        )
+
+    @property
+    def throughput(self):
+        """Completed swaps and swap cycles per second."""
+        return self.matches / self.duration if self.duration else 0.0
+
+    def __str__(self):
+        return f"{self.shards} shards, {self.matches} matches in {self.duration:.3f}s ({self.throughput:.1f}/s)"
+
+
+def match_events(events, executor=None):
+    """Matches the open swap requests of all given events, split into
+    shards, on the given or configured executor.
+
+    Returns the :class:`MatchingRun`, or None if the shards are matched in
+    the background. Used by the ``match_swap_requests`` management
+    command.
+    """
+    executor = executor or get_executor()
+    shards = [
+        (event, subevent_ids, None, None)
+        for event in events
+        if event.settings.swap_orderpositions
+        for subevent_ids in get_matching_shards(event)
+    ]
+    return executor.run(shards, "Matched swap requests")
+
+
+def mark_buckets_dirty(event_id, item_ids, subevent_ids):
+    """Marks the open swap requests for all combinations of the given items
+    and dates as changed, so that the next periodic run matches them
+    again."""
+    from .models import SwapMatchingBucket
+
+    item_ids, subevent_ids = set(item_ids), set(filter(None, subevent_ids))
+    if not item_ids or not subevent_ids:
+        return
+    SwapMatchingBucket.objects.bulk_create(
+        [
+            SwapMatchingBucket(
+                event_id=event_id, item_id=item_id, subevent_id=subevent_id
+            )
+            for item_id in item_ids
+            for subevent_id in subevent_ids
+        ],
+        ignore_conflicts=True,
+    )
+    SwapMatchingBucket.objects.filter(
+        event_id=event_id, item_id__in=item_ids, subevent_id__in=subevent_ids
+    ).update(version=F("version") + 1)
+
+
+def mark_open_requests_dirty(event):
+    """Marks the buckets of all open swap requests of an event as changed.
+
+    The periodic run drops the marks of events that don't allow swapping,
+    so they have to be set again once swapping is allowed.
+    """
+    from .models import SwapRequest
+
+    subevents = defaultdict(set)
+    for item_id, subevent_id in (
+        SwapRequest.objects.filter(
+            event=event,
+            state=SwapRequest.States.REQUESTED,
+            swap_type=SwapRequest.Types.SWAP,
+        )
+        .order_by()
+        .values_list("item_id", "subevent_id")
+        .distinct()
+    ):
+        subevents[item_id].add(subevent_id)
+    for item_id, subevent_ids in subevents.items():
+        mark_buckets_dirty(event.pk, [item_id], subevent_ids)
+
+
+def load_dirty_buckets():
+    """Returns all dirty buckets by event ID, as a dict of ``(item_id,
+    subevent_id)`` to the ``(pk, version)`` of the bucket."""
+    from .models import SwapMatchingBucket
+
+    buckets = SwapMatchingBucket.objects.values_list(
+        "pk", "version", "event_id", "item_id", "subevent_id"
+    )
+    by_event = defaultdict(dict)
+    for pk, version, event_id, item_id, subevent_id in buckets:
+        by_event[event_id][item_id, subevent_id] = (pk, version)
+    return by_event
+
+
+def clear_dirty_buckets(buckets):
+    """Clears the marks of the given ``(pk, version)`` buckets, unless they
+    were marked again in the meantime."""
+    from .models import SwapMatchingBucket
+
+    by_version = defaultdict(list)
+    for pk, version in buckets:
+        by_version[version].append(pk)
+    # Most buckets share a few versions, so this is a handful of deletes
+    for version, pks in by_version.items():
+        for start in range(0, len(pks), CLAIM_BATCH_SIZE):
+            end = start + CLAIM_BATCH_SIZE
+            SwapMatchingBucket.objects.filter(
+                pk__in=pks[start:end], version=version
+            ).delete()
+
+
+def match_dirty_buckets(executor=None):
+    """Matches the open swap requests of all buckets that changed since the
+    last run. Every shard containing a dirty date is matched again, limited
+    to the dirty items.
+
+    The marks of a shard are cleared once the shard has been matched, so
+    a failed shard is matched again by the next run. Marks that belong to
+    no shard are cleared right away. Runs from the ``periodic_task``
+    signal. Without dirty buckets, this costs a single query on a table
+    that is usually empty.
+    """
+    with scopes_disabled():
+        by_event = load_dirty_buckets()
+        if not by_event:
+            return None
+        events = list(Event.objects.filter(pk__in=by_event).select_related("organizer"))
+    shards = []
+    unmatched = []
+    for event in events:
+        dirty = by_event[event.pk]
+        with scope(organizer=event.organizer):
+            subevent_shards = (
+                get_matching_shards(event) if event.settings.swap_orderpositions else []
+            )
+        for subevent_ids in subevent_shards:
+            shard = set(subevent_ids)
+            keys = [key for key in dirty if key[1] in shard]
+            if keys:
+                shards.append(
+                    (
+                        event,
+                        subevent_ids,
+                        sorted({item_id for item_id, subevent_id in keys}),
+                        [dirty.pop(key) for key in keys],
+                    )
+                )
+        unmatched += dirty.values()
+    with scopes_disabled():
+        clear_dirty_buckets(unmatched)
+    return (executor or get_executor()).run(shards, "Matched dirty swap requests")
@@ -1,14 +1,26 @@
+import time
 from decimal import Decimal
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
 from django.dispatch import receiver
 from django.template.loader import get_template
 from django.urls import resolve, reverse
 from django.utils.translation import gettext_lazy as _
 from pretix.base.settings import settings_hierarkey
-from pretix.base.signals import logentry_display, logentry_object_link, order_paid
+from pretix.base.signals import (
+    event_copy_data,
+    logentry_display,
+    logentry_object_link,
+    order_changed,
+    order_paid,
+    periodic_task,
+    register_data_exporters,
+)
 from pretix.control.signals import nav_event, nav_event_settings, order_search_forms
 from pretix.presale.signals import order_info, order_info_top
 
-from .utils import get_valid_swap_types
+from .instrumentation import instrument
+from .utils import bump_eligibility_version, get_order_swap_requests
 
 BOOLEAN_SETTINGS = [
     "swap_orderpositions",
@@ -16,11 +28,70 @@ BOOLEAN_SETTINGS = [
     "cancel_orderpositions",
     "cancel_orderpositions_specific",
     "cancel_orderpositions_verified_only",
+    "swap_instrumentation",
+    "swap_async_matching",
 ]
 
 for settings_name in BOOLEAN_SETTINGS:
     settings_hierarkey.add_default(settings_name, "False", bool)
 settings_hierarkey.add_default("swap_cancellation_fee", "0.00", Decimal)
+settings_hierarkey.add_default("swap_max_cycle_length", "2", int)
+
+
+@receiver(post_save, sender="pretix_swap.SwapGroup", dispatch_uid="swap_group_saved")
+@receiver(
+    post_delete, sender="pretix_swap.SwapGroup", dispatch_uid="swap_group_deleted"
+)
+@receiver(
+    m2m_changed,
+    sender="pretix_swap.SwapGroup_items",
+    dispatch_uid="swap_group_items_changed",
+)
+@receiver(
+    m2m_changed,
+    sender="pretix_swap.SwapGroup_subevents",
+    dispatch_uid="swap_group_subevents_changed",
+)
+def swap_group_changed(sender, instance, **kwargs):
+    bump_eligibility_version(instance.event_id)
+
+
+@receiver(
+    m2m_changed,
+    sender="pretix_swap.SwapGroup_items",
+    dispatch_uid="swap_group_items_added",
+)
+@receiver(
+    m2m_changed,
+    sender="pretix_swap.SwapGroup_subevents",
+    dispatch_uid="swap_group_subevents_added",
+)
+def swap_group_extended(sender, instance, action, reverse, **kwargs):
+    """New items or dates in a swap group can make open requests matchable."""
+    if action != "post_add" or reverse:
+        return
+    from .scheduler import mark_buckets_dirty
+
+    item_ids = list(instance.items.values_list("pk", flat=True))
+    if not item_ids:  # Groups without items apply to all items
+        item_ids = instance.event.items.values_list("pk", flat=True)
+    mark_buckets_dirty(
+        instance.event_id, item_ids, instance.subevents.values_list("pk", flat=True)
+    )
+
+
+@receiver(post_save, sender="pretix_swap.SwapRequest", dispatch_uid="swap_created")
+def swap_request_created(sender, instance, created, **kwargs):
+    if not created:
+        return
+    from .codes import forget_unknown_code
+
+    forget_unknown_code(instance.event_id, "swap", instance.swap_code)
+    if instance.swap_type != instance.Types.SWAP:
+        return
+    from .scheduler import mark_buckets_dirty
+
+    mark_buckets_dirty(instance.event_id, [instance.item_id], [instance.subevent_id])
 
 
 @receiver(nav_event_settings, dispatch_uid="swap_nav_settings")
@@ -68,16 +139,14 @@ def navbar_info(sender, request, **kwargs):
 
 
 @receiver(order_info_top, dispatch_uid="swap_order_info_top")
+@instrument("order_info_top")
 def notifications_order_info_top(sender, request, order, **kwargs):
-    from .models import SwapRequest
-
     if not order.status == "p":
         return
     event = request.event
     notifications = []
 
-    states = SwapRequest.objects.filter(position__order=order).order_by("state")
-    if states:
+    if get_order_swap_requests(request, order).has_requests:
         notifications.append(
             {
                 "type": "info",
@@ -101,6 +170,7 @@ def notifications_order_info_top(sender, request, order, **kwargs):
 
 
 @receiver(order_info, dispatch_uid="swap_order_info")
+@instrument("order_info")
 def order_info_bottom(sender, request, order, **kwargs):
     from .models import SwapRequest
 
@@ -123,26 +193,17 @@ def order_info_bottom(sender, request, order, **kwargs):
         ).exists()
         return template.render({"secret": order.code, "in_progress": in_progress})
 
-    states = SwapRequest.objects.filter(position__order=order).order_by(
-        "position__positionid"
-    )
     can_swap = (
         event.settings.swap_orderpositions or event.settings.cancel_orderpositions
     )
+    swap_requests = get_order_swap_requests(request, order)
 
-    if not states and not can_swap:
+    if not swap_requests.has_requests and not can_swap:
         return
 
-    positions = order.positions.all().prefetch_related("swap_states")
-    for position in positions:
-        position.no_active_requests = not position.swap_states.filter(
-            state=SwapRequest.States.REQUESTED
-        ).exists()
-        position.ordered_requests = position.swap_states.order_by("requested")
-        position.actions_allowed = get_valid_swap_types(position)
     ctx = {
         "request": request,
-        "positions": positions,
+        "positions": swap_requests.positions,
         "specific_swap_allowed": event.settings.swap_orderpositions
         and event.settings.swap_orderpositions_specific,
     }
@@ -158,6 +219,10 @@ def swap_logentry_display(sender, logentry, *args, **kwargs):
             "to match a cancelation request, but no matching cancelation request was found."
         ),
     }
+    if logentry.action_type == "pretix_swap.swap.matching_failed":
+        return str(_("Matching failed with error message: {e}")).format(
+            e=logentry.parsed_data["detail"]
+        )
     if logentry.action_type in simple_displays:
         return simple_displays.get(logentry.action_type)
     if logentry.action_type == "pretix_swap.swap.cancel":
@@ -233,71 +298,81 @@ def swap_logentry_display_link(logentry, sender, *args, **kwargs):
 
 
 @receiver(order_paid, dispatch_uid="swap_order_paid")
+@instrument("order_paid")
 def swap_order_paid(order, sender, *args, **kwargs):
+    """Queues the cancelation matching for a paid order.
+
+    This runs inside the payment confirmation, so the actual work is
+    done in ``tasks.process_paid_order``, which is only queued once the
+    payment has been committed.
+    """
     swap_approval = getattr(order, "swap_approval", None)
-    if not order.event.settings.cancel_orderpositions:
-        return
-    if not swap_approval or not swap_approval.approved_for_cancelation_request:
+    if not swap_approval:
         return
 
-    from .models import SwapRequest
+    from .tasks import process_paid_order
 
-    for position in order.positions.all():
-        # First, check if there are specific cancelation request, if
-        # if not order.event.settings.cancel_orderpositions_specific:
-        specific_request = SwapRequest.objects.filter(
-            state=SwapRequest.States.REQUESTED,
-            swap_type=SwapRequest.Types.CANCELATION,
-            swap_method=SwapRequest.Methods.SPECIFIC,
-            target_order=order,
-            position__order__status="p",
-            position__item=position.item,
-            position__subevent=position.subevent,
+    queued = time.time()
+    transaction.on_commit(
+        lambda: process_paid_order.apply_async(
+            kwargs={"event": order.event_id, "order": order.pk, "queued": queued}
         )
-        if position.variation:
-            specific_request = specific_request.filter(
-                position__variation=position.variation
-            )
-        specific_request = specific_request.first()
-
-        if specific_request:
-            try:
-                specific_request.cancel_for(position)
-                continue
-            except Exception as e:
-                order.log_action(
-                    "pretix_swap.cancelation.cancelation_failed",
-                    data={"detail": str(e)},
-                )
-        # Next go through the oldest cancelation requests that are compatible
-        requests = SwapRequest.objects.filter(
-            state=SwapRequest.States.REQUESTED,
-            swap_type=SwapRequest.Types.CANCELATION,
-            swap_method=SwapRequest.Methods.FREE,
-            position__order__status="p",
-            position__item=position.item,
-            position__subevent=position.subevent,
-        )
-        if position.variation:
-            requests = requests.filter(position__variation=position.variation)
-        if not requests:
-            order.log_action(
-                "pretix_swap.cancelation.no_partner",
-                data={
-                    "position": position.pk,
-                    "positionid": position.positionid,
-                },
-            )
-            return
-        for request in requests:  # Try until we succeed or run out of requests
-            try:
-                request.cancel_for(position)
-                break
-            except Exception as e:
-                order.log_action(
-                    "pretix_swap.cancelation.cancelation_failed",
-                    data={"detail": str(e)},
-                )
+    )
+
+
+@receiver(order_changed, dispatch_uid="swap_order_changed")
+def swap_order_changed(order, sender, *args, **kwargs):
+    """Keeps the copied position columns of swap requests in sync when the
+    products or dates of an order are changed."""
+    from .models import sync_position_columns
+    from .scheduler import mark_buckets_dirty
+    from .stats import get_counter, update_snapshot
+
+    for request, old_subevent_id in sync_position_columns(order):
+        if (
+            request.state == request.States.REQUESTED
+            and request.subevent_id == request.target_subevent_id
+        ):
+            continue  # Moved by our own swap, which updates the snapshot itself
+        if request.subevent_id != old_subevent_id:
+            counter = get_counter(request)
+            update_snapshot(sender, old_subevent_id, **{counter: -1})
+            update_snapshot(sender, request.subevent_id, **{counter: 1})
+        if (
+            request.swap_type == request.Types.SWAP
+            and request.state == request.States.REQUESTED
+        ):
+            mark_buckets_dirty(sender.pk, [request.item_id], [request.subevent_id])
+
+
+@receiver(periodic_task, dispatch_uid="swap_rebuild_stats")
+@instrument("periodic.rebuild_stats")
+def rebuild_stats(sender, **kwargs):
+    from .stats import rebuild_stale_snapshots
+
+    rebuild_stale_snapshots()
+
+
+@receiver(periodic_task, dispatch_uid="swap_match_dirty_buckets")
+@instrument("periodic.match_dirty_buckets")
+def match_dirty_buckets(sender, **kwargs):
+    from .scheduler import match_dirty_buckets
+
+    match_dirty_buckets()
+
+
+@receiver(event_copy_data, dispatch_uid="swap_copy_data")
+def copy_swap_groups(sender, other, item_map, **kwargs):
+    from .groups import copy_swap_groups
+
+    copy_swap_groups(other, sender, item_map)
+
+
+@receiver(register_data_exporters, dispatch_uid="swap_exporter")
+def register_swap_exporter(sender, **kwargs):
+    from .exporters import SwapRequestExporter
+
+    return SwapRequestExporter
 
 
 @receiver(order_search_forms)
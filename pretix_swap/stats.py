@@ -0,0 +1,159 @@
+import datetime
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils.timezone import now
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Event, Order, OrderPosition
+
+from .models import SwapRequest, SwapStatsSnapshot
+
+SNAPSHOT_MAX_AGE = datetime.timedelta(hours=1)
+
+
+def count_requests_by_subevent(event):
+    """Counts the swap and cancelation requests of an event by state, grouped
+    by subevent, in a single query."""
+    return {
+        row.pop("subevent"): row
+        for row in SwapRequest.objects.filter(event=event)
+        .order_by()
+        .values("subevent")
+        .annotate(
+            open_swap_requests=Count(
+                "pk",
+                filter=Q(
+                    swap_type=SwapRequest.Types.SWAP,
+                    state=SwapRequest.States.REQUESTED,
+                ),
+            ),
+            completed_swap_requests=Count(
+                "pk",
+                filter=Q(
+                    swap_type=SwapRequest.Types.SWAP,
+                    state=SwapRequest.States.COMPLETED,
+                ),
+            ),
+            open_cancelation_requests=Count(
+                "pk",
+                filter=Q(
+                    swap_type=SwapRequest.Types.CANCELATION,
+                    state=SwapRequest.States.REQUESTED,
+                    partner__isnull=True,
+                    position__order__status=Order.STATUS_PAID,
+                ),
+            ),
+            completed_cancelation_requests=Count(
+                "pk",
+                filter=Q(
+                    swap_type=SwapRequest.Types.CANCELATION,
+                    state=SwapRequest.States.COMPLETED,
+                ),
+            ),
+        )
+    }
+
+
+def count_pending_orders_by_subevent(event):
+    """Counts the positions of pending orders with and without approval,
+    grouped by subevent, in a single query."""
+    return {
+        row.pop("subevent"): row
+        for row in OrderPosition.objects.filter(
+            order__status="n",  # Pending orders with and without approval
+            order__event=event,
+        )
+        .order_by()
+        .values("subevent")
+        .annotate(
+            approval_orders=Count("pk", filter=Q(order__require_approval=True)),
+            pending_orders=Count("pk", filter=Q(order__require_approval=False)),
+        )
+    }
+
+
+@transaction.atomic
+def rebuild_snapshot(event):
+    """Recomputes the swap overview of an event from scratch."""
+    requests = count_requests_by_subevent(event)
+    subevent_ids = set(event.subevents.values_list("pk", flat=True))
+    if not subevent_ids:
+        subevent_ids = {None}
+    timestamp = now()
+    SwapStatsSnapshot.objects.filter(event=event).delete()
+    SwapStatsSnapshot.objects.bulk_create(
+        [
+            SwapStatsSnapshot(
+                event=event,
+                subevent_id=subevent_id,
+                rebuilt=timestamp,
+                updated=timestamp,
+                **requests.get(subevent_id, {}),
+            )
+            for subevent_id in subevent_ids
+        ]
+    )
+
+
+def get_snapshot(event):
+    """Returns the swap overview lines of an event, ordered by subevent.
+
+    The snapshot is built on first use.
+    """
+    lines = SwapStatsSnapshot.objects.filter(event=event)
+    if not lines.exists():
+        rebuild_snapshot(event)
+    return list(
+        lines.select_related("subevent").order_by(
+            "subevent__date_from", "subevent__name", "subevent_id"
+        )
+    )
+
+
+def get_counter(request):
+    """Returns the name of the snapshot counter a swap or cancelation
+    request is counted in."""
+    state = "open" if request.state == SwapRequest.States.REQUESTED else "completed"
+    kind = "swap" if request.swap_type == SwapRequest.Types.SWAP else "cancelation"
+    return f"{state}_{kind}_requests"
+
+
+def update_snapshot(event, subevent, **changes):
+    """Adds the given changes (counter name: difference) to the snapshot line
+    of a subevent.
+
+    Events whose overview has never been opened have no snapshot and are
+    skipped, their snapshot will be built on first use.
+    """
+    subevent_id = getattr(subevent, "pk", subevent)
+    updated = SwapStatsSnapshot.objects.filter(
+        event=event, subevent_id=subevent_id
+    ).update(
+        updated=now(),
+        **{counter: F(counter) + value for counter, value in changes.items()},
+    )
+    if not updated and SwapStatsSnapshot.objects.filter(event=event).exists():
+        timestamp = now()
+        SwapStatsSnapshot.objects.create(
+            event=event,
+            subevent_id=subevent_id,
+            rebuilt=timestamp,
+            updated=timestamp,
+            **{counter: max(value, 0) for counter, value in changes.items()},
+        )
+
+
+def rebuild_stale_snapshots():
+    """Rebuilds all snapshots that have not been rebuilt for
+    ``SNAPSHOT_MAX_AGE``."""
+    with scopes_disabled():
+        stale = (
+            SwapStatsSnapshot.objects.order_by()
+            .values("event")
+            .annotate(last_rebuilt=Min("rebuilt"))
+            .filter(last_rebuilt__lt=now() - SNAPSHOT_MAX_AGE)
+            .values_list("event", flat=True)
+        )
+        events = list(Event.objects.filter(pk__in=stale).select_related("organizer"))
+    for event in events:
+        with scope(organizer=event.organizer):
+            rebuild_snapshot(event)
@@ -0,0 +1,308 @@
+import time
+from collections import defaultdict
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils.timezone import now
+from pretix.base.models import Order, OrderPosition
+from pretix.base.secrets import assign_ticket_secret
+from pretix.base.services import tickets
+from pretix.base.services.invoices import (
+    generate_cancellation,
+    generate_invoice,
+    invoice_qualified,
+)
+from pretix.base.services.orders import (
+    OrderError,
+    approve_order,
+    notify_user_changed_order,
+)
+from pretix.base.services.tasks import EventTask
+from pretix.base.signals import order_changed
+from pretix.celery_app import app
+
+from .metrics import order_paid_queue_latency, swap_matching_latency
+from .models import SwapApproval, SwapApprovalJob, SwapRequest
+from .validation import CandidateValidator, count_rejection
+
+APPROVAL_CHUNK_SIZE = 50
+
+
+def approve_chunk(event, job, order_ids):
+    """Approves one chunk of orders and returns the number of approved and
+    failed orders.
+
+    Every order is approved in its own short transaction, and
+    ``approve_order`` sends its email only after that transaction has
+    been committed. Orders that no longer wait for approval, or that
+    already have a :class:`SwapApproval` of another job, count as failed.
+    """
+    orders = {
+        order.pk: order
+        for order in Order.objects.filter(
+            event=event,
+            pk__in=order_ids,
+            status=Order.STATUS_PENDING,
+            require_approval=True,
+            swap_approval__isnull=True,
+        )
+    }
+    SwapApproval.objects.bulk_create(
+        [SwapApproval(order=order) for order in orders.values()],
+        ignore_conflicts=True,
+    )
+    approved = failed = 0
+    for order_id in order_ids:
+        order = orders.get(order_id)
+        if not order:
+            failed += 1
+            continue
+        try:
+            approve_order(order, user=job.user, send_mail=True)
+        except OrderError as e:
+            SwapApproval.objects.filter(order=order).delete()
+            order.log_action(
+                "pretix_swap.cancelation.approve_failed",
+                data={"detail": str(e)},
+                user=job.user,
+            )
+            failed += 1
+            continue
+        approved += 1
+    return approved, failed
+
+
+@app.task(base=EventTask)
+def approve_swap_orders(event, job: int):
+    """Approves the orders of a :class:`SwapApprovalJob` in chunks of
+    ``APPROVAL_CHUNK_SIZE``, and records the progress on the job after every
+    chunk."""
+    job = SwapApprovalJob.objects.select_related("user").get(event=event, pk=job)
+    done = job.approved + job.failed
+    for start in range(done, job.total, APPROVAL_CHUNK_SIZE):
+        end = start + APPROVAL_CHUNK_SIZE
+        approved, failed = approve_chunk(event, job, job.orders[start:end])
+        SwapApprovalJob.objects.filter(pk=job.pk).update(
+            approved=F("approved") + approved, failed=F("failed") + failed
+        )
+    SwapApprovalJob.objects.filter(pk=job.pk).update(finished=now())
+
+
+def match_cancelation_requests(order):
+    """Cancels one matching position with an open cancelation request for
+    every position of a paid order.
+
+    Specific requests that name this order are preferred, then the
+    oldest free requests are tried.
+    """
+    validator = CandidateValidator(order.event)
+    for position in order.positions.all():
+        specific_request = SwapRequest.objects.filter(
+            state=SwapRequest.States.REQUESTED,
+            swap_type=SwapRequest.Types.CANCELATION,
+            swap_method=SwapRequest.Methods.SPECIFIC,
+            target_order=order,
+            position__order__status="p",
+            item=position.item,
+            subevent=position.subevent,
+        )
+        if position.variation:
+            specific_request = specific_request.filter(variation=position.variation)
+        specific_request = specific_request.select_related("position").first()
+
+        if specific_request and cancel_for_position(
+            validator, specific_request, position
+        ):
+            continue
+        # Next go through the oldest cancelation requests that are compatible
+        failed = []
+        while True:  # Try until we succeed or run out of requests
+            request = claim_cancelation_request(position, exclude=failed)
+            if not request or cancel_for_position(validator, request, position):
+                break
+            failed.append(request.pk)
+        if not request and not failed:
+            order.log_action(
+                "pretix_swap.cancelation.no_partner",
+                data={
+                    "position": position.pk,
+                    "positionid": position.positionid,
+                },
+            )
+
+
+def cancel_for_position(validator, request, position):
+    """Cancels the position of ``request`` in favour of the paid
+    ``position`` and returns whether that worked.
+
+    Requests rejected by the validator are left unchanged, but stay locked
+    until the surrounding transaction ends.
+    Failures are counted by reason and logged on the paid order.
+    """
+    error = validator.check_cancelation(request, position)
+    if not error:
+        try:
+            request.cancel_for(position)
+            return True
+        except Exception as e:
+            error = e
+    count_rejection("cancelation", error)
+    position.order.log_action(
+        "pretix_swap.cancelation.cancelation_failed",
+        data={"detail": str(error)},
+    )
+    return False
+
+
+def claim_cancelation_request(position, exclude=()):
+    """Locks and returns the oldest open free cancelation request for the
+    item, variation and date of ``position``, or None.
+
+    The request is read from the head of the ``pretix_swap_cancel_queue``
+    index. Requests locked by concurrent payments are skipped instead of
+    waited for, so that every payment claims a different request. The
+    lock is held until the end of the surrounding transaction. Only the
+    request row is locked on databases that support ``SELECT ... FOR
+    UPDATE OF``, everywhere else the joined rows are locked as well.
+    """
+    of = ("self",) if connection.features.has_select_for_update_of else ()
+    return (
+        SwapRequest.objects.select_for_update(skip_locked=True, of=of)
+        .filter(
+            event_id=position.order.event_id,
+            item_id=position.item_id,
+            variation_id=position.variation_id,
+            subevent_id=position.subevent_id,
+            state=SwapRequest.States.REQUESTED,
+            swap_type=SwapRequest.Types.CANCELATION,
+            swap_method=SwapRequest.Methods.FREE,
+            position__order__status=Order.STATUS_PAID,
+        )
+        .exclude(pk__in=exclude)
+        .select_related("position")
+        .order_by("requested", "pk")
+        .first()
+    )
+
+
+@app.task(base=EventTask)
+def process_paid_order(event, order: int, queued: float = None):
+    """Runs the cancelation matching for an order that has been approved
+    through the swap overview and was then paid.
+
+    The order's ``SwapApproval`` is locked while the order is processed
+    and marked as processed in the same transaction, so running the task
+    twice for the same order has no effect.
+    """
+    if queued is not None:
+        order_paid_queue_latency.observe(time.time() - queued)
+    with transaction.atomic():
+        swap_approval = (
+            SwapApproval.objects.select_for_update()
+            .select_related("order")
+            .filter(order__event=event, order_id=order, processed__isnull=True)
+            .first()
+        )
+        if not swap_approval:
+            return
+        order = swap_approval.order
+        if (
+            event.settings.cancel_orderpositions
+            and swap_approval.approved_for_cancelation_request
+        ):
+            match_cancelation_requests(order)
+        swap_approval.processed = now()
+        swap_approval.save(update_fields=["processed"])
+
+
+@app.task(base=EventTask)
+def match_swap_shard(
+    event, subevent_ids: list, item_ids: list = None, buckets: list = None
+):
+    """Matches the open swap requests of one shard of an event, see
+    :func:`pretix_swap.scheduler.get_matching_shards`, and clears the
+    dirty ``buckets`` of the shard afterwards. Returns the number of
+    matches for :func:`log_matching_run`."""
+    from .scheduler import match_shard
+
+    return match_shard(event, subevent_ids, item_ids, buckets).matches
+
+
+@app.task()
+def log_matching_run(matches: list, label: str, queued: float):
+    """Logs the totals of the shards of a matching run, once all of them
+    are done."""
+    from .scheduler import MatchingRun, logger
+
+    run = MatchingRun(len(matches), sum(matches), time.time() - queued)
+    logger.info("%s: %s", label, run)
+
+
+def reissue_invoice(order):
+    """Cancels and reissues the invoice of a changed order, like pretix's
+    ``OrderChangeManager`` does."""
+    invoices = []
+    invoice = order.invoices.filter(is_cancellation=False).last()
+    if invoice and not invoice.refered.exists():
+        invoices.append(generate_cancellation(invoice))
+    if invoice_qualified(order) and (
+        invoice or order.event.settings.invoice_generate == "True"
+    ):
+        invoices.append(generate_invoice(order))
+    return invoices
+
+
+@app.task(base=EventTask)
+def finish_bulk_swap(event, positions: list):
+    """Runs the side effects that pretix's ``OrderChangeManager`` would run
+    for the orders of positions swapped by
+    :func:`pretix_swap.bulk.execute_swap_pairs`: new ticket secrets,
+    transactions, invoices, ticket caches and emails."""
+    changed = defaultdict(list)
+    for position in OrderPosition.all.filter(
+        order__event=event, pk__in=positions
+    ).select_related("order"):
+        changed[position.order].append(position)
+    for order, order_positions in changed.items():
+        with transaction.atomic():
+            for position in order_positions:
+                assign_ticket_secret(
+                    event=event, position=position, force_invalidate=False, save=True
+                )
+            order.create_transactions()
+            invoices = reissue_invoice(order)
+        tickets.invalidate_cache.apply_async(
+            kwargs={"event": event.pk, "order": order.pk}
+        )
+        notify_user_changed_order(
+            order,
+            invoices=invoices if event.settings.invoice_email_attachment else [],
+        )
+        order_changed.send(event, order=order)
+
+
+@app.task(base=EventTask)
+def match_swap_request(event, request: int, queued: float = None):
+    """Looks for a partner for a swap request that was submitted with
+    ``swap_async_matching`` turned on.
+
+    If matching fails, the request stays open for the periodic matching
+    run. Either way, the request is no longer shown as being matched.
+    """
+    instance = (
+        SwapRequest.objects.select_related("position__order")
+        .filter(event=event, pk=request, matching_queued__isnull=False)
+        .first()
+    )
+    if not instance:
+        return
+    try:
+        with transaction.atomic():
+            if instance.state == SwapRequest.States.REQUESTED:
+                instance.attempt_swap()
+    except Exception as e:
+        instance.position.order.log_action(
+            "pretix_swap.swap.matching_failed", data={"detail": str(e)}
+        )
+    SwapRequest.objects.filter(pk=instance.pk).update(matching_queued=None)
+    if queued is not None:
+        swap_matching_latency.observe(time.time() - queued)
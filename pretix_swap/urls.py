@@ -13,6 +13,16 @@ urlpatterns = [
         views.SwapGroupCreate.as_view(),
         name="settings.new",
     ),
+    url(
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/settings/swap/import/$",
+        views.SwapGroupImport.as_view(),
+        name="settings.import",
+    ),
+    url(
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/settings/swap/export/$",
+        views.SwapGroupExport.as_view(),
+        name="settings.export",
+    ),
     url(
         r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/settings/swap/(?P<pk>[0-9]+)/$",
         views.SwapGroupEdit.as_view(),
@@ -28,6 +38,16 @@ urlpatterns = [
         views.SwapStats.as_view(),
         name="stats",
     ),
+    url(
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/swap/rebuild$",
+        views.SwapStatsRebuild.as_view(),
+        name="stats.rebuild",
+    ),
+    url(
+        r"^control/event/(?P<organizer>[^/]+)/(?P<event>[^/]+)/swap/approvals/(?P<pk>[0-9]+)/$",
+        views.SwapApprovalJobDetail.as_view(),
+        name="approval",
+    ),
 ]
 
 from pretix.multidomain import event_url
@@ -1,32 +1,183 @@
-from django.db.models import Q
+from collections import defaultdict
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils.crypto import get_random_string
+
+from .metrics import eligibility_cache_requests
+
+ELIGIBILITY_KEY = "pretix_swap:eligibility:{event_id}:{version}"
+ELIGIBILITY_VERSION_KEY = "pretix_swap:eligibility_version:{event_id}"
+ELIGIBILITY_CACHE_TIMEOUT = 3600
+
+_eligibility_cache = {}
+
+
+class SwapEligibility:
+    """Compiled swap group rules of an event.
+
+    Maps ``(item_id, subevent_id, swap_type)`` to the ids of all
+    subevents that the position may be swapped to (for cancelations:
+    that are in the same group). Groups without items apply to all
+    items and are stored with an ``item_id`` of None.
+    """
+
+    def __init__(self, rules):
+        """``rules`` is an iterable of ``(swap_type, item_ids, subevent_ids)``
+        tuples, one per swap group."""
+        self.targets = {}
+        for swap_type, item_ids, subevent_ids in rules:
+            subevent_ids = frozenset(subevent_ids)
+            for item_id in item_ids or [None]:
+                for subevent_id in subevent_ids:
+                    key = (item_id, subevent_id, swap_type)
+                    if key in self.targets:
+                        self.targets[key] = self.targets[key] | subevent_ids
+                    else:
+                        self.targets[key] = subevent_ids
+
+    def get_targets(self, item_id, subevent_id, swap_type):
+        specific = self.targets.get((item_id, subevent_id, swap_type))
+        general = self.targets.get((None, subevent_id, swap_type))
+        if specific is None or general is None:
+            return specific or general or frozenset()
+        return specific | general
+
+    def is_eligible(self, item_id, subevent_id, swap_type):
+        return (item_id, subevent_id, swap_type) in self.targets or (
+            None,
+            subevent_id,
+            swap_type,
+        ) in self.targets
+
+    def can_swap(self, item_id, subevent_id, other_subevent_id):
+        from .models import SwapGroup
+
+        swap_type = SwapGroup.Types.SWAP
+        return other_subevent_id in self.targets.get(
+            (item_id, subevent_id, swap_type), ()
+        ) or other_subevent_id in self.targets.get((None, subevent_id, swap_type), ())
+
+    def get_reachable(self, swap_type):
+        """Returns the ids of all subevents in groups of ``swap_type`` by
+        item id, with the subevents of groups without items under None."""
+        reachable = defaultdict(set)
+        for (item_id, subevent_id, key_type), targets in self.targets.items():
+            if key_type == swap_type:
+                reachable[item_id] |= targets
+        return reachable
+
+    def get_swap_types(self, item_id, subevent_id):
+        from .models import SwapGroup
+
+        return {
+            swap_type
+            for swap_type in SwapGroup.Types.values
+            if self.is_eligible(item_id, subevent_id, swap_type)
+        }
+
+
+def load_swap_group_rules(event):
+    """Returns one ``(swap_type, item_ids, subevent_ids)`` tuple per swap
+    group of the event, in a fixed number of queries."""
+    from .models import SwapGroup
+
+    items = defaultdict(list)
+    subevents = defaultdict(list)
+    for group_id, item_id in SwapGroup.items.through.objects.filter(
+        swapgroup__event_id=event.pk
+    ).values_list("swapgroup_id", "item_id"):
+        items[group_id].append(item_id)
+    for group_id, subevent_id in SwapGroup.subevents.through.objects.filter(
+        swapgroup__event_id=event.pk
+    ).values_list("swapgroup_id", "subevent_id"):
+        subevents[group_id].append(subevent_id)
+    return [
+        (swap_type, sorted(items[group_id]), sorted(subevents[group_id]))
+        for group_id, swap_type in SwapGroup.objects.filter(
+            event_id=event.pk
+        ).values_list("id", "swap_type")
+    ]
+
+
+def get_eligibility_version(event_id):
+    """Returns the current version of an event's swap group configuration.
+
+    The version is a random token, so that cache entries written before
+    the version key was lost can never be mistaken for current ones.
+    """
+    key = ELIGIBILITY_VERSION_KEY.format(event_id=event_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, get_random_string(12), timeout=None)
+        version = cache.get(key) or get_random_string(12)
+    return version
+
+
+def _set_eligibility_version(event_id):
+    cache.set(
+        ELIGIBILITY_VERSION_KEY.format(event_id=event_id),
+        get_random_string(12),
+        timeout=None,
+    )
+    _eligibility_cache.pop(event_id, None)
+
+
+def bump_eligibility_version(event_id):
+    """Invalidates the cached swap group configuration of an event in all
+    processes.
+
+    Inside a transaction, the version is changed again after the commit.
+    Until then, other processes still read the old rules and would cache
+    them under the first new version.
+    """
+    _set_eligibility_version(event_id)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _set_eligibility_version(event_id))
+
+
+def get_eligibility(event):
+    """Returns the :class:`SwapEligibility` of an event.
+
+    The swap group rules are stored in Django's cache under a versioned
+    key, so that all workers share them. On a cache miss, they are
+    loaded from the database. The compiled index is kept in memory for
+    as long as the version does not change.
+    """
+    version = get_eligibility_version(event.pk)
+    cached = _eligibility_cache.get(event.pk)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    key = ELIGIBILITY_KEY.format(event_id=event.pk, version=version)
+    rules = cache.get(key)
+    if rules is None:
+        eligibility_cache_requests.inc(1, result="miss")
+        rules = load_swap_group_rules(event)
+        cache.set(key, rules, ELIGIBILITY_CACHE_TIMEOUT)
+    else:
+        eligibility_cache_requests.inc(1, result="hit")
+    eligibility = SwapEligibility(rules)
+    _eligibility_cache[event.pk] = (version, eligibility)
+    return eligibility
 
 
 def get_target_subevents(position, swap_type):
     from pretix.base.models.event import SubEvent
 
-    result = set()
-    groups = position.order.event.swap_groups.all().filter(
-        Q(items__isnull=True) | Q(items__in=[position.item]),
-        swap_type=swap_type,
+    targets = get_eligibility(position.order.event).get_targets(
+        position.item_id, position.subevent_id, swap_type
     )
-    for group in groups:
-        result |= set(group.subevents.all().values_list("id", flat=True))
-    return SubEvent.objects.filter(pk__in=result).exclude(pk=position.subevent.pk)
+    return SubEvent.objects.filter(pk__in=targets).exclude(pk=position.subevent_id)
 
 
 def get_valid_swap_types(position):
     from .models import SwapRequest
 
-    actions = set(
-        position.order.event.swap_groups.all()
-        .filter(
-            Q(items__isnull=True) | Q(items__in=[position.item]),
-            subevents__in=[position.subevent],
-        )
-        .values_list("swap_type", flat=True)
+    event = position.order.event
+    actions = get_eligibility(event).get_swap_types(
+        position.item_id, position.subevent_id
     )
     result = []
-    event = position.order.event
     if event.settings.swap_orderpositions and SwapRequest.Types.SWAP in actions:
         result.append(SwapRequest.Types.SWAP)
     if (
@@ -37,111 +188,112 @@ def get_valid_swap_types(position):
     return result
 
 
-def test_swap_groups(groups, item, subevent, other_subevent=None):
-    for group in groups:
-        if group.items.all() and item not in group.items.all():
-            continue
-        if subevent not in group.subevents.all():
-            continue
-        if not other_subevent or other_subevent in group.subevents.all():
-            return True
-    return False
+class OrderSwapRequests:
+    """The positions of an order with their swap requests and allowed
+    actions, as shown on the order page."""
 
+    def __init__(self, order, positions):
+        from .models import SwapRequest
 
-def can_be_swapped(event, item, subevent, other_subevent):
-    from .models import SwapGroup
+        self.order = order
+        self.positions = positions
+        self.has_requests = False
+        for position in positions:
+            requests = list(position.swap_states.all())
+            self.has_requests = self.has_requests or bool(requests)
+            position.ordered_requests = requests
+            position.no_active_requests = not any(
+                request.state == SwapRequest.States.REQUESTED for request in requests
+            )
+            position.actions_allowed = get_valid_swap_types(position)
+
+
+def get_order_swap_requests(request, order):
+    """Returns the :class:`OrderSwapRequests` of an order.
+
+    The result is cached on the request, so that all signal receivers
+    rendering parts of the order page share two queries (positions
+    and swap requests), plus the cached swap group rules.
+    """
+    from django.db.models import Prefetch
+
+    from .models import SwapRequest
+
+    cache = request.__dict__.setdefault("_swap_order_requests", {})
+    if order.pk not in cache:
+        positions = list(
+            order.positions.all()
+            .select_related("item", "variation")
+            .prefetch_related(
+                Prefetch(
+                    "swap_states",
+                    queryset=SwapRequest.objects.select_related(
+                        "target_subevent"
+                    ).order_by("requested", "pk"),
+                )
+            )
+        )
+        for position in positions:
+            position.order = order
+            for swap_request in position.swap_states.all():
+                if swap_request.target_subevent:
+                    # Subevents need their event to render their dates
+                    swap_request.target_subevent.event = request.event
+        cache[order.pk] = OrderSwapRequests(order, positions)
+    return cache[order.pk]
 
-    groups = event.swap_groups.filter(swap_type=SwapGroup.Types.SWAP).prefetch_related(
-        "subevents", "items"
+
+def can_be_swapped(event, item, subevent, other_subevent):
+    return get_eligibility(event).can_swap(
+        item.pk, getattr(subevent, "pk", None), getattr(other_subevent, "pk", None)
     )
-    return test_swap_groups(groups, item, subevent, other_subevent)
 
 
 def can_be_canceled(event, item, subevent):
     from .models import SwapGroup
 
-    groups = event.swap_groups.filter(
-        swap_type=SwapGroup.Types.CANCELATION
-    ).prefetch_related("subevents", "items")
-    return test_swap_groups(groups, item, subevent)
+    return get_eligibility(event).is_eligible(
+        item.pk, getattr(subevent, "pk", None), SwapGroup.Types.CANCELATION
+    )
 
 
-def get_applicable_subevents(event):
-    result = set()
-    for swap_group in event.swap_groups.all().prefetch_related("subevents"):
-        result |= set(swap_group.subevents.all())
-    return result
+def get_reachable_subevents(event, swap_type, item_ids=None):
+    """Returns a dict of item id to the ids of all subevents that positions
+    of the item can be swapped between (or canceled on), for all items of
+    the event or the given ``item_ids``.
+
+    Answered from the compiled swap group rules, without further queries
+    unless a group applies to all items and ``item_ids`` is not given.
+    """
+    reachable = get_eligibility(event).get_reachable(swap_type)
+    general = reachable.pop(None, set())
+    if item_ids is None:
+        item_ids = event.items.values_list("pk", flat=True) if general else reachable
+    return {
+        item_id: frozenset(reachable.get(item_id, set()) | general)
+        for item_id in item_ids
+    }
 
 
-def get_swappable_subevents(item, groups=None):
+def get_swappable_subevents(event, item_ids=None):
     from .models import SwapGroup
 
-    groups = groups or item.event.swap_groups.filter(
-        swap_type=SwapGroup.Types.SWAP
-    ).prefetch_related("subevents")
-    result = set()
-    for group in groups:
-        if item in group.subevents.all():
-            result |= set(group.subevents.all())
-    return result
+    return get_reachable_subevents(event, SwapGroup.Types.SWAP, item_ids)
 
 
-def get_cancelable_subevents(item, groups=None):
+def get_cancelable_subevents(event, item_ids=None):
     from .models import SwapGroup
 
-    groups = groups or item.event.swap_groups.filter(
-        swap_type=SwapGroup.Types.CANCELATION
-    ).prefetch_related("subevents")
-    result = set()
-    for group in groups:
-        if item in group.subevents.all():
-            result |= set(group.subevents.all())
-    return result
+    return get_reachable_subevents(event, SwapGroup.Types.CANCELATION, item_ids)
 
 
 def match_open_swap_requests(event):
     """Can be used in admin actions and runperiodic.
 
     Attempts to find matches for all open requests. Shouldn't be many,
-    usually these will get caught on request creation.
+    usually these will get caught on request creation. Returns a
+    :class:`pretix_swap.matching.MatchReport`.
     """
-    from .models import SwapRequest
-
-    # This is only an approximation of legal swaps. There is a detailed check run when the swap is about to be performed
-    subevents = get_swappable_subevents()
-    open_requests = (
-        SwapRequest.objects.filter(
-            position__order__event_id=event.pk,
-            state=SwapRequest.States.REQUESTED,
-            swap_method=SwapRequest.Methods.FREE,
-            swap_type=SwapRequest.Types.SWAP,
-            position__subevent__in=subevents,
-            target_subevent__in=subevents,
-            partner__isnull=True,
-        )
-        .select_related("position", "position__item", "position__subevent")
-        .order_by("requested")
-    )
+    from .matching import match_open_swap_requests
 
-    matched_requests = set()
-
-    for request in open_requests:
-        if request.pk in matched_requests:
-            continue
-
-        matches = open_requests.exclude(pk__in=matched_requests,).filter(
-            target_subevent=request.position.subevent,
-            position__subevent=request.target_subevent,
-            position__item=request.position.item,
-        )
-        if request.position.variation:
-            matches = matches.filter(position__variation=request.position.variation)
-
-        for other in matches:
-            try:
-                request.swap_with(other)
-                matched_requests.add(request.pk)
-                matched_requests.add(other.pk)
-                break
-            except Exception:
-                continue
+    return match_open_swap_requests(event)
@@ -0,0 +1,141 @@
+from django.db import models
+from pretix.base.models import Order
+
+from .metrics import candidate_rejections
+from .utils import get_eligibility
+
+
+class Reasons(models.TextChoices):
+    SETTING_DISABLED = "setting_disabled"
+    ITEM_MISMATCH = "item_mismatch"
+    VARIATION_MISMATCH = "variation_mismatch"
+    DATE_MISMATCH = "date_mismatch"
+    SAME_DATE = "same_date"
+    PRICE_MISMATCH = "price_mismatch"
+    NOT_ALLOWED = "not_allowed"
+    NOT_REQUESTED = "not_requested"
+    POSITION_CHANGED = "position_changed"
+    NO_QUOTA = "no_quota"
+    NOT_PAID = "not_paid"
+    OTHER = "other"
+
+
+class Rejection(Exception):
+    """A swap or cancelation that can't be done, with one of
+    :class:`Reasons` as ``reason`` and a message for the logs."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def check_paid(positions):
+    """Returns a :class:`Rejection` if one of the positions is canceled or
+    its order is not paid.
+
+    Swaps move paid positions only: they count against the quotas of
+    their date, so a swap never changes the quota usage in total.
+    """
+    for position in positions:
+        if position.canceled or position.order.status != Order.STATUS_PAID:
+            return Rejection(
+                Reasons.NOT_PAID,
+                "All positions have to be paid and must not be canceled.",
+            )
+    return None
+
+
+def count_rejection(operation, error):
+    """Counts a failed swap or cancelation by its reason. Errors that are
+    not a :class:`Rejection`, like pretix's order errors, count as
+    ``other``."""
+    reason = getattr(error, "reason", Reasons.OTHER)
+    candidate_rejections.inc(1, operation=operation, reason=reason)
+
+
+class CandidateValidator:
+    """Checks swap and cancelation candidates against a snapshot of an
+    event's settings and swap groups.
+
+    The checks only compare the ids and prices of already loaded
+    positions, so rejecting a candidate costs no queries. The checks
+    return a :class:`Rejection` instead of raising it, so that matchers
+    can move on to the next candidate.
+    """
+
+    def __init__(self, event):
+        self.swap_allowed = event.settings.swap_orderpositions
+        self.cancel_allowed = event.settings.cancel_orderpositions
+        self.eligibility = get_eligibility(event)
+
+    def check_swap(self, request, other):
+        """Checks whether the positions of two swap requests may be swapped
+        with each other, each moving to the date the other one asked for."""
+        mine = request.position
+        theirs = other.position
+        if not self.swap_allowed:
+            return Rejection(
+                Reasons.SETTING_DISABLED,
+                "Order position swapping is currently not allowed",
+            )
+        if mine.item_id != theirs.item_id:
+            return Rejection(
+                Reasons.ITEM_MISMATCH,
+                f"Items do not match: {mine.item} vs {theirs.item}.",
+            )
+        if mine.variation_id != theirs.variation_id:
+            return Rejection(
+                Reasons.VARIATION_MISMATCH,
+                f"Item variations do not match: {mine.variation} vs {theirs.variation}.",
+            )
+        if mine.subevent_id == theirs.subevent_id:
+            return Rejection(Reasons.SAME_DATE, "Can't swap within the same subevent.")
+        rejection = check_paid([mine, theirs])
+        if rejection:
+            return rejection
+        if not self.eligibility.can_swap(
+            mine.item_id, mine.subevent_id, theirs.subevent_id
+        ):
+            return Rejection(Reasons.NOT_ALLOWED, "This swap is currently not allowed.")
+        if (
+            request.target_subevent_id != theirs.subevent_id
+            or other.target_subevent_id != mine.subevent_id
+        ):
+            return Rejection(
+                Reasons.DATE_MISMATCH, "The requests are for different dates."
+            )
+        return None
+
+    def check_cancelation(self, request, position):
+        """Checks whether the position of a cancelation request may be
+        canceled in favour of the newly paid ``position``."""
+        from .models import SwapGroup
+
+        mine = request.position
+        if not self.cancel_allowed:
+            return Rejection(
+                Reasons.SETTING_DISABLED,
+                "Order position canceling is currently not allowed",
+            )
+        if mine.subevent_id != position.subevent_id:
+            return Rejection(
+                Reasons.DATE_MISMATCH, "Cancelation failed, orders are not equal"
+            )
+        if (
+            mine.item_id != position.item_id
+            or mine.variation_id != position.variation_id
+        ):
+            return Rejection(
+                Reasons.ITEM_MISMATCH, "Cancelation failed, orders are not equal"
+            )
+        if not self.eligibility.is_eligible(
+            mine.item_id, mine.subevent_id, SwapGroup.Types.CANCELATION
+        ):
+            return Rejection(
+                Reasons.NOT_ALLOWED, "Cancelation failed, currently not allowed"
+            )
+        if mine.price > position.price:
+            return Rejection(
+                Reasons.PRICE_MISMATCH, "Cannot cancel for a cheaper product."
+            )
+        return None
@@ -1,22 +1,29 @@
+import time
+from collections import defaultdict
 from django.contrib import messages
+from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.db.models import Count
-from django.http import Http404
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 from django.utils.functional import cached_property
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 from django.views.generic import (
     CreateView,
     DeleteView,
+    DetailView,
     FormView,
     TemplateView,
     UpdateView,
+    View,
 )
 from formtools.wizard.views import SessionWizardView
 from pretix.base.models.event import Event
+from pretix.base.models.items import Quota
 from pretix.base.models.orders import OrderPosition
-from pretix.base.services.orders import OrderError, approve_order
+from pretix.base.services.quotas import QuotaAvailability
 from pretix.control.permissions import EventPermissionRequiredMixin
 from pretix.control.views.event import EventSettingsFormView, EventSettingsViewMixin
 from pretix.multidomain.urlreverse import eventreverse
@@ -26,14 +33,25 @@ from pretix.presale.views.order import OrderDetailMixin
 from .forms import (
     CancelationForm,
     SwapGroupForm,
+    SwapGroupImportForm,
     SwapSettingsForm,
     SwapWizardConfirmForm,
     SwapWizardDetailsForm,
     SwapWizardPositionForm,
     SwapWizardTypeForm,
 )
-from .models import SwapApproval, SwapGroup, SwapRequest
-from .utils import get_valid_swap_types
+from .groups import export_swap_groups, import_swap_groups
+from .instrumentation import instrument, measure
+from .models import SwapApprovalJob, SwapGroup, SwapRequest
+from .stats import (
+    count_pending_orders_by_subevent,
+    get_counter,
+    get_snapshot,
+    rebuild_snapshot,
+    update_snapshot,
+)
+from .tasks import approve_swap_orders, match_swap_request
+from .utils import get_target_subevents, get_valid_swap_types
 
 try:
     from refund_banktransfer.payment import RefundBanktransfer
@@ -55,6 +73,10 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
     template_name = "pretix_swap/control/stats.html"
     form_class = CancelationForm
 
+    @instrument("swap_stats")
+    def dispatch(self, request, *args, **kwargs):
+        return super().dispatch(request, *args, **kwargs)
+
     def get_context_data(self, *args, **kwargs):
         ctx = super().get_context_data(*args, **kwargs)
         ctx["overview"] = self.requests_by_state
@@ -65,6 +87,9 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
         ctx["by_subevents"] = by_subevents
         ctx["subevents"] = self.subevents
         ctx["items"] = self.items
+        ctx["snapshot_rebuilt"] = min(
+            (line.rebuilt for line in self.snapshot), default=None
+        )
         return ctx
 
     def get_form_kwargs(self):
@@ -81,9 +106,8 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
             },
         )
 
-    @transaction.atomic
     def form_valid(self, form):
-        orders_approved = 0
+        orders = []
         data = form.cleaned_data
         for row in self.requests_by_date:
             approvable = row["approval_orders"]
@@ -105,38 +129,38 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
                 "-has_request",
                 "order__datetime",
             )  # Ones with matching requests first, then oldest
-            orders_approved += self.approve_orders(positions, to_approve)
+            orders += self.get_orders_to_approve(positions, to_approve)
 
-        messages.success(
-            self.request,
-            str(_("Approved {orders_approved} orders.")).format(
-                orders_approved=orders_approved
-            ),
+        if not orders:
+            messages.warning(self.request, _("There are no orders to approve."))
+            return super().form_valid(form)
+        job = SwapApprovalJob.objects.create(
+            event=self.request.event, user=self.request.user, orders=orders
+        )
+        approve_swap_orders.apply_async(
+            kwargs={"event": self.request.event.pk, "job": job.pk}
+        )
+        return redirect(
+            reverse(
+                "plugins:pretix_swap:approval",
+                kwargs={
+                    "organizer": self.request.event.organizer.slug,
+                    "event": self.request.event.slug,
+                    "pk": job.pk,
+                },
+            )
         )
-        return super().form_valid(form)
 
-    def approve_orders(self, positions, count):
+    def get_orders_to_approve(self, positions, count):
         """WARNING DANGER ATTENTION This only works when there is only one
         orderposition per order!!!"""
-        approved = 0
-        for position in positions:
-            if approved >= count:
+        result = []
+        for order_id in positions.values_list("order_id", flat=True):
+            if len(result) >= count:
                 break
-            try:
-                SwapApproval.objects.create(order=position.order)
-                approve_order(
-                    position.order,
-                    user=self.request.user,
-                    send_mail=True,
-                )
-                approved += 1
-            except OrderError as e:
-                position.order.log_action(
-                    "pretix_swap.cancelation.approve_failed",
-                    data={"detail": str(e)},
-                    user=self.request.user,
-                )
-        return approved
+            if order_id not in result:
+                result.append(order_id)
+        return result
 
     @cached_property
     def subevents(self):
@@ -145,7 +169,7 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
     @cached_property
     def requests(self):
         return SwapRequest.objects.filter(
-            position__order__event=self.request.event,
+            event=self.request.event,
             state=SwapRequest.States.REQUESTED,
             partner__isnull=True,
             position__order__status="p",  # Should already be the case, but hey
@@ -161,85 +185,101 @@ class SwapStats(EventPermissionRequiredMixin, FormView):
 
     @cached_property
     def items(self):
-        items = sorted(
-            list(
-                set(self.requests.values_list("position__item", flat=True))
-                | set(self.positions.values_list("item", flat=True))
-            )
+        items = set(self.requests.values_list("item", flat=True)) | set(
+            self.positions.values_list("item", flat=True)
         )
-        items = [self.request.event.items.get(pk=item) for item in items]
-        return items
+        return list(self.request.event.items.filter(pk__in=items).order_by("pk"))
 
     @cached_property
-    def requests_by_date(self):
-        requests = self.requests
-        positions = self.positions
-        dates = self.subevents
-        items = self.items
-        result = []
-        for date in dates:
-            availabilities = []
-            for item in items:
-                availability = item.check_quotas(subevent=date)
-                if not availability[1] and availability[0] == 100:
-                    availability = "∞"
-                else:
-                    availability = availability[1]
-                availabilities.append(availability)
-            line = {
-                "subevent": date,
-                "available_in_quota": availabilities,
-                "open_cancelation_requests": requests.filter(
-                    position__subevent=date,
-                ).count(),
-                "approval_orders": positions.filter(
-                    subevent=date, order__require_approval=True
-                ).count(),
-                "pending_orders": positions.filter(
-                    subevent=date, order__require_approval=False
-                ).count(),
-            }
-            if (
-                line["open_cancelation_requests"]
-                or line["approval_orders"]
-                or line["pending_orders"]
-            ):
-                result.append(line)
+    def availabilities(self):
+        """Maps ``(subevent_id, item_id)`` to the quota availability of the
+        item on that date, computed for all dates and items at once."""
+        quota_items = defaultdict(list)
+        for quota_id, item_id in Quota.items.through.objects.filter(
+            quota__event=self.request.event, item__in=self.items
+        ).values_list("quota_id", "item_id"):
+            quota_items[quota_id].append(item_id)
+        quotas = list(self.request.event.quotas.filter(pk__in=quota_items))
+        availability = QuotaAvailability()
+        availability.queue(*quotas)
+        availability.compute()
+
+        result = {}
+        for quota in quotas:
+            count = availability.results[quota][1]
+            if count is None:
+                continue  # Unlimited quotas don't limit the availability
+            for item_id in quota_items[quota.pk]:
+                key = (quota.subevent_id, item_id)
+                if key not in result or count < result[key]:
+                    result[key] = count
         return result
 
     @cached_property
-    def requests_by_state(self):
-        requests = SwapRequest.objects.filter(position__order__event=self.request.event)
-        subevents = self.request.event.subevents.all()
+    def snapshot(self):
+        return get_snapshot(self.request.event)
+
+    @cached_property
+    def pending_orders(self):
+        """Counts the pending orders by subevent live, pretix changes them
+        without notifying plugins."""
+        return count_pending_orders_by_subevent(self.request.event)
+
+    @cached_property
+    def requests_by_date(self):
+        availabilities = self.availabilities
         result = []
-        for subevent in subevents:
+        for line in self.snapshot:
+            orders = self.pending_orders.get(line.subevent_id, {})
+            approval_orders = orders.get("approval_orders", 0)
+            pending_orders = orders.get("pending_orders", 0)
+            if not (
+                line.open_cancelation_requests or approval_orders or pending_orders
+            ):
+                continue
             result.append(
                 {
-                    "subevent": subevent,
-                    "open_swap_requests": requests.filter(
-                        swap_type=SwapRequest.Types.SWAP,
-                        state=SwapRequest.States.REQUESTED,
-                        position__subevent=subevent,
-                    ).count(),
-                    "completed_swap_requests": requests.filter(
-                        swap_type=SwapRequest.Types.SWAP,
-                        state=SwapRequest.States.COMPLETED,
-                        position__subevent=subevent,
-                    ).count(),
-                    "open_cancelation_requests": requests.filter(
-                        swap_type=SwapRequest.Types.CANCELATION,
-                        state=SwapRequest.States.REQUESTED,
-                        position__subevent=subevent,
-                    ).count(),
-                    "completed_cancelation_requests": requests.filter(
-                        swap_type=SwapRequest.Types.CANCELATION,
-                        state=SwapRequest.States.COMPLETED,
-                        position__subevent=subevent,
-                    ).count(),
+                    "subevent": line.subevent,
+                    "available_in_quota": [
+                        availabilities.get((line.subevent_id, item.pk), "∞")
+                        for item in self.items
+                    ],
+                    "open_cancelation_requests": line.open_cancelation_requests,
+                    "approval_orders": approval_orders,
+                    "pending_orders": pending_orders,
                 }
             )
         return result
 
+    @cached_property
+    def requests_by_state(self):
+        return [line for line in self.snapshot if line.subevent_id]
+
+
+class SwapApprovalJobDetail(EventPermissionRequiredMixin, DetailView):
+    permission = "can_change_event_settings"
+    template_name = "pretix_swap/control/approval.html"
+    context_object_name = "job"
+
+    def get_queryset(self):
+        return SwapApprovalJob.objects.filter(event=self.request.event)
+
+
+class SwapStatsRebuild(EventPermissionRequiredMixin, View):
+    permission = "can_change_event_settings"
+
+    def post(self, request, *args, **kwargs):
+        rebuild_snapshot(request.event)
+        return redirect(
+            reverse(
+                "plugins:pretix_swap:stats",
+                kwargs={
+                    "organizer": request.event.organizer.slug,
+                    "event": request.event.slug,
+                },
+            )
+        )
+
 
 class SwapSettings(EventSettingsViewMixin, EventSettingsFormView):
     model = Event
@@ -340,23 +380,55 @@ class SwapGroupEdit(EventPermissionRequiredMixin, UpdateView):
         )
 
 
+class SwapGroupExport(EventPermissionRequiredMixin, View):
+    permission = "can_change_event_settings"
+
+    def get(self, request, *args, **kwargs):
+        response = JsonResponse(
+            export_swap_groups(request.event), json_dumps_params={"indent": 2}
+        )
+        response["Content-Disposition"] = (
+            f'attachment; filename="{request.event.slug}_swap_groups.json"'
+        )
+        return response
+
+
+class SwapGroupImport(EventPermissionRequiredMixin, FormView):
+    permission = "can_change_event_settings"
+    template_name = "pretix_swap/control/import.html"
+    form_class = SwapGroupImportForm
+
+    def form_valid(self, form):
+        try:
+            groups = import_swap_groups(
+                self.request.event,
+                form.cleaned_data["file"],
+                replace=form.cleaned_data["replace"],
+            )
+        except ValidationError as e:
+            form.add_error("file", e)
+            return self.form_invalid(form)
+        messages.success(
+            self.request,
+            _("{count} swap groups have been imported.").format(count=len(groups)),
+        )
+        return redirect(
+            reverse(
+                "plugins:pretix_swap:settings",
+                kwargs={
+                    "organizer": self.request.event.organizer.slug,
+                    "event": self.request.event.slug,
+                },
+            )
+            + "#tab-0-1-open"
+        )
+
+
 class SwapGroupDelete(EventPermissionRequiredMixin, DeleteView):
     permission = "can_change_event_settings"
     template_name = "pretix_swap/control/delete.html"
     model = SwapGroup
 
-    def delete(self, request, *args, **kwargs):
-        position = self.get_object().position
-        result = super().delete(request, *args, **kwargs)
-        position.order.log_action(
-            "pretix_swap.swap.cancel",
-            data={
-                "position": position.pk,
-                "positionid": position.positionid,
-            },
-        )
-        return result
-
     def get_success_url(self):
         return reverse(
             "plugins:pretix_swap:settings",
@@ -402,8 +474,19 @@ class SwapCancel(EventViewMixin, OrderDetailMixin, TemplateView):
         return ctx
 
     def post(self, request, *args, **kwargs):
-        self.object.delete()
-        messages.success(request, _("We have canceled your request."))
+        # Only delete the request if it hasn't been completed in the meantime
+        deleted, _deleted = SwapRequest.objects.filter(
+            pk=self.object.pk, state=SwapRequest.States.REQUESTED
+        ).delete()
+        if deleted:
+            update_snapshot(
+                self.request.event,
+                self.object.position.subevent_id,
+                **{get_counter(self.object): -1},
+            )
+            messages.success(request, _("We have canceled your request."))
+        else:
+            messages.error(request, _("Your request has already been completed."))
         return redirect(
             eventreverse(
                 self.request.event,
@@ -414,12 +497,11 @@ class SwapCancel(EventViewMixin, OrderDetailMixin, TemplateView):
 
 
 def condition_position(wizard):
-    return len(wizard.order.positions.all()) > 1
+    return len(wizard.positions) > 1
 
 
 def condition_type(wizard):
-    actions = get_valid_swap_types(wizard.position)
-    return len(actions) > 1
+    return len(wizard.valid_swap_types) > 1
 
 
 def condition_details(wizard):
@@ -434,13 +516,7 @@ def condition_details(wizard):
 
 
 def condition_refund(wizard):
-    return (
-        HAS_REFUND_HANDLING
-        and wizard.swap_type == SwapRequest.Types.CANCELATION
-        and wizard.request.event.settings.swap_cancellation_fee
-        and "refund-banktransfer" in wizard.request.event.get_payment_providers()
-        and RefundBanktransfer(wizard.request.event).get_refund_amount(wizard.order)
-    )
+    return wizard.swap_type == SwapRequest.Types.CANCELATION and wizard.can_refund
 
 
 class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
@@ -465,33 +541,115 @@ class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
         "refund": condition_refund,
     }
 
+    # formtools evaluates the step conditions, and with them the properties
+    # below, many times per request. Everything that doesn't depend on the
+    # submitted data is cached on the view, and the cleaned data of each step
+    # is cached until new data is submitted, see get_cleaned_data_for_step().
+
     @cached_property
-    def position(self):
-        positions = self.order.positions.all()
-        if len(positions) == 1:
-            return positions.first()
-        try:
-            return self.get_cleaned_data_for_step("position").get("position")
-        except Exception:  # not filled in or not valid
-            return None
+    def positions(self):
+        positions = list(
+            self.order.positions.all().select_related("item", "variation", "subevent")
+        )
+        for position in positions:
+            position.order = self.order
+        return positions
+
+    @cached_property
+    def swap_types_by_position(self):
+        return {
+            position.pk: get_valid_swap_types(position) for position in self.positions
+        }
 
     @cached_property
+    def swappable_positions(self):
+        return [
+            position
+            for position in self.positions
+            if self.swap_types_by_position[position.pk]
+        ]
+
+    @cached_property
+    def can_refund(self):
+        return bool(
+            HAS_REFUND_HANDLING
+            and self.request.event.settings.swap_cancellation_fee
+            and "refund-banktransfer" in self.request.event.get_payment_providers()
+            and RefundBanktransfer(self.request.event).get_refund_amount(self.order)
+        )
+
+    @property
+    def position(self):
+        if len(self.positions) == 1:
+            return self.positions[0]
+        position = (self.get_cleaned_data_for_step("position") or {}).get("position")
+        return next((p for p in self.positions if p == position), None)
+
+    @property
+    def valid_swap_types(self):
+        position = self.position
+        if not position:
+            return []
+        return self.swap_types_by_position.get(position.pk, [])
+
+    @property
+    def target_subevents(self):
+        key = (getattr(self.position, "pk", None), self.swap_type)
+        if key not in self._target_subevents:
+            self._target_subevents[key] = get_target_subevents(
+                self.position, self.swap_type
+            )
+        return self._target_subevents[key]
+
+    @property
     def swap_type(self):
-        actions = get_valid_swap_types(self.position)
+        actions = self.valid_swap_types
         if len(actions) == 1:
             return actions[0]
-        if not self.steps.current or (self.steps.current in ("position", "type")):
-            return None
-        try:
-            return self.get_cleaned_data_for_step("type").get("swap_type")
-        except Exception:  # not filled in or not valid
-            return None
+        return (self.get_cleaned_data_for_step("type") or {}).get("swap_type")
 
     def dispatch(self, request, *args, **kwargs):
         if not self.order.status == "p":
             raise Http404()
+        self._cleaned_data = {}
+        self._target_subevents = {}
         return super().dispatch(request, *args, **kwargs)
 
+    def get(self, request, *args, **kwargs):
+        with measure("swap_wizard.start", request.event):
+            return super().get(request, *args, **kwargs)
+
+    def post(self, *args, **kwargs):
+        with measure(f"swap_wizard.{self.steps.current}", self.request.event):
+            return super().post(*args, **kwargs)
+
+    def get_cleaned_data_for_step(self, step):
+        """Validates the stored data of a step, like formtools does, but
+        without evaluating the step conditions first – they depend on the
+        cleaned data themselves."""
+        if step == "refund":
+            return super().get_cleaned_data_for_step(step)
+        if step not in self._cleaned_data:
+            cleaned_data = None
+            data = self.storage.get_step_data(step)
+            if step in self.form_list and data is not None:
+                form_class = self.form_list[step]
+                form = form_class(
+                    data=data,
+                    files=self.storage.get_step_files(step),
+                    prefix=self.get_form_prefix(step, form_class),
+                    initial=self.get_form_initial(step),
+                    **self.get_form_kwargs(step),
+                )
+                if form.is_valid():
+                    cleaned_data = form.cleaned_data
+            self._cleaned_data[step] = cleaned_data
+        return self._cleaned_data[step]
+
+    def process_step(self, form):
+        self._cleaned_data = {}
+        return super().process_step(form)
+
     def get_template_names(self):
         return f"pretix_swap/presale/new_{self.steps.current}.html"
 
@@ -528,11 +686,15 @@ class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
 
     def get_form_kwargs(self, step=None):
         if step == "position":
-            return {"order": self.order}
+            return {"order": self.order, "positions": self.swappable_positions}
         if step == "type":
-            return {"swap_types": get_valid_swap_types(self.position)}
+            return {"swap_types": self.valid_swap_types}
         if step == "details":
-            return {"position": self.position, "swap_type": self.swap_type}
+            return {
+                "position": self.position,
+                "swap_type": self.swap_type,
+                "target_subevents": self.target_subevents,
+            }
         return {}
 
     def get_form(self, step=None, data=None, files=None):
@@ -559,10 +721,14 @@ class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
         swap_method = details.get("swap_method", SwapRequest.Methods.FREE)
 
         # TODO more validation
-        valid_swap_types = get_valid_swap_types(position)
-        if swap_type not in valid_swap_types:
+        if swap_type not in self.valid_swap_types:
             return self.form_invalid(_("Invalid request!"))
 
+        match_later = (
+            swap_type == SwapRequest.Types.SWAP
+            and swap_method == SwapRequest.Methods.FREE
+            and self.request.event.settings.swap_async_matching
+        )
         instance = SwapRequest.objects.create(
             position=position,
             state=SwapRequest.States.REQUESTED,
@@ -570,6 +736,10 @@ class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
             swap_method=swap_method,
             target_order=details.get("cancel_code"),
             target_subevent=details.get("target_subevent"),
+            matching_queued=now() if match_later else None,
+        )
+        update_snapshot(
+            self.request.event, position.subevent_id, **{get_counter(instance): 1}
         )
         instance.position.order.log_action(
             "pretix_swap.swap.request",
@@ -583,6 +753,17 @@ class SwapCreate(EventViewMixin, OrderDetailMixin, SessionWizardView):
         if instance.swap_type == SwapRequest.Types.SWAP:  # Only swaps are instantaneous
             if details.get("swap_code"):
                 instance.swap_with(details.get("swap_code"))
+            elif match_later:
+                queued = time.time()
+                transaction.on_commit(
+                    lambda: match_swap_request.apply_async(
+                        kwargs={
+                            "event": self.request.event.pk,
+                            "request": instance.pk,
+                            "queued": queued,
+                        }
+                    )
+                )
             elif instance.swap_method == SwapRequest.Methods.FREE:
                 instance.attempt_swap()
         else:
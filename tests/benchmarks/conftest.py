@@ -0,0 +1,212 @@
+import datetime
+import os
+import pytest
+import random
+from decimal import Decimal
+from django.utils.crypto import get_random_string
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Item, Order, OrderPosition, Quota, SubEvent
+
+from pretix_swap.models import SwapGroup, SwapRequest
+
+BATCH_SIZE = 1000
+
+
+def get_benchmark_sizes():
+    """Numbers of open requests per synthetic festival, configured as a
+    comma separated list in ``SWAP_BENCHMARK_SIZES``."""
+    sizes = os.environ.get("SWAP_BENCHMARK_SIZES", "")
+    return [int(size) for size in sizes.split(",") if size]
+
+
+def get_festival_shape():
+    """Numbers of dates and items and the number of dates per swap group,
+    configured in ``SWAP_BENCHMARK_SUBEVENTS``, ``SWAP_BENCHMARK_ITEMS`` and
+    ``SWAP_BENCHMARK_GROUP_SIZE``."""
+    return {
+        "subevents": int(os.environ.get("SWAP_BENCHMARK_SUBEVENTS", 20)),
+        "items": int(os.environ.get("SWAP_BENCHMARK_ITEMS", 3)),
+        "group_size": int(os.environ.get("SWAP_BENCHMARK_GROUP_SIZE", 5)),
+    }
+
+
+class Festival:
+    """A synthetic event with many dates, items and open swap and
+    cancelation requests."""
+
+    def __init__(self, event, subevents, items, groups, requests):
+        self.event = event
+        self.subevents = subevents
+        self.items = items
+        self.groups = groups
+        self.requests = requests
+        self.counter = 0
+
+    @property
+    def info(self):
+        return {
+            "subevents": len(self.subevents),
+            "items": len(self.items),
+            "groups": len(self.groups),
+            "requests": self.requests,
+        }
+
+    def make_position(self, subevent, item=None, status=Order.STATUS_PAID):
+        self.counter += 1
+        item = item or self.items[0]
+        order = Order.objects.create(
+            event=self.event,
+            code=f"BENCH{self.counter}",
+            email="dummy@example.org",
+            status=status,
+            datetime=now(),
+            expires=now() + datetime.timedelta(days=10),
+            total=item.default_price,
+            locale="en",
+        )
+        return OrderPosition.objects.create(
+            order=order,
+            item=item,
+            subevent=subevent,
+            price=item.default_price,
+            positionid=1,
+        )
+
+
+def build_festival(
+    event,
+    requests,
+    subevents=20,
+    items=3,
+    group_size=5,
+    cancelation_share=0.2,
+    seed=0,
+):
+    """Creates ``requests`` open requests with one paid single-position
+    order each, spread randomly over the dates and items of the event.
+
+    Dates are grouped into swap groups of ``group_size`` dates that apply
+    to all items, and one cancelation group contains all dates. Requests
+    are created in bulk, so the denormalized fields are set here instead
+    of in ``SwapRequest.save``.
+    """
+    rng = random.Random(seed)
+    start = now() + datetime.timedelta(days=1)
+    SubEvent.objects.bulk_create(
+        [
+            SubEvent(
+                event=event,
+                name=f"Day {i}",
+                date_from=start + datetime.timedelta(days=i),
+                active=True,
+            )
+            for i in range(subevents)
+        ]
+    )
+    subevents = list(event.subevents.order_by("date_from"))
+    items = [
+        Item.objects.create(
+            event=event, name=f"Ticket {i}", default_price=Decimal("23.00")
+        )
+        for i in range(items)
+    ]
+    for subevent in subevents:
+        quota = Quota.objects.create(
+            event=event, subevent=subevent, size=requests, name=str(subevent)
+        )
+        quota.items.add(*items)
+
+    groups = []
+    for i in range(0, len(subevents), group_size):
+        group = SwapGroup.objects.create(
+            event=event, name=f"Swap {i}", swap_type=SwapGroup.Types.SWAP
+        )
+        group.subevents.add(*subevents[i:][:group_size])
+        groups.append(group)
+    group = SwapGroup.objects.create(
+        event=event, name="Cancelation", swap_type=SwapGroup.Types.CANCELATION
+    )
+    group.subevents.add(*subevents)
+    groups.append(group)
+
+    created = now()
+    plan = []
+    for i in range(requests):
+        source = rng.randrange(len(subevents))
+        item = rng.choice(items)
+        if rng.random() < cancelation_share:
+            target = None
+        else:
+            first = source - source % group_size
+            choices = [
+                j
+                for j in range(first, min(first + group_size, len(subevents)))
+                if j != source
+            ]
+            target = subevents[rng.choice(choices)] if choices else None
+        plan.append((f"REQ{i}", subevents[source], item, target))
+
+    Order.objects.bulk_create(
+        [
+            Order(
+                event=event,
+                code=code,
+                email="dummy@example.org",
+                status=Order.STATUS_PAID,
+                datetime=created,
+                expires=created + datetime.timedelta(days=10),
+                total=item.default_price,
+                locale="en",
+            )
+            for code, subevent, item, target in plan
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    orders = dict(event.orders.values_list("code", "pk"))
+    OrderPosition.objects.bulk_create(
+        [
+            OrderPosition(
+                order_id=orders[code],
+                item=item,
+                subevent=subevent,
+                price=item.default_price,
+                positionid=1,
+                tax_rate=Decimal("0.00"),
+                tax_value=Decimal("0.00"),
+                secret=get_random_string(32),
+                pseudonymization_id=get_random_string(16),
+            )
+            for code, subevent, item, target in plan
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    positions = dict(
+        OrderPosition.objects.filter(order__event=event).values_list(
+            "order__code", "pk"
+        )
+    )
+    SwapRequest.objects.bulk_create(
+        [
+            SwapRequest(
+                position_id=positions[code],
+                event=event,
+                item=item,
+                subevent=subevent,
+                swap_type=(
+                    SwapRequest.Types.SWAP if target else SwapRequest.Types.CANCELATION
+                ),
+                target_subevent=target,
+                swap_code=get_random_string(20),
+            )
+            for code, subevent, item, target in plan
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    return Festival(event, subevents, items, groups, requests)
+
+
+@pytest.fixture(params=get_benchmark_sizes(), ids=lambda size: f"{size}-requests")
+def festival(request, event):
+    with scopes_disabled():
+        return build_festival(event, request.param, **get_festival_shape())
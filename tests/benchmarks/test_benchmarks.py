@@ -0,0 +1,140 @@
+"""Benchmarks of the swap entry points on synthetic festivals.
+
+The benchmarks only run with pytest-benchmark installed and
+``SWAP_BENCHMARK_SIZES`` set to the numbers of open requests to generate,
+for example::
+
+    SWAP_BENCHMARK_SIZES=1000,10000,100000 python -m pytest tests/benchmarks \
+        --benchmark-json=benchmark.json
+
+Every benchmark records the number of queries of its slowest round in
+``extra_info``, next to the timings, so that releases can be compared with
+``pytest-benchmark compare``.
+"""
+
+import os
+import pytest
+import random
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import Order
+
+from pretix_swap.models import SwapApproval, SwapRequest
+from pretix_swap.signals import order_info_bottom, swap_order_paid
+from pretix_swap.utils import match_open_swap_requests
+
+pytest.importorskip("pytest_benchmark")
+if not os.environ.get("SWAP_BENCHMARK_SIZES"):
+    pytest.skip("SWAP_BENCHMARK_SIZES is not set", allow_module_level=True)
+
+
+def run_benchmark(benchmark, festival, func, setup=None, rounds=1):
+    queries = []
+
+    def target(*args, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+        queries.append(len(context.captured_queries))
+        return result
+
+    with scopes_disabled():
+        result = benchmark.pedantic(target, setup=setup, rounds=rounds, iterations=1)
+    benchmark.extra_info.update(festival.info)
+    benchmark.extra_info["queries"] = max(queries)
+    return result
+
+
+def open_requests(festival, swap_type):
+    with scopes_disabled():
+        return list(
+            SwapRequest.objects.filter(
+                event=festival.event,
+                swap_type=swap_type,
+                state=SwapRequest.States.REQUESTED,
+            ).select_related("position__subevent", "target_subevent")
+        )
+
+
+@pytest.mark.django_db
+def test_match_open_swap_requests(benchmark, festival):
+    report = run_benchmark(
+        benchmark,
+        festival,
+        match_open_swap_requests,
+        setup=lambda: ((festival.event,), {}),
+    )
+    benchmark.extra_info["matches"] = len(report.matched) + len(report.cycles)
+
+
+@pytest.mark.django_db
+def test_attempt_swap(benchmark, festival):
+    candidates = open_requests(festival, SwapRequest.Types.SWAP)
+    random.Random(0).shuffle(candidates)
+
+    def setup():
+        other = candidates.pop()
+        request = SwapRequest.objects.create(
+            position=festival.make_position(
+                other.target_subevent, item=other.position.item
+            ),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=other.position.subevent,
+        )
+        return (request,), {}
+
+    run_benchmark(
+        benchmark,
+        festival,
+        SwapRequest.attempt_swap,
+        setup=setup,
+        rounds=10,
+    )
+
+
+@pytest.mark.django_db
+def test_swap_order_paid(benchmark, festival, django_capture_on_commit_callbacks):
+    subevents = [
+        request.position.subevent
+        for request in open_requests(festival, SwapRequest.Types.CANCELATION)
+    ]
+
+    def setup():
+        order = festival.make_position(
+            subevents.pop(), status=Order.STATUS_PENDING
+        ).order
+        SwapApproval.objects.create(order=order)
+        return (order,), {}
+
+    def paid(order):
+        with django_capture_on_commit_callbacks(execute=True):
+            swap_order_paid(order, festival.event)
+
+    run_benchmark(benchmark, festival, paid, setup=setup, rounds=10)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("rebuild", [False, True], ids=["snapshot", "rebuild"])
+def test_swap_stats(benchmark, festival, admin_client, rebuild):
+    url = f"/control/event/{festival.event.organizer.slug}/{festival.event.slug}/swap"
+    if rebuild:
+        url += "?rebuild=1"
+    admin_client.get(url)  # Warm up the session, settings and snapshot
+
+    response = run_benchmark(
+        benchmark, festival, admin_client.get, setup=lambda: ((url,), {}), rounds=5
+    )
+    assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_order_info_bottom(benchmark, festival, rf):
+    request = rf.get("/")
+    request.event = festival.event
+    order = open_requests(festival, SwapRequest.Types.SWAP)[0].position.order
+
+    def setup():
+        request.__dict__.pop("_swap_order_requests", None)
+        return (festival.event,), {"request": request, "order": order}
+
+    run_benchmark(benchmark, festival, order_info_bottom, setup=setup, rounds=20)
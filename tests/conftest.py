@@ -1 +1,132 @@
-# put your pytest fixtures here
+import datetime
+import pytest
+from decimal import Decimal
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Item, Order, OrderPosition, Organizer, Quota
+
+
+@pytest.fixture(autouse=True)
+def cache(settings):
+    from django.core.cache import cache
+
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    cache.clear()
+    from pretix_swap.utils import _eligibility_cache
+
+    _eligibility_cache.clear()
+    return cache
+
+
+@pytest.fixture
+def organizer():
+    return Organizer.objects.create(name="Festival", slug="festival")
+
+
+@pytest.fixture
+def event(organizer):
+    event = Event.objects.create(
+        organizer=organizer,
+        name="Festival",
+        slug="festival",
+        date_from=now(),
+        has_subevents=True,
+        plugins="pretix_swap",
+    )
+    event.settings.swap_orderpositions = True
+    event.settings.cancel_orderpositions = True
+    return event
+
+
+@pytest.fixture
+def subevents(event):
+    with scopes_disabled():
+        return [
+            event.subevents.create(
+                name=f"Day {i}",
+                date_from=now() + datetime.timedelta(days=i),
+                active=True,
+            )
+            for i in range(1, 5)
+        ]
+
+
+@pytest.fixture
+def item(event, subevents):
+    with scopes_disabled():
+        item = Item.objects.create(
+            event=event, name="Ticket", default_price=Decimal("23.00")
+        )
+        for subevent in subevents:
+            quota = Quota.objects.create(
+                event=event, subevent=subevent, size=100, name="Q"
+            )
+            quota.items.add(item)
+        return item
+
+
+@pytest.fixture
+def swap_group(event, item, subevents):
+    from pretix_swap.models import SwapGroup
+
+    with scopes_disabled():
+        group = SwapGroup.objects.create(event=event, name="Swap", swap_type="s")
+        group.items.add(item)
+        group.subevents.add(*subevents)
+        return group
+
+
+@pytest.fixture
+def cancelation_group(event, item, subevents):
+    from pretix_swap.models import SwapGroup
+
+    with scopes_disabled():
+        group = SwapGroup.objects.create(event=event, name="Cancelation", swap_type="c")
+        group.items.add(item)
+        group.subevents.add(*subevents)
+        return group
+
+
+@pytest.fixture
+def make_position(event, item):
+    counter = {"value": 0}
+
+    def make(subevent, status=Order.STATUS_PAID, price=Decimal("23.00")):
+        counter["value"] += 1
+        with scopes_disabled():
+            order = Order.objects.create(
+                event=event,
+                code=f"CODE{counter['value']}",
+                email="dummy@example.org",
+                status=status,
+                datetime=now(),
+                expires=now() + datetime.timedelta(days=10),
+                total=price,
+                locale="en",
+            )
+            return OrderPosition.objects.create(
+                order=order, item=item, subevent=subevent, price=price, positionid=1
+            )
+
+    return make
+
+
+@pytest.fixture
+def admin_client(client, organizer, event):
+    from pretix.base.models import User
+
+    user = User.objects.create_user("admin@example.org", "admin")
+    with scopes_disabled():
+        team = organizer.teams.create(
+            name="Admins",
+            all_events=True,
+            can_change_event_settings=True,
+            can_change_items=True,
+            can_view_orders=True,
+            can_change_orders=True,
+        )
+        team.members.add(user)
+    client.login(email="admin@example.org", password="admin")
+    return client
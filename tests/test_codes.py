@@ -0,0 +1,44 @@
+import pytest
+from django_scopes import scopes_disabled
+
+from pretix_swap.codes import resolve_cancel_code, resolve_swap_code
+from pretix_swap.models import SwapRequest
+
+
+@pytest.mark.django_db
+def test_resolve_codes_ignores_case(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        order = make_position(subevents[1]).order
+
+        code = f" {request.swap_code.upper()} "
+        assert resolve_swap_code(event, code) == request
+        assert resolve_cancel_code(event, order.code.lower()) == order
+
+
+@pytest.mark.django_db
+def test_resolve_codes_caches_unknown_codes(event, django_assert_num_queries):
+    with scopes_disabled():
+        with django_assert_num_queries(1):
+            assert resolve_swap_code(event, "unknown") is None
+            assert resolve_swap_code(event, "UNKNOWN") is None
+        with django_assert_num_queries(0):
+            assert resolve_swap_code(event, "not a code!") is None
+            assert resolve_cancel_code(event, "ABC-123") is None
+
+
+@pytest.mark.django_db
+def test_new_requests_clear_unknown_codes(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        assert resolve_swap_code(event, "newcode") is None
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+            swap_code="newcode",
+        )
+
+        assert resolve_swap_code(event, "newcode") == request
@@ -0,0 +1,42 @@
+import json
+import pytest
+from django_scopes import scopes_disabled
+
+from pretix_swap.exporters import SwapRequestExporter
+from pretix_swap.models import SwapRequest
+
+
+def request_swap(position, target_subevent):
+    return SwapRequest.objects.create(
+        position=position,
+        swap_type=SwapRequest.Types.SWAP,
+        target_subevent=target_subevent,
+    )
+
+
+@pytest.mark.django_db
+def test_export_swap_requests(
+    event, subevents, swap_group, make_position, django_assert_max_num_queries
+):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        second = request_swap(make_position(subevents[1]), subevents[0])
+        first.swap_with(second)
+        open_request = request_swap(make_position(subevents[2]), subevents[3])
+        exporter = SwapRequestExporter(event, event.organizer)
+
+        with django_assert_max_num_queries(2):
+            filename, content_type, data = exporter.render({"_format": "jsonl"})
+        rows = [json.loads(line) for line in data.decode().splitlines()]
+
+        assert filename == "festival_swap_requests.jsonl"
+        assert [row["id"] for row in rows] == [first.pk, second.pk, open_request.pk]
+        assert rows[0]["partner_order"] == second.position.order.code
+        assert rows[0]["state"] == "Completed"
+        assert rows[2]["partner_order"] is None
+        assert rows[2]["target_date"] == str(subevents[3])
+
+        filename, content_type, data = exporter.render({"_format": "default"})
+        lines = data.decode().splitlines()
+        assert lines[0].startswith('"ID","Order code"')
+        assert len(lines) == 4
@@ -0,0 +1,111 @@
+import pytest
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Item
+
+from pretix_swap.groups import copy_swap_groups, export_swap_groups, import_swap_groups
+from pretix_swap.models import SwapGroup
+
+
+@pytest.fixture
+def other_event(organizer, event, subevents):
+    with scopes_disabled():
+        other = Event.objects.create(
+            organizer=organizer,
+            name="Next festival",
+            slug="next",
+            date_from=event.date_from,
+            has_subevents=True,
+            plugins="pretix_swap",
+        )
+        for subevent in subevents:
+            other.subevents.create(
+                name=subevent.name, date_from=subevent.date_from, active=True
+            )
+        Item.objects.create(event=other, name="Ticket", default_price=23)
+        return other
+
+
+def get_group_members(event):
+    return [
+        (
+            str(group.name),
+            group.swap_type,
+            sorted(str(item.name) for item in group.items.all()),
+            sorted(subevent.date_from for subevent in group.subevents.all()),
+        )
+        for group in event.swap_groups.order_by("pk")
+    ]
+
+
+@pytest.mark.django_db
+def test_import_exported_swap_groups(
+    event, subevents, swap_group, cancelation_group, other_event
+):
+    with scopes_disabled():
+        swap_group.subevents.remove(subevents[3])
+        data = export_swap_groups(event)
+        import_swap_groups(other_event, data)
+        assert get_group_members(other_event) == get_group_members(event)
+
+        data["swap_groups"] *= 5
+        with CaptureQueriesContext(connection) as context:
+            import_swap_groups(other_event, data, replace=True)
+        assert other_event.swap_groups.count() == 10
+        inserts = [
+            query["sql"]
+            for query in context.captured_queries
+            if query["sql"].startswith('INSERT INTO "pretix_swap_swapgroup_')
+        ]
+        assert len(inserts) == 2  # One for the items, one for the dates
+
+
+@pytest.mark.django_db
+def test_import_rejects_unknown_dates(event, subevents, swap_group, other_event):
+    with scopes_disabled():
+        data = export_swap_groups(event)
+        other_event.subevents.filter(date_from=subevents[0].date_from).delete()
+
+        with pytest.raises(ValidationError) as excinfo:
+            import_swap_groups(other_event, data)
+        assert subevents[0].date_from.isoformat() in str(excinfo.value)
+        assert not other_event.swap_groups.exists()
+
+
+@pytest.mark.django_db
+def test_import_rejects_ambiguous_items(event, subevents, swap_group, other_event):
+    with scopes_disabled():
+        data = export_swap_groups(event)
+        Item.objects.create(event=other_event, name="Ticket", default_price=42)
+
+        with pytest.raises(ValidationError) as excinfo:
+            import_swap_groups(other_event, data)
+        assert "not unique" in str(excinfo.value)
+        assert not other_event.swap_groups.exists()
+
+
+@pytest.mark.django_db
+def test_copy_skips_groups_without_copied_items(event, item, swap_group, other_event):
+    with scopes_disabled():
+        assert copy_swap_groups(event, other_event, {}) == []
+        assert not other_event.swap_groups.exists()
+
+
+@pytest.mark.django_db
+def test_clone_event_copies_swap_groups(organizer, event, item, swap_group):
+    with scopes_disabled():
+        clone = Event.objects.create(
+            organizer=organizer,
+            name="Clone",
+            slug="clone",
+            date_from=event.date_from,
+            has_subevents=True,
+        )
+        clone.copy_data_from(event)
+
+        (group,) = clone.swap_groups.all()
+        assert group.swap_type == SwapGroup.Types.SWAP
+        assert [i.event for i in group.items.all()] == [clone]
+        assert not group.subevents.exists()  # pretix does not clone dates
@@ -0,0 +1,58 @@
+import logging
+import pytest
+from django_scopes import scopes_disabled
+
+from pretix_swap import instrumentation
+from pretix_swap.models import SwapRequest
+from pretix_swap.utils import match_open_swap_requests
+
+
+@pytest.mark.django_db
+def test_instrumentation_is_off_by_default(event, monkeypatch):
+    # Queries are not even counted while the instrumentation is disabled
+    monkeypatch.setattr(instrumentation, "QueryCounter", pytest.fail)
+    with scopes_disabled():
+        match_open_swap_requests(event)
+
+
+@pytest.mark.django_db
+def test_instrumentation_records_queries(event, settings, monkeypatch, caplog):
+    observed = {}
+    monkeypatch.setattr(
+        instrumentation.call_queries,
+        "observe",
+        lambda amount, entry_point: observed.setdefault(entry_point, amount),
+    )
+    settings.METRICS_ENABLED = True
+    event.settings.swap_instrumentation = True
+
+    with scopes_disabled(), caplog.at_level(logging.INFO):
+        match_open_swap_requests(event)
+
+    assert observed["match_open_swap_requests"] > 0
+    (line,) = [
+        record.getMessage()
+        for record in caplog.records
+        if record.name == "pretix_swap.instrumentation"
+    ]
+    assert line.startswith(
+        f"match_open_swap_requests for event {event.slug}: "
+        f"{observed['match_open_swap_requests']} queries"
+    )
+
+
+@pytest.mark.django_db
+def test_find_event_does_not_load_relations(
+    event, subevents, make_position, django_assert_num_queries
+):
+    with scopes_disabled():
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+        request = SwapRequest.objects.get(pk=request.pk)
+
+        with django_assert_num_queries(0):
+            assert instrumentation.find_event((request,), {}) is None
+        request.event
+        assert instrumentation.find_event((request,), {}) == event
@@ -0,0 +1,285 @@
+import pytest
+from decimal import Decimal
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPosition
+
+from pretix_swap.models import SwapRequest
+from pretix_swap.utils import match_open_swap_requests
+from pretix_swap.validation import Reasons, Rejection
+
+
+def request_swap(position, target_subevent):
+    return SwapRequest.objects.create(
+        position=position,
+        swap_type=SwapRequest.Types.SWAP,
+        target_subevent=target_subevent,
+    )
+
+
+@pytest.mark.django_db
+def test_match_pairs_first_come_first_served(
+    event, subevents, swap_group, make_position
+):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        second = request_swap(make_position(subevents[0]), subevents[1])
+        other = request_swap(make_position(subevents[1]), subevents[0])
+
+        report = match_open_swap_requests(event)
+
+        assert [(r.pk, o.pk) for r, o in report.matched] == [(first.pk, other.pk)]
+        assert not report.rejected
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert first.state == SwapRequest.States.COMPLETED
+        assert first.completed
+        assert first.partner == other
+        assert first.position.subevent == subevents[1]
+        assert first.subevent == subevents[1]
+        assert first.event == event
+        assert second.state == SwapRequest.States.REQUESTED
+
+
+@pytest.mark.django_db
+def test_match_skips_different_prices(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        request_swap(make_position(subevents[0]), subevents[1])
+        request_swap(make_position(subevents[1], price=Decimal("42.00")), subevents[0])
+
+        report = match_open_swap_requests(event)
+
+        assert not report.matched
+
+
+@pytest.mark.django_db
+def test_match_reports_disallowed_swaps(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        swap_group.subevents.remove(subevents[1])
+        request_swap(make_position(subevents[0]), subevents[1])
+        request_swap(make_position(subevents[1]), subevents[0])
+
+        report = match_open_swap_requests(event)
+
+        assert not report.matched
+        assert len(report.rejected) == 1
+        assert report.rejected[0][2] == "This swap is currently not allowed."
+
+
+@pytest.mark.django_db
+def test_match_three_way_cycle(event, subevents, swap_group, make_position):
+    event.settings.swap_max_cycle_length = 3
+    with scopes_disabled():
+        requests = [
+            request_swap(make_position(subevents[0]), subevents[1]),
+            request_swap(make_position(subevents[1]), subevents[2]),
+            request_swap(make_position(subevents[2]), subevents[0]),
+        ]
+
+        report = match_open_swap_requests(event)
+
+        assert [[r.pk for r in cycle] for cycle in report.cycles] == [
+            [r.pk for r in requests]
+        ]
+        for request, target in zip(requests, subevents[1:3] + subevents[:1]):
+            request.refresh_from_db()
+            assert request.state == SwapRequest.States.COMPLETED
+            assert request.completed
+            assert request.position.subevent == target
+
+
+@pytest.mark.django_db
+def test_match_cycle_length_is_limited(event, subevents, swap_group, make_position):
+    event.settings.swap_max_cycle_length = 3
+    with scopes_disabled():
+        for source, target in zip(subevents, subevents[1:] + subevents[:1]):
+            request_swap(make_position(source), target)
+
+        report = match_open_swap_requests(event)
+
+        assert not report.cycles
+
+
+@pytest.mark.django_db
+def test_swap_cycle_requires_paid_orders(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        requests = [
+            request_swap(make_position(subevents[0]), subevents[1]),
+            request_swap(make_position(subevents[1]), subevents[2]),
+            request_swap(make_position(subevents[2]), subevents[0]),
+        ]
+        Order.objects.filter(pk=requests[1].position.order_id).update(
+            status=Order.STATUS_PENDING
+        )
+
+        with pytest.raises(Rejection) as excinfo:
+            SwapRequest.swap_cycle(requests)
+
+        assert excinfo.value.reason == Reasons.NOT_PAID
+        for request, subevent in zip(requests, subevents):
+            request.refresh_from_db()
+            assert request.state == SwapRequest.States.REQUESTED
+            assert request.position.subevent == subevent
+
+
+@pytest.mark.django_db
+def test_swap_cycle_requires_two_requests(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        request = request_swap(make_position(subevents[0]), subevents[1])
+
+        with pytest.raises(ValueError):
+            SwapRequest.swap_cycle([request])
+
+
+@pytest.mark.django_db
+def test_attempt_swap_skips_canceled_orders(
+    event, subevents, swap_group, make_position
+):
+    with scopes_disabled():
+        canceled = request_swap(
+            make_position(subevents[1], status=Order.STATUS_CANCELED), subevents[0]
+        )
+        request = request_swap(make_position(subevents[0]), subevents[1])
+
+        request.attempt_swap()  # Must not raise
+        assert request.state == SwapRequest.States.REQUESTED
+
+        other = request_swap(make_position(subevents[1]), subevents[0])
+        request.attempt_swap()
+
+        assert request.state == SwapRequest.States.COMPLETED
+        assert request.partner == other
+        canceled.refresh_from_db()
+        assert canceled.state == SwapRequest.States.REQUESTED
+
+
+@pytest.mark.django_db
+def test_attempt_swap_finds_cycle(event, subevents, swap_group, make_position):
+    event.settings.swap_max_cycle_length = 4
+    with scopes_disabled():
+        request_swap(make_position(subevents[0]), subevents[1])
+        request_swap(make_position(subevents[1]), subevents[2])
+        request = request_swap(make_position(subevents[2]), subevents[0])
+
+        request.attempt_swap()
+
+        assert request.state == SwapRequest.States.COMPLETED
+        assert (
+            SwapRequest.objects.filter(state=SwapRequest.States.COMPLETED).count() == 3
+        )
+
+
+@pytest.mark.django_db
+def test_swap_with_rechecks_partner_date(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        other = request_swap(make_position(subevents[1]), subevents[0])
+        OrderPosition.objects.filter(pk=other.position_id).update(subevent=subevents[2])
+
+        with pytest.raises(Rejection) as excinfo:
+            first.swap_with(other)
+
+        assert excinfo.value.reason == Reasons.POSITION_CHANGED
+        first.refresh_from_db()
+        assert first.state == SwapRequest.States.REQUESTED
+        assert first.position.subevent == subevents[0]
+
+
+@pytest.mark.django_db
+def test_swap_with_uses_locked_state(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        other = request_swap(make_position(subevents[1]), subevents[0])
+        stale = SwapRequest.objects.select_related("position").get(pk=first.pk)
+        late = request_swap(make_position(subevents[1]), subevents[0])
+
+        first.swap_with(other)
+
+        with pytest.raises(Exception, match="'requesting' state"):
+            stale.swap_with(late)
+        late.refresh_from_db()
+        assert late.state == SwapRequest.States.REQUESTED
+        assert late.position.subevent == subevents[1]
+
+
+@pytest.mark.django_db
+def test_swap_with_retries_lock_errors(
+    monkeypatch, event, subevents, swap_group, make_position
+):
+    from django.db import OperationalError
+
+    from pretix_swap import models
+
+    attempts = []
+    lock = models.lock_swap_requests
+
+    def flaky_lock(requests, operation):
+        attempts.append(operation)
+        if len(attempts) == 1:
+            raise OperationalError("deadlock detected")
+        return lock(requests, operation)
+
+    monkeypatch.setattr(models, "lock_swap_requests", flaky_lock)
+    monkeypatch.setattr(models, "SWAP_LOCK_BACKOFF", 0)
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        other = request_swap(make_position(subevents[1]), subevents[0])
+
+        first.swap_with(other)
+
+        assert attempts == ["swap", "swap"]
+        assert first.state == SwapRequest.States.COMPLETED
+
+
+@pytest.mark.django_db
+def test_match_completes_pairs_in_bulk(
+    event, subevents, swap_group, make_position, django_capture_on_commit_callbacks
+):
+    with scopes_disabled():
+        pairs = [
+            (
+                request_swap(make_position(subevents[0]), subevents[1]),
+                request_swap(make_position(subevents[1]), subevents[0]),
+            )
+            for _ in range(3)
+        ]
+
+        with django_capture_on_commit_callbacks(execute=True):
+            report = match_open_swap_requests(event)
+
+        assert [(r.pk, o.pk) for r, o in report.matched] == [
+            (r.pk, o.pk) for r, o in pairs
+        ]
+        for request, other in pairs:
+            request.refresh_from_db()
+            assert request.state == SwapRequest.States.COMPLETED
+            assert request.completed
+            assert request.partner == other
+            assert request.subevent == subevents[1]
+            order = request.position.order
+            assert order.positions.get().subevent == subevents[1]
+            assert order.all_logentries().filter(
+                action_type="pretix.event.order.changed.subevent"
+            )
+            # Written by the finish_bulk_swap task after the commit
+            assert order.transactions.filter(subevent=subevents[1]).exists()
+
+
+@pytest.mark.django_db
+def test_bulk_swap_skips_canceled_orders(event, subevents, swap_group, make_position):
+    from pretix_swap.bulk import execute_swap_pairs
+
+    with scopes_disabled():
+        event.quotas.filter(subevent=subevents[1]).update(size=1)
+        make_position(subevents[1])  # Takes the only ticket on the second date
+        request = request_swap(make_position(subevents[0]), subevents[1])
+        partner = request_swap(make_position(subevents[1]), subevents[0])
+        partner.position.order.status = Order.STATUS_CANCELED
+        partner.position.order.save()
+
+        assert not match_open_swap_requests(event).matched
+        completed, rejected = execute_swap_pairs(event, [(request, partner)])
+
+        assert not completed
+        assert rejected[0][2].reason == Reasons.NOT_PAID
+        request.refresh_from_db()
+        assert request.position.subevent == subevents[0]
@@ -0,0 +1,202 @@
+import pytest
+from django.core.management import call_command
+from django_scopes import scopes_disabled
+from io import StringIO
+
+from pretix_swap import scheduler
+from pretix_swap.forms import SwapSettingsForm
+from pretix_swap.models import SwapGroup, SwapMatchingBucket, SwapRequest
+from pretix_swap.scheduler import (
+    CeleryExecutor,
+    SerialExecutor,
+    clear_dirty_buckets,
+    get_matching_shards,
+    load_dirty_buckets,
+    match_dirty_buckets,
+    match_events,
+)
+
+
+def request_swap(position, target_subevent):
+    return SwapRequest.objects.create(
+        position=position,
+        swap_type=SwapRequest.Types.SWAP,
+        target_subevent=target_subevent,
+    )
+
+
+@pytest.fixture
+def split_groups(event, item, subevents, cancelation_group):
+    with scopes_disabled():
+        for name, group_subevents in (
+            ("First", subevents[0:2]),
+            ("Second", subevents[2:3]),
+            ("Third", subevents[3:4]),
+            ("Bridge", [subevents[2], subevents[3]]),
+        ):
+            group = SwapGroup.objects.create(
+                event=event, name=name, swap_type=SwapGroup.Types.SWAP
+            )
+            group.items.add(item)
+            group.subevents.add(*group_subevents)
+
+
+@pytest.mark.django_db
+def test_shards_are_connected_subevents(event, subevents, split_groups):
+    with scopes_disabled():
+        assert get_matching_shards(event) == [
+            sorted([subevents[0].pk, subevents[1].pk]),
+            sorted([subevents[2].pk, subevents[3].pk]),
+        ]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("executor", [SerialExecutor, CeleryExecutor])
+def test_match_events_runs_all_shards(
+    event, subevents, split_groups, make_position, executor, caplog
+):
+    with scopes_disabled():
+        pairs = [
+            (
+                request_swap(make_position(subevents[a]), subevents[b]),
+                request_swap(make_position(subevents[b]), subevents[a]),
+            )
+            for a, b in ((0, 1), (2, 3))
+        ]
+
+        run = match_events([event], executor())
+
+        for first, second in pairs:
+            first.refresh_from_db()
+            assert first.state == SwapRequest.States.COMPLETED
+            assert first.partner_id == second.pk
+        shards = get_matching_shards(event)
+    if executor is SerialExecutor:
+        assert [result.subevent_ids for result in run.results] == shards
+        assert run.matches == 2
+        assert run.throughput > 0
+    else:
+        assert run is None  # The chord callback logs the totals
+    assert f"Matched swap requests: {len(shards)} shards, 2 matches" in caplog.text
+
+
+@pytest.mark.django_db
+def test_match_swap_requests_command(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        request_swap(make_position(subevents[1]), subevents[0])
+    out = StringIO()
+
+    call_command("match_swap_requests", executor="serial", stdout=out)
+
+    assert "1 matches" in out.getvalue()
+    with scopes_disabled():
+        first.refresh_from_db()
+    assert first.state == SwapRequest.States.COMPLETED
+
+
+@pytest.mark.django_db
+def test_idle_tick_is_a_single_query(event, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        assert match_dirty_buckets(SerialExecutor()) is None
+
+
+@pytest.mark.django_db
+def test_dirty_buckets_are_matched_once(event, item, subevents, make_position):
+    with scopes_disabled():
+        first = request_swap(make_position(subevents[0]), subevents[1])
+        second = request_swap(make_position(subevents[1]), subevents[0])
+        assert SwapMatchingBucket.objects.count() == 2
+
+        # Nothing can be matched without a swap group, but the marks are gone
+        assert match_dirty_buckets(SerialExecutor()).matches == 0
+        assert not SwapMatchingBucket.objects.exists()
+
+        group = SwapGroup.objects.create(
+            event=event, name="Swap", swap_type=SwapGroup.Types.SWAP
+        )
+        group.items.add(item)
+        group.subevents.add(subevents[0], subevents[1])
+
+        run = match_dirty_buckets(SerialExecutor())
+        assert run.matches == 1
+        assert [result.item_ids for result in run.results] == [[item.pk]]
+        first.refresh_from_db()
+        assert first.partner_id == second.pk
+        assert match_dirty_buckets(SerialExecutor()) is None
+
+
+@pytest.mark.django_db
+def test_clear_dirty_buckets_in_batches(
+    event, item, subevents, make_position, monkeypatch
+):
+    monkeypatch.setattr(scheduler, "CLAIM_BATCH_SIZE", 2)
+    with scopes_disabled():
+        for subevent in subevents:
+            request_swap(make_position(subevent), subevents[0])
+        scheduler.mark_buckets_dirty(event.pk, [item.pk], [subevents[0].pk])
+        (dirty,) = load_dirty_buckets().values()
+        assert set(dirty) == {(item.pk, subevent.pk) for subevent in subevents}
+        scheduler.mark_buckets_dirty(event.pk, [item.pk], [subevents[1].pk])
+
+        clear_dirty_buckets(dirty.values())
+
+        # Marked again in the meantime
+        assert list(
+            SwapMatchingBucket.objects.values_list("subevent_id", flat=True)
+        ) == [subevents[1].pk]
+
+
+@pytest.mark.django_db
+def test_failed_shard_keeps_dirty_buckets(
+    event, item, subevents, swap_group, make_position, monkeypatch
+):
+    def fail(*args, **kwargs):
+        raise RuntimeError("Worker died")
+
+    with scopes_disabled():
+        request_swap(make_position(subevents[0]), subevents[1])
+        monkeypatch.setattr(scheduler, "match_open_swap_requests", fail)
+        with pytest.raises(RuntimeError):
+            match_dirty_buckets(SerialExecutor())
+        assert SwapMatchingBucket.objects.exists()
+
+        monkeypatch.undo()
+        assert match_dirty_buckets(SerialExecutor()).matches == 0
+        assert not SwapMatchingBucket.objects.exists()
+
+
+@pytest.mark.django_db
+def test_group_without_items_marks_all_items(event, item, subevents, make_position):
+    with scopes_disabled():
+        request_swap(make_position(subevents[0]), subevents[1])
+        SwapMatchingBucket.objects.all().delete()
+
+        group = SwapGroup.objects.create(
+            event=event, name="Swap", swap_type=SwapGroup.Types.SWAP
+        )
+        group.subevents.add(subevents[0], subevents[1])
+
+        assert set(
+            SwapMatchingBucket.objects.values_list("item_id", "subevent_id")
+        ) == {(item.pk, subevents[0].pk), (item.pk, subevents[1].pk)}
+
+
+@pytest.mark.django_db
+def test_enabling_swaps_marks_open_requests(event, item, subevents, make_position):
+    event.settings.swap_orderpositions = False
+    with scopes_disabled():
+        request_swap(make_position(subevents[0]), subevents[1])
+        match_dirty_buckets(SerialExecutor())
+        assert not SwapMatchingBucket.objects.exists()
+
+        form = SwapSettingsForm(
+            obj=event,
+            data={"swap_orderpositions": "on", "swap_max_cycle_length": 2},
+        )
+        assert form.is_valid(), form.errors
+        form.save()
+
+        assert list(
+            SwapMatchingBucket.objects.values_list("item_id", "subevent_id")
+        ) == [(item.pk, subevents[0].pk)]
@@ -0,0 +1,93 @@
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPosition
+from pretix.base.signals import order_changed
+
+from pretix_swap.models import SwapMatchingBucket, SwapRequest
+from pretix_swap.signals import notifications_order_info_top, order_info_bottom
+
+
+def render_order_info(rf, event, order):
+    request = rf.get("/")
+    request.event = event
+    with CaptureQueriesContext(connection) as context:
+        top = notifications_order_info_top(event, request=request, order=order)
+        bottom = order_info_bottom(event, request=request, order=order)
+    return top + bottom, len(context.captured_queries)
+
+
+@pytest.mark.django_db
+def test_order_info_query_count_does_not_grow_with_positions(
+    rf, event, item, subevents, swap_group, make_position
+):
+    with scopes_disabled():
+        position = make_position(subevents[0])
+        order = position.order
+        SwapRequest.objects.create(
+            position=position,
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        render_order_info(rf, event, order)  # Warm up settings and rule caches
+        html, before = render_order_info(rf, event, order)
+        assert "You have requested to swap this product" in html
+
+        for i in range(2, 6):
+            position = OrderPosition.objects.create(
+                order=order,
+                item=item,
+                subevent=subevents[i % len(subevents)],
+                price=position.price,
+                positionid=i,
+            )
+            SwapRequest.objects.create(
+                position=position,
+                swap_type=SwapRequest.Types.SWAP,
+                target_subevent=subevents[0],
+            )
+        html, after = render_order_info(rf, event, order)
+        assert html.count("You have requested to swap this product") == 5
+        assert after == before == 2
+
+
+@pytest.mark.django_db
+def test_order_changed_syncs_request_columns(event, subevents, make_position):
+    with scopes_disabled():
+        position = make_position(subevents[0])
+        request = SwapRequest.objects.create(
+            position=position,
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[2],
+        )
+        SwapMatchingBucket.objects.all().delete()
+        OrderPosition.objects.filter(pk=position.pk).update(subevent=subevents[1])
+
+        order_changed.send(event, order=position.order)
+
+        request.refresh_from_db()
+        assert request.subevent == subevents[1]
+        assert SwapMatchingBucket.objects.filter(
+            item=position.item, subevent=subevents[1]
+        ).exists()
+
+
+@pytest.mark.django_db
+def test_own_swaps_do_not_mark_buckets(event, subevents, swap_group, make_position):
+    with scopes_disabled():
+        first = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        second = SwapRequest.objects.create(
+            position=make_position(subevents[1]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[0],
+        )
+        SwapMatchingBucket.objects.all().delete()
+
+        first.swap_with(second)
+
+        assert not SwapMatchingBucket.objects.exists()
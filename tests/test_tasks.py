@@ -0,0 +1,104 @@
+import pytest
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPayment
+
+from pretix_swap.models import SwapApproval, SwapApprovalJob, SwapRequest
+from pretix_swap.tasks import (
+    approve_chunk,
+    claim_cancelation_request,
+    process_paid_order,
+)
+
+
+@pytest.mark.django_db
+def test_paid_order_cancels_matching_request(
+    event,
+    subevents,
+    cancelation_group,
+    make_position,
+    django_capture_on_commit_callbacks,
+):
+    with scopes_disabled():
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+        order = make_position(subevents[0], status=Order.STATUS_PENDING).order
+        SwapApproval.objects.create(order=order)
+        payment = order.payments.create(
+            provider="manual",
+            amount=order.total,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+
+        with django_capture_on_commit_callbacks() as callbacks:
+            payment.confirm()
+        request.refresh_from_db()
+        assert request.state == SwapRequest.States.REQUESTED
+
+        for callback in callbacks:
+            callback()
+
+        request.refresh_from_db()
+        assert request.state == SwapRequest.States.COMPLETED
+        assert request.completed
+        assert request.target_order == order
+        assert SwapApproval.objects.get(order=order).processed
+
+
+@pytest.mark.django_db
+def test_process_paid_order_is_idempotent(
+    event, subevents, cancelation_group, make_position
+):
+    with scopes_disabled():
+        requests = [
+            SwapRequest.objects.create(
+                position=make_position(subevents[0]),
+                swap_type=SwapRequest.Types.CANCELATION,
+            )
+            for _ in range(2)
+        ]
+        order = make_position(subevents[0]).order
+        SwapApproval.objects.create(order=order)
+
+        process_paid_order.apply(kwargs={"event": event.pk, "order": order.pk})
+        process_paid_order.apply(kwargs={"event": event.pk, "order": order.pk})
+
+        states = [SwapRequest.objects.get(pk=request.pk).state for request in requests]
+        assert states == [SwapRequest.States.COMPLETED, SwapRequest.States.REQUESTED]
+
+
+@pytest.mark.django_db
+def test_claim_cancelation_request_takes_oldest(
+    event, subevents, cancelation_group, make_position
+):
+    with scopes_disabled():
+        requests = [
+            SwapRequest.objects.create(
+                position=make_position(subevent),
+                swap_type=SwapRequest.Types.CANCELATION,
+            )
+            for subevent in (subevents[1], subevents[0], subevents[0])
+        ]
+        position = make_position(subevents[0])
+
+        assert claim_cancelation_request(position) == requests[1]
+        assert claim_cancelation_request(position, exclude=[requests[1].pk]) == (
+            requests[2]
+        )
+        assert not claim_cancelation_request(
+            position, exclude=[requests[1].pk, requests[2].pk]
+        )
+
+
+@pytest.mark.django_db
+def test_approve_chunk_keeps_approvals_of_other_jobs(event, subevents, make_position):
+    with scopes_disabled():
+        order = make_position(subevents[0], status=Order.STATUS_PENDING).order
+        Order.objects.filter(pk=order.pk).update(require_approval=True)
+        approval = SwapApproval.objects.create(order=order)
+        job = SwapApprovalJob.objects.create(event=event, orders=[order.pk])
+
+        assert approve_chunk(event, job, job.orders) == (0, 1)
+
+        assert SwapApproval.objects.filter(pk=approval.pk).exists()
@@ -0,0 +1,105 @@
+import pytest
+from django_scopes import scopes_disabled
+from pretix.base.models import Item
+
+from pretix_swap.models import SwapGroup
+from pretix_swap.utils import (
+    ELIGIBILITY_VERSION_KEY,
+    bump_eligibility_version,
+    can_be_canceled,
+    can_be_swapped,
+    get_cancelable_subevents,
+    get_eligibility_version,
+    get_swappable_subevents,
+    get_target_subevents,
+    get_valid_swap_types,
+)
+
+
+@pytest.mark.django_db
+def test_eligibility_is_answered_from_index(
+    event, item, subevents, swap_group, make_position, django_assert_num_queries
+):
+    with scopes_disabled():
+        position = make_position(subevents[0])
+        assert can_be_swapped(event, item, subevents[0], subevents[1])
+        with django_assert_num_queries(0):
+            assert can_be_swapped(event, item, subevents[1], subevents[2])
+            assert not can_be_canceled(event, item, subevents[0])
+            assert get_valid_swap_types(position) == ["s"]
+        assert set(get_target_subevents(position, "s")) == set(subevents[1:])
+
+
+@pytest.mark.django_db
+def test_eligibility_respects_items(event, item, subevents, swap_group):
+    with scopes_disabled():
+        other_item = Item.objects.create(event=event, name="Other", default_price=23)
+        assert not can_be_swapped(event, other_item, subevents[0], subevents[1])
+        swap_group.items.clear()
+        assert can_be_swapped(event, other_item, subevents[0], subevents[1])
+
+
+@pytest.mark.django_db
+def test_eligibility_is_invalidated(event, item, subevents, swap_group):
+    with scopes_disabled():
+        assert not can_be_canceled(event, item, subevents[0])
+        group = SwapGroup.objects.create(event=event, name="Cancel", swap_type="c")
+        group.subevents.add(subevents[0])
+        assert can_be_canceled(event, item, subevents[0])
+        assert not can_be_canceled(event, item, subevents[1])
+
+        swap_group.subevents.remove(subevents[3])
+        assert not can_be_swapped(event, item, subevents[0], subevents[3])
+
+        group.delete()
+        assert not can_be_canceled(event, item, subevents[0])
+
+
+@pytest.mark.django_db
+def test_eligibility_is_shared_through_cache(
+    event, item, subevents, swap_group, cache, django_assert_num_queries
+):
+    from pretix_swap.utils import _eligibility_cache
+
+    with scopes_disabled():
+        assert can_be_swapped(event, item, subevents[0], subevents[1])
+        _eligibility_cache.clear()  # A different worker process
+        with django_assert_num_queries(0):
+            assert can_be_swapped(event, item, subevents[0], subevents[1])
+
+        # Another worker changes the configuration without touching our memory
+        SwapGroup.subevents.through.objects.filter(subevent_id=subevents[1].pk).delete()
+        cache.set(ELIGIBILITY_VERSION_KEY.format(event_id=event.pk), "bumped")
+        assert not can_be_swapped(event, item, subevents[0], subevents[1])
+
+
+@pytest.mark.django_db
+def test_eligibility_version_changes_after_commit(
+    event, cache, django_capture_on_commit_callbacks
+):
+    with django_capture_on_commit_callbacks(execute=True):
+        bump_eligibility_version(event.pk)
+        # Another worker may cache the uncommitted rules under this version
+        during = get_eligibility_version(event.pk)
+    assert get_eligibility_version(event.pk) != during
+
+
+@pytest.mark.django_db
+def test_reachable_subevents_for_all_items(
+    event, item, subevents, swap_group, cancelation_group, django_assert_num_queries
+):
+    with scopes_disabled():
+        other_item = Item.objects.create(event=event, name="Other", default_price=23)
+        swap_group.subevents.remove(subevents[3])
+        general = SwapGroup.objects.create(event=event, name="All", swap_type="s")
+        general.subevents.add(subevents[3])
+
+        assert get_swappable_subevents(event) == {
+            item.pk: {subevent.pk for subevent in subevents},
+            other_item.pk: {subevents[3].pk},
+        }
+        with django_assert_num_queries(0):
+            assert get_cancelable_subevents(event, [item.pk, other_item.pk]) == {
+                item.pk: {subevent.pk for subevent in subevents},
+                other_item.pk: set(),
+            }
@@ -0,0 +1,66 @@
+import pytest
+from decimal import Decimal
+from django_scopes import scopes_disabled
+
+from pretix_swap import validation
+from pretix_swap.models import SwapRequest
+from pretix_swap.tasks import match_cancelation_requests
+from pretix_swap.validation import CandidateValidator, Reasons
+
+
+@pytest.mark.django_db
+def test_validator_rejects_swaps_without_queries(
+    event, subevents, swap_group, make_position, django_assert_num_queries
+):
+    with scopes_disabled():
+        swap_group.subevents.remove(subevents[2])
+        requests = [
+            SwapRequest.objects.select_related("position__order").get(
+                pk=SwapRequest.objects.create(
+                    position=make_position(subevent),
+                    swap_type=SwapRequest.Types.SWAP,
+                    target_subevent=target,
+                ).pk
+            )
+            for subevent, target in (
+                (subevents[0], subevents[1]),
+                (subevents[1], subevents[0]),
+                (subevents[2], subevents[0]),
+                (subevents[1], subevents[2]),
+            )
+        ]
+        validator = CandidateValidator(event)
+
+        with django_assert_num_queries(0):
+            assert validator.check_swap(requests[0], requests[1]) is None
+            same_date = validator.check_swap(requests[0], requests[0])
+            not_allowed = validator.check_swap(requests[0], requests[2])
+            other_target = validator.check_swap(requests[0], requests[3])
+        assert same_date.reason == Reasons.SAME_DATE
+        assert other_target.reason == Reasons.DATE_MISMATCH
+        assert not_allowed.reason == Reasons.NOT_ALLOWED
+        assert str(not_allowed) == "This swap is currently not allowed."
+
+
+@pytest.mark.django_db
+def test_cancelation_rejections_are_counted(
+    event, subevents, cancelation_group, make_position, monkeypatch
+):
+    counted = []
+    monkeypatch.setattr(
+        validation.candidate_rejections,
+        "inc",
+        lambda amount, operation, reason: counted.append((operation, reason)),
+    )
+    with scopes_disabled():
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0], price=Decimal("42.00")),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+        order = make_position(subevents[0]).order
+
+        match_cancelation_requests(order)
+
+        request.refresh_from_db()
+        assert request.state == SwapRequest.States.REQUESTED
+        assert counted == [("cancelation", Reasons.PRICE_MISMATCH)]
@@ -0,0 +1,364 @@
+import pytest
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_scopes import scopes_disabled
+from pretix.base.models import Order, OrderPosition, Quota
+
+from pretix_swap.models import SwapApproval, SwapRequest, SwapStatsSnapshot
+from pretix_swap.stats import get_snapshot, rebuild_snapshot, update_snapshot
+from pretix_swap.views import SwapStats
+
+
+def stats_url(event):
+    return f"/control/event/{event.organizer.slug}/{event.slug}/swap"
+
+
+@pytest.mark.django_db
+def test_stats_requests_by_state(admin_client, event, subevents, make_position):
+    with scopes_disabled():
+        SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+            state=SwapRequest.States.COMPLETED,
+        )
+
+    response = admin_client.get(stats_url(event))
+
+    overview = {line.subevent: line for line in response.context["overview"]}
+    assert overview[subevents[0]].open_swap_requests == 1
+    assert overview[subevents[0]].completed_cancelation_requests == 1
+    assert overview[subevents[0]].open_cancelation_requests == 0
+    assert overview[subevents[1]].open_swap_requests == 0
+
+
+def get_stats_view(rf, event, path="/"):
+    view = SwapStats()
+    view.request = rf.get(path)
+    view.request.event = event
+    return view
+
+
+@pytest.mark.django_db
+def test_stats_requests_by_state_query_count(
+    rf, event, subevents, make_position, django_assert_num_queries
+):
+    with scopes_disabled():
+        for subevent in subevents:
+            SwapRequest.objects.create(
+                position=make_position(subevent),
+                swap_type=SwapRequest.Types.SWAP,
+                target_subevent=subevents[0],
+            )
+        rebuild_snapshot(event)
+        view = get_stats_view(rf, event)
+        with django_assert_num_queries(2):
+            assert len(view.requests_by_state) == len(subevents)
+
+
+@pytest.mark.django_db
+def test_stats_snapshot_is_updated_incrementally(
+    event, subevents, swap_group, make_position
+):
+    with scopes_disabled():
+        rebuild_snapshot(event)
+        first = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        update_snapshot(event, subevents[0], open_swap_requests=1)
+        second = SwapRequest.objects.create(
+            position=make_position(subevents[1]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[0],
+        )
+        update_snapshot(event, subevents[1], open_swap_requests=1)
+        first.swap_with(second)
+
+        def counts():
+            return {
+                line.subevent_id: (
+                    line.open_swap_requests,
+                    line.completed_swap_requests,
+                )
+                for line in get_snapshot(event)
+            }
+
+        incremental = counts()
+        rebuild_snapshot(event)
+        assert incremental == counts()
+        assert incremental[subevents[0].pk] == (0, 1)
+
+
+@pytest.mark.django_db
+def test_withdrawn_request_leaves_snapshot(
+    client, event, subevents, swap_group, make_position
+):
+    event.live = True
+    event.save()
+    with scopes_disabled():
+        request = SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[1],
+        )
+        rebuild_snapshot(event)
+        order = request.position.order
+    url = (
+        f"/{event.organizer.slug}/{event.slug}/order/{order.code}/{order.secret}"
+        f"/swap/{request.pk}/cancel"
+    )
+
+    assert client.get(url).status_code == 200
+    assert client.post(url).status_code == 302
+
+    with scopes_disabled():
+        assert not SwapRequest.objects.filter(pk=request.pk).exists()
+        line = SwapStatsSnapshot.objects.get(event=event, subevent=subevents[0])
+    assert line.open_swap_requests == 0
+
+
+def count_stats_queries(rf, event):
+    rebuild_snapshot(event)
+    view = get_stats_view(rf, event)
+    with CaptureQueriesContext(connection) as context:
+        view.requests_by_date
+        view.requests_by_state
+    return len(context.captured_queries)
+
+
+@pytest.mark.django_db
+def test_stats_query_count_does_not_grow_with_subevents(
+    rf, event, item, subevents, make_position
+):
+    def add_subevent(i):
+        subevent = event.subevents.create(
+            name=f"Extra {i}", date_from=subevents[0].date_from
+        )
+        Quota.objects.create(event=event, subevent=subevent, size=10).items.add(item)
+        position = make_position(subevent, status=Order.STATUS_PENDING)
+        position.order.require_approval = True
+        position.order.save()
+        SwapRequest.objects.create(
+            position=make_position(subevent),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+
+    with scopes_disabled():
+        add_subevent(0)
+        before = count_stats_queries(rf, event)
+        for i in range(1, 10):
+            add_subevent(i)
+        assert count_stats_queries(rf, event) == before
+
+
+@pytest.mark.django_db
+def test_stats_requests_by_date(admin_client, event, item, subevents, make_position):
+    with scopes_disabled():
+        pending = make_position(subevents[0], status=Order.STATUS_PENDING)
+        pending.order.require_approval = True
+        pending.order.save()
+        make_position(subevents[0], status=Order.STATUS_PENDING)
+        SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+        Quota.objects.filter(subevent=subevents[0]).update(size=None)
+        Quota.objects.create(event=event, subevent=subevents[0], size=5).items.add(item)
+
+    response = admin_client.get(stats_url(event))
+
+    (line,) = response.context["by_subevents"]
+    assert line["subevent"] == subevents[0]
+    assert line["approval_orders"] == 1
+    assert line["pending_orders"] == 1
+    assert line["open_cancelation_requests"] == 1
+    assert line["available_in_quota"] == [5 - 3]
+
+    with scopes_disabled():  # Pending orders are counted live
+        make_position(subevents[0], status=Order.STATUS_PENDING)
+    response = admin_client.get(stats_url(event))
+    (line,) = response.context["by_subevents"]
+    assert line["pending_orders"] == 2
+    assert response.context["snapshot_rebuilt"]
+
+
+@pytest.mark.django_db
+def test_stats_rebuild_only_on_post(admin_client, event, subevents, make_position):
+    with scopes_disabled():
+        rebuild_snapshot(event)
+        SwapRequest.objects.create(
+            position=make_position(subevents[0]),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+        SwapRequest.objects.create(  # Unpaid orders are not counted
+            position=make_position(subevents[0], status=Order.STATUS_PENDING),
+            swap_type=SwapRequest.Types.CANCELATION,
+        )
+    url = stats_url(event) + "/rebuild"
+
+    assert admin_client.get(url).status_code == 405
+    with scopes_disabled():
+        line = SwapStatsSnapshot.objects.get(event=event, subevent=subevents[0])
+    assert line.open_cancelation_requests == 0
+
+    assert admin_client.post(url).status_code == 302
+    with scopes_disabled():
+        line = SwapStatsSnapshot.objects.get(event=event, subevent=subevents[0])
+    assert line.open_cancelation_requests == 1
+
+
+@pytest.mark.django_db
+def test_stats_approves_orders_in_background(
+    admin_client, event, subevents, make_position
+):
+    with scopes_disabled():
+        orders = []
+        for i in range(3):
+            position = make_position(subevents[0], status=Order.STATUS_PENDING)
+            position.order.require_approval = True
+            position.order.save()
+            orders.append(position.order)
+
+    response = admin_client.post(
+        stats_url(event), {f"subevent_{subevents[0].pk}": "2"}, follow=True
+    )
+
+    job = response.context["job"]
+    assert (job.approved, job.failed, job.remaining) == (2, 0, 0)
+    assert job.finished
+    with scopes_disabled():
+        for order in orders:
+            order.refresh_from_db()
+        assert [order.require_approval for order in orders] == [False, False, True]
+        assert SwapApproval.objects.filter(order__in=orders).count() == 2
+
+
+def walk_swap_wizard(client, event, order, position, target_subevent):
+    """Submits every step of the swap wizard and returns the number of
+    queries per step."""
+    url = f"/{event.organizer.slug}/{event.slug}/order/{order.code}/{order.secret}/swap/new"
+    steps = [
+        ("position", {"position-position": position.pk}),
+        ("type", {"type-swap_type": SwapRequest.Types.SWAP}),
+        ("details", {"details-target_subevent": target_subevent.pk}),
+        ("confirm", {}),
+    ]
+    counts = {}
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(url)
+    assert response.status_code == 200
+    counts["get"] = len(context.captured_queries)
+    for step, data in steps:
+        with CaptureQueriesContext(connection) as context:
+            response = client.post(
+                url, {"swap_create-current_step": step, **data}, follow=False
+            )
+        assert response.status_code in (200, 302), step
+        if step != "confirm":
+            assert response.context["wizard"]["steps"].current != step
+        counts[step] = len(context.captured_queries)
+    return counts
+
+
+@pytest.mark.django_db
+def test_swap_wizard_query_counts_do_not_grow_with_positions(
+    client, event, item, subevents, swap_group, cancelation_group, make_position
+):
+    def add_positions(order, count):
+        with scopes_disabled():
+            for _ in range(count):
+                OrderPosition.objects.create(
+                    order=order,
+                    item=item,
+                    subevent=subevents[0],
+                    price=order.total,
+                    positionid=order.positions.count() + 1,
+                )
+
+    event.live = True
+    event.save()
+    small = make_position(subevents[0])
+    add_positions(small.order, 1)
+    large = make_position(subevents[0])
+    add_positions(large.order, 5)
+
+    walk_swap_wizard(client, event, small.order, small, subevents[1])  # Warm up
+    client.cookies.clear()
+    small_counts = walk_swap_wizard(client, event, small.order, small, subevents[2])
+    client.cookies.clear()
+    large_counts = walk_swap_wizard(client, event, large.order, large, subevents[2])
+
+    assert small_counts == large_counts
+    with scopes_disabled():
+        assert SwapRequest.objects.filter(position__in=[small, large]).count() == 3
+
+
+@pytest.mark.django_db
+def test_swap_groups_export_and_import(admin_client, event, swap_group):
+    url = f"/control/event/{event.organizer.slug}/{event.slug}/settings/swap"
+    export = admin_client.get(f"{url}/export/")
+    assert export["Content-Disposition"].endswith('_swap_groups.json"')
+
+    upload = SimpleUploadedFile("groups.json", export.content)
+    response = admin_client.post(
+        f"{url}/import/", {"file": upload, "replace": "on"}, follow=True
+    )
+
+    assert response.status_code == 200
+    with scopes_disabled():
+        (group,) = event.swap_groups.all()
+        assert group.pk != swap_group.pk
+        assert group.subevents.count() == 4
+
+
+@pytest.mark.django_db
+def test_swap_wizard_matches_in_background(
+    client,
+    event,
+    subevents,
+    swap_group,
+    cancelation_group,
+    make_position,
+    django_capture_on_commit_callbacks,
+):
+    event.live = True
+    event.save()
+    event.settings.swap_async_matching = True
+    position = make_position(subevents[0])
+    with scopes_disabled():
+        OrderPosition.objects.create(  # Only then the wizard asks for a position
+            order=position.order,
+            item=position.item,
+            subevent=subevents[0],
+            price=position.price,
+            positionid=2,
+        )
+        partner = SwapRequest.objects.create(
+            position=make_position(subevents[1]),
+            swap_type=SwapRequest.Types.SWAP,
+            target_subevent=subevents[0],
+        )
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        walk_swap_wizard(client, event, position.order, position, subevents[1])
+    with scopes_disabled():
+        request = SwapRequest.objects.get(position=position)
+    assert request.state == SwapRequest.States.REQUESTED
+    assert request.matching_queued
+    order_url = f"/{event.organizer.slug}/{event.slug}/order/{position.order.code}/{position.order.secret}/"
+    assert "looking for a swap partner" in client.get(order_url).content.decode()
+
+    for callback in callbacks:
+        callback()
+    with scopes_disabled():
+        request.refresh_from_db()
+    assert request.state == SwapRequest.States.COMPLETED
+    assert request.partner == partner
+    assert not request.matching_queued